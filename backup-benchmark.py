@@ -0,0 +1,341 @@
+#!python
+"""
+Backup benchmarks
+
+Generates deterministic synthetic directory trees and times the backup.py code paths that matter at
+scale on each of them: scanning, saving and loading the tree, filter changes, sorting, writing
+FILES.csv and README.txt, and copying.
+
+Trees come in a few shapes:
+* deep - a long chain of nested directories with a few files at each level
+* wide - a directory with thousands of subdirectories
+* small - many small files spread over a moderate number of directories
+* huge - a few very large files
+
+Results are appended to a CSV file, and each timing is compared with the previous run of the same
+shape and operation, so runs can be compared across changes.
+
+"""
+
+from __future__ import print_function
+from csv import DictReader, DictWriter
+from datetime import datetime
+from optparse import OptionParser
+import json
+import os
+import random
+import shutil
+import sys
+import time
+
+import backup
+
+SHAPES = ('deep', 'wide', 'small', 'huge')
+
+OPERATIONS = (
+    'ls',
+    'save',
+    'load',
+    'load_walk',
+    'filter',
+    'index',
+    'search',
+    'sort_by_name',
+    'write_file_list',
+    'write_readme',
+    'copy',
+    'copy_unchanged',
+)
+
+RESULT_FIELDS = (
+    'date',
+    'label',
+    'shape',
+    'scale',
+    'operation',
+    'entries',
+    'bytes',
+    'wall_seconds',
+    'cpu_seconds',
+    'listing',
+)
+
+SPEC_NAME = 'shape.json'
+FILTER_SAMPLE_SIZE = 1000
+BLOCK_SIZE = 64 * 1024
+
+
+def parse_command_line():
+
+    parser = OptionParser(
+        usage='%prog [options] WORK_DIR'
+    )
+
+    # options
+
+    parser.add_option(
+        '--shape', dest='shapes', default=[], action='append', type='choice', choices=SHAPES,
+        help='tree shape to benchmark: deep, wide, small or huge (repeatable, default: all)',
+    )
+
+    parser.add_option(
+        '--scale', dest='scale', default=1.0, type='float',
+        help='multiplier for the number of entries (or, for huge trees, the file size) (default: %default)',
+    )
+
+    parser.add_option(
+        '--seed', dest='seed', default=0, type='int',
+        help='seed for the tree generator (default: %default)',
+    )
+
+    parser.add_option(
+        '--label', dest='label', default='',
+        help='name for this run in the results, e.g. a commit id',
+    )
+
+    parser.add_option(
+        '--results', dest='results_path', default=None,
+        help='CSV file results are appended to (default: WORK_DIR/benchmark-results.csv)',
+    )
+
+    parser.add_option(
+        '--skip', dest='skip', default=[], action='append', type='choice', choices=OPERATIONS,
+        help='operation to leave out, e.g. copy (repeatable)',
+    )
+
+    parser.add_option(
+        '--scan-workers', dest='scan_workers', default=backup.DEFAULT_SCAN_WORKERS, type='int',
+        help='number of directories to list in parallel (default: %default)',
+    )
+
+    parser.add_option(
+        '--copy-workers', dest='copy_workers', default=backup.DEFAULT_COPY_WORKERS, type='int',
+        help='number of files to copy in parallel (default: %default)',
+    )
+
+    (options, args) = parser.parse_args()
+
+    # args
+
+    if len(args) < 1:
+        parser.print_usage()
+        sys.exit(1)
+
+    return (options, args)
+
+
+def shape_spec(shape, scale):
+    # every directory down to the given number of levels gets the same number of subdirectories
+    # and files, with file sizes picked between min_size and max_size
+    count = lambda n: max(1, int(n * scale))
+    if shape == 'deep':
+        return dict(levels=count(200), directories=1, files=5, min_size=0, max_size=4096)
+    if shape == 'wide':
+        return dict(levels=1, directories=count(2000), files=count(10), min_size=0, max_size=1024)
+    if shape == 'small':
+        return dict(levels=2, directories=count(20), files=count(100), min_size=0, max_size=4096)
+    if shape == 'huge':
+        return dict(levels=1, directories=1, files=4, min_size=count(64 * 1024 * 1024),
+                    max_size=count(64 * 1024 * 1024))
+    raise ValueError('Unknown shape %s' % (shape,))
+
+
+def write_file(path, size, block):
+    with open(path, 'wb') as f:
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def generate_tree(root, spec, seed):
+    # the same spec and seed always produce the same names, sizes and contents
+    rng = random.Random(seed)
+    block = bytearray(rng.randrange(256) for i in range(BLOCK_SIZE))
+    pending = [(root, 0)]
+    while pending:
+        (path, level) = pending.pop()
+        os.makedirs(path)
+        for i in range(spec['files']):
+            name = 'file%05d.%s' % (i, rng.choice(('txt', 'jpg', 'dat', 'log')))
+            write_file(os.path.join(path, name), rng.randint(spec['min_size'], spec['max_size']), block)
+        if level < spec['levels']:
+            # short names keep deep paths under the platform's path length limit
+            for i in range(spec['directories']):
+                pending.append((os.path.join(path, 'd%d' % (i,)), level + 1))
+
+
+def prepare_tree(work_path, shape, scale, seed):
+    # generated trees are kept and reused while their spec and seed stay the same
+    path = os.path.join(work_path, shape)
+    source_path = os.path.join(path, 'source')
+    spec = dict(shape_spec(shape, scale), seed=seed)
+    spec_path = os.path.join(path, SPEC_NAME)
+    if os.path.exists(spec_path):
+        with open(spec_path) as f:
+            if json.load(f) == spec:
+                return source_path
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    print('Generating %s tree ...' % (shape,))
+    start_time = time.time()
+    generate_tree(source_path, spec, seed)
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f, sort_keys=True)
+    print('Completed in %.1f seconds' % (time.time() - start_time,))
+    return source_path
+
+
+def load_previous_results(path):
+    previous = dict()
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            for row in DictReader(f):
+                previous[(row['shape'], row['scale'], row['operation'])] = row
+    return previous
+
+
+def benchmark_shape(options, work_path, shape, record):
+    source_path = prepare_tree(work_path, shape, options.scale, options.seed)
+    path = os.path.dirname(source_path)
+    tree_file_path = os.path.join(path, 'tree.dat')
+    copy_path = os.path.join(path, 'copy')
+    state = dict()
+
+    def timed(operation, function):
+        if operation in options.skip:
+            return
+        start_time = time.time()
+        start_cpu = backup.cpu_time()
+        (entries, size) = function()
+        record(shape, operation, entries, size, time.time() - start_time, backup.cpu_time() - start_cpu)
+
+    def ls():
+        stats = dict()
+        state['tree'] = backup.DirTree.ls(source_path, options.scan_workers, stats)
+        return stats['entries'], state['tree'].size
+
+    def save():
+        state['tree'].save(tree_file_path)
+        return None, os.path.getsize(tree_file_path)
+
+    def load():
+        backup.DirTree.load(tree_file_path)
+        return None, os.path.getsize(tree_file_path)
+
+    def load_walk():
+        return sum(1 for (node, relpath) in backup.walk_tree(backup.DirTree.load(tree_file_path))), None
+
+    def change_filters():
+        # exclude then re-include a fixed sample of entries, one at a time, the way clicks in the
+        # file chooser do
+        nodes = [node for (node, relpath) in backup.walk_tree(state['tree'])][1:]
+        sample = random.Random(options.seed).sample(nodes, min(FILTER_SAMPLE_SIZE, len(nodes)))
+        for node in sample:
+            node.exclude_all()
+        for node in sample:
+            node.include_all()
+        return 2 * len(sample), None
+
+    def index():
+        state['index'] = backup.NameIndex(state['tree'])
+        return len(state['index']), None
+
+    def search():
+        index = state.get('index') or backup.NameIndex(state['tree'])
+        return sum(len(index.search(query)) for query in ('file0', '*.jpg', 'd1')), None
+
+    def sort_by_name():
+        state['tree'].sort_by_name()
+        return None, None
+
+    def write_file_list():
+        with open(os.devnull, 'wb') as f:
+            writer = DictWriter(f, fieldnames=('path', 'is_directory', 'size'))
+            writer.writeheader()
+            backup.write_file_list(state['tree'], writer)
+        return None, None
+
+    def write_readme():
+        with open(os.devnull, 'w') as f:
+            backup.write_readme(state['tree'], f, source_path)
+        return None, None
+
+    def copy():
+        (counts, sizes, copied_bytes) = backup.copy_tree_native(
+            state['tree'], source_path, copy_path, options.copy_workers)
+        return sum(counts.values()), copied_bytes
+
+    if os.path.exists(copy_path):
+        shutil.rmtree(copy_path)
+
+    print('Benchmarking %s tree ...' % (shape,))
+    timed('ls', ls)
+    if 'tree' not in state:
+        state['tree'] = backup.DirTree.ls(source_path, options.scan_workers)
+    timed('save', save)
+    if os.path.exists(tree_file_path):
+        timed('load', load)
+        timed('load_walk', load_walk)
+    timed('filter', change_filters)
+    timed('index', index)
+    timed('search', search)
+    timed('sort_by_name', sort_by_name)
+    timed('write_file_list', write_file_list)
+    timed('write_readme', write_readme)
+    timed('copy', copy)
+    # the second copy finds every file unchanged
+    if 'copy' not in options.skip:
+        timed('copy_unchanged', copy)
+
+
+if __name__ == '__main__':
+    (options, args) = parse_command_line()
+
+    work_path = os.path.abspath(args[0])
+    if not os.path.exists(work_path):
+        os.makedirs(work_path)
+    results_path = options.results_path or os.path.join(work_path, 'benchmark-results.csv')
+    previous = load_previous_results(results_path)
+    append = os.path.isfile(results_path)
+    date = datetime.now()
+    # results files from before a column was added keep their columns
+    fields = RESULT_FIELDS
+    if append:
+        with open(results_path, 'rb') as f:
+            fields = DictReader(f).fieldnames or RESULT_FIELDS
+    print('Listing directories with %s' % (backup.LISTING_METHOD,))
+
+    with open(results_path, 'ab') as results_file:
+        writer = DictWriter(results_file, fields, extrasaction='ignore')
+        if not append:
+            writer.writeheader()
+
+        def record(shape, operation, entries, size, wall, cpu):
+            data = dict(
+                date=date,
+                label=options.label,
+                shape=shape,
+                scale=options.scale,
+                operation=operation,
+                entries=entries if entries is not None else '',
+                bytes=size if size is not None else '',
+                wall_seconds='%.4f' % (wall,),
+                cpu_seconds='%.4f' % (cpu,),
+                listing=backup.LISTING_METHOD,
+            )
+            writer.writerow(data)
+            results_file.flush()
+
+            comparison = ''
+            last = previous.get((shape, str(options.scale), operation))
+            if last and float(last['wall_seconds']) > 0:
+                comparison = ' (%+.0f%% vs %s)' % (
+                    (wall / float(last['wall_seconds']) - 1) * 100,
+                    last['label'] or last['date'],
+                )
+            print('  %-16s %9.3f s%s' % (operation, wall, comparison))
+
+        for shape in options.shapes or SHAPES:
+            benchmark_shape(options, work_path, shape, record)
+
+    print('Results appended to %s' % (results_path,))
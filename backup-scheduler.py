@@ -0,0 +1,199 @@
+#!python
+"""
+Backup scheduler
+
+Runs a set of backup.py jobs side by side, the way a nightly cron entry would run them one after
+another, without letting them fight over disks:
+* at most --jobs-per-device jobs read from or write to any one device at a time
+* each job copies within a share of its devices' bandwidth and IOPS budgets, split between the
+  jobs running on the device when it starts.  Shares aren't changed once a job is running, so a
+  job that starts alone keeps the whole budget, and a device can go over it until that job ends
+
+Jobs are read from a JSON file holding a list of objects:
+
+    [
+        {"name": "photos", "source": "/home/me/Photos", "dest": "/mnt/backup/photos",
+         "job": "/var/lib/backup/photos", "args": ["--snapshot"]},
+        ...
+    ]
+
+"name", "job" and "args" are optional.  Each job's output goes to NAME.log in the log directory.
+
+"""
+
+from __future__ import print_function
+from optparse import OptionParser
+import json
+import os
+import subprocess
+import sys
+import time
+
+import backup
+
+DEFAULT_MAX_JOBS = 4
+DEFAULT_JOBS_PER_DEVICE = 1
+POLL_SECONDS = 0.5
+BACKUP_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'backup.py')
+
+
+def parse_command_line():
+
+    parser = OptionParser(
+        usage='%prog [options] JOBS_FILE'
+    )
+
+    # options
+
+    parser.add_option(
+        '--max-jobs', dest='max_jobs', default=DEFAULT_MAX_JOBS, type='int',
+        help='number of jobs to run at once (default: %default)',
+    )
+
+    parser.add_option(
+        '--jobs-per-device', dest='jobs_per_device', default=DEFAULT_JOBS_PER_DEVICE, type='int',
+        help='number of jobs that may read from or write to one device at once (default: %default)',
+    )
+
+    parser.add_option(
+        '--device-bandwidth', dest='device_bandwidth', default=None,
+        help='bytes per second to split between the jobs copying from or to one device, e.g. 200M',
+    )
+
+    parser.add_option(
+        '--device-iops', dest='device_iops', default=None, type='int',
+        help='entries and chunks per second to split between the jobs copying from or to one device',
+    )
+
+    parser.add_option(
+        '--log-dir', dest='log_dir', default=None,
+        help='directory for the jobs\' output (default: next to JOBS_FILE)',
+    )
+
+    parser.add_option(
+        '-n', '--dry-run', dest='dry_run', default=False, action='store_true',
+        help='print the command for each job without running any',
+    )
+
+    (options, args) = parser.parse_args()
+
+    if options.device_bandwidth is not None:
+        try:
+            options.device_bandwidth = backup.parse_size(options.device_bandwidth)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # args
+
+    if len(args) < 1:
+        parser.print_usage()
+        sys.exit(1)
+
+    return (options, args)
+
+
+def load_jobs(path):
+    with open(path) as f:
+        jobs = json.load(f)
+    if not isinstance(jobs, list):
+        raise ValueError('%s: expected a list of jobs' % (path,))
+    names = set()
+    for (i, job) in enumerate(jobs):
+        if not isinstance(job, dict) or 'source' not in job or 'dest' not in job:
+            raise ValueError('%s: job %d needs a "source" and a "dest"' % (path, i + 1))
+        job.setdefault('name', os.path.basename(os.path.normpath(job['source'])) or 'job%d' % (i + 1,))
+        if job['name'] in names:
+            job['name'] = '%s-%d' % (job['name'], i + 1)
+        names.add(job['name'])
+        job.setdefault('args', [])
+    return jobs
+
+
+def device(path):
+    # destinations may not exist yet, in which case they end up on their closest existing parent's
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+def job_command(job, options, sharing=1):
+    # the job may use its devices' budget divided by sharing, the most jobs running on any of its
+    # devices, itself included
+    command = [sys.executable, BACKUP_SCRIPT, '-q']
+    if job.get('job'):
+        command += ['--job', job['job']]
+    if options.device_bandwidth:
+        command += ['--max-bandwidth', '%d' % (max(1, options.device_bandwidth // sharing),)]
+    if options.device_iops:
+        command += ['--max-iops', '%d' % (max(1, options.device_iops // sharing),)]
+    return command + list(job['args']) + [job['source'], job['dest']]
+
+
+def run_jobs(jobs, options, log_dir):
+    # starts jobs in file order whenever a slot is free on both of their devices; a job that has to
+    # wait doesn't hold up later ones that could start.  Returns (job, return code, seconds) tuples.
+    pending = list(jobs)
+    running = []
+    results = []
+    busy = dict()
+    try:
+        while pending or running:
+            for job in list(pending):
+                if len(running) >= options.max_jobs:
+                    break
+                if any(busy.get(d, 0) >= options.jobs_per_device for d in job['devices']):
+                    continue
+                pending.remove(job)
+                for d in job['devices']:
+                    busy[d] = busy.get(d, 0) + 1
+                print('Starting %s ...' % (job['name'],))
+                log = open(os.path.join(log_dir, job['name'] + '.log'), 'ab')
+                sharing = max(busy[d] for d in job['devices'])
+                process = subprocess.Popen(job_command(job, options, sharing), stdout=log, stderr=subprocess.STDOUT)
+                running.append((job, process, log, time.time()))
+            time.sleep(POLL_SECONDS)
+            for (job, process, log, start_time) in list(running):
+                if process.poll() is None:
+                    continue
+                running.remove((job, process, log, start_time))
+                log.close()
+                for d in job['devices']:
+                    busy[d] -= 1
+                elapsed_time = time.time() - start_time
+                results.append((job, process.returncode, elapsed_time))
+                print('%s %s in %.1f seconds' % (
+                    job['name'], 'completed' if process.returncode == 0 else 'FAILED', elapsed_time))
+    finally:
+        # interrupted: the jobs keep their partial copies, which the next run picks up
+        for (job, process, log, start_time) in running:
+            process.terminate()
+            process.wait()
+            log.close()
+    return results
+
+
+if __name__ == '__main__':
+    (options, args) = parse_command_line()
+
+    jobs_path = os.path.abspath(args[0])
+    jobs = load_jobs(jobs_path)
+    log_dir = options.log_dir or os.path.dirname(jobs_path)
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    for job in jobs:
+        job['devices'] = sorted(set((device(job['source']), device(job['dest']))))
+
+    if options.dry_run:
+        for job in jobs:
+            print('%s: %s' % (job['name'], ' '.join(job_command(job, options))))
+        sys.exit(0)
+
+    start_time = time.time()
+    results = run_jobs(jobs, options, log_dir)
+    failed = [job['name'] for (job, returncode, elapsed_time) in results if returncode != 0]
+    print('Ran %d jobs, %d failed%s' % (len(results), len(failed), (': ' + ', '.join(failed)) if failed else ''))
+    print('Completed in %.1f seconds' % (time.time() - start_time,))
+    if failed:
+        sys.exit(1)
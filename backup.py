@@ -10,23 +10,71 @@ Selected files are copied to the output directory, along with a few generated fi
 
 Job data can be saved to disk for later use.  Loading job data is often faster than re-scanning the directory.
 
+Directories are listed with scandir, which on python 2 is the scandir module ("pip install scandir").  Without it,
+Linux's readdir is used through ctypes; elsewhere every entry has to be stat'ed, which makes scans slower.
+
 """
 
 from __future__ import print_function
 from abc import abstractmethod, ABCMeta
+from array import array
+from bisect import bisect_right
+from collections import deque
 from csv import DictReader, DictWriter
 from datetime import datetime
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
+import codecs
+import errno
+import fnmatch
+import hashlib
+import heapq
+import itertools
 import json
+import mmap
+import operator
 import os
+import re
+import select
+import shutil
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
 import time
 import Tkinter as tk
 import ttk
 import tkFont as tkf
 
+try:
+    from Queue import Empty, Queue
+except ImportError:
+    from queue import Empty, Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
 
 def parse_command_line():
 
@@ -46,6 +94,123 @@ def parse_command_line():
         help='do a dry run (don\'t copy anything)',
     )
 
+    parser.add_option(
+        '--refresh', dest='refresh', default=False, action='store_true',
+        help='when loading a job, re-list only directories that changed since it was saved',
+    )
+
+    parser.add_option(
+        '--scan-workers', dest='scan_workers', default=DEFAULT_SCAN_WORKERS, type='int',
+        help='number of directories to list in parallel while scanning (default: %default)',
+    )
+
+    parser.add_option(
+        '--watch', dest='watch', default=False, action='store_true',
+        help='instead of copying, keep the job\'s directory tree up to date as files change, until '
+             'interrupted (Linux only)',
+    )
+
+    parser.add_option(
+        '--tree-backend', dest='tree_backend', default='memory', type='choice', choices=TREE_BACKENDS,
+        help='where the directory tree is kept: memory, or sqlite for trees too large for memory (a '
+             'database in the job, so needs --job) (default: %default)',
+    )
+
+    parser.add_option(
+        '--memory-usage', dest='memory_usage', default=False, action='store_true',
+        help='report how much memory the directory tree takes',
+    )
+
+    parser.add_option(
+        '--rules', dest='rules_path', default=None,
+        help='file of include and exclude rules (globs, regexes, sizes and ages) to apply to the tree',
+    )
+
+    parser.add_option(
+        '--analytics', dest='analytics', default=False, action='store_true',
+        help='print the largest files and directories, space per extension and space by file age',
+    )
+
+    parser.add_option(
+        '--unload-collapsed', dest='unload_collapsed', default=False, action='store_true',
+        help='remove rows from the file chooser when their directory is collapsed',
+    )
+
+    parser.add_option(
+        '--copy-engine', dest='copy_engine', default=None, type='choice', choices=COPY_ENGINES,
+        help='how to copy files: rsync, or native (multi-threaded, in-process) (default: rsync on '
+             'macOS, native elsewhere)',
+    )
+
+    parser.add_option(
+        '--compact-rsync-rules', dest='compact_rsync_rules', default=False, action='store_true',
+        help='give rsync shorter rules: excluded files in a directory that share an extension become '
+             'one *.EXT pattern, which also excludes new files with that extension, and when fewer '
+             'entries are included than excluded, only the included ones are listed, so new files '
+             'beside them aren\'t copied',
+    )
+
+    parser.add_option(
+        '--copy-workers', dest='copy_workers', default=DEFAULT_COPY_WORKERS, type='int',
+        help='number of files the native copy engine copies, or archives it compresses, in parallel '
+             '(default: %default)',
+    )
+
+    parser.add_option(
+        '--max-bandwidth', dest='max_bandwidth', default=None,
+        help='bytes per second the copy may transfer, e.g. 50M (B, K, M, G or T)',
+    )
+
+    parser.add_option(
+        '--max-iops', dest='max_iops', default=None, type='int',
+        help='entries and chunks per second the native copy engine may copy, or entries per second '
+             'archives may take in (rsync has no such limit, and ignores it)',
+    )
+
+    parser.add_option(
+        '--archive', dest='archive', default=None, type='choice', choices=tuple(sorted(ARCHIVE_COMPRESSIONS)),
+        help='instead of copying files one by one, write the included files to DEST_DIR as compressed '
+             'tar archives (gzip, bz2 or lzma), compressed in parallel by the copy workers, with an '
+             'index of which archive holds each file',
+    )
+
+    parser.add_option(
+        '--archive-chunk-size', dest='archive_chunk_size', default=DEFAULT_ARCHIVE_CHUNK_SIZE,
+        help='uncompressed size at which a new archive is started (default: %default)',
+    )
+
+    parser.add_option(
+        '--extract', dest='extract_path', default=None,
+        help='instead of backing up, restore one path from the archives in SOURCE_DIR into DEST_DIR, '
+             'decompressing only the archive that holds it',
+    )
+
+    parser.add_option(
+        '--snapshot', dest='snapshot', default=False, action='store_true',
+        help='copy into a new dated directory under DEST_DIR, hard-linking files that are unchanged '
+             'since the previous snapshot.  A snapshot that is cut short is carried on by the next run, '
+             'and is only used as the previous snapshot once complete',
+    )
+
+    parser.add_option(
+        '--hash', dest='hash_name', default=DEFAULT_HASH_NAME,
+        help='hash algorithm for the content hashes the native copy engine records in %s, or '
+             '"none" (default: %%default)' % (FILE_LIST_NAME,),
+    )
+
+    parser.add_option(
+        '--verify', dest='verify', default=None, type='choice',
+        choices=(VERIFY_QUICK, VERIFY_CONTENT, VERIFY_HASHES),
+        help='instead of copying, check an existing backup: "quick" compares sizes and modification '
+             'times, "content" also hashes source and destination, "hashes" checks the destination '
+             'against the hashes in its %s without reading the source' % (FILE_LIST_NAME,),
+    )
+
+    parser.add_option(
+        '--verify-workers', dest='verify_workers', default=None, type='int',
+        help='number of worker processes that hash files while verifying (default: one per CPU)',
+    )
+
     parser.add_option(
         '-q', '--quiet', dest='quiet', default=False, action='store_true',
         help='Non-interactive mode. (Don\'t show file chooser)',
@@ -53,6 +218,40 @@ def parse_command_line():
 
     (options, args) = parser.parse_args()
 
+    if options.tree_backend == 'sqlite':
+        if not options.job_path:
+            parser.error('--tree-backend sqlite needs --job')
+        if options.refresh or options.rules_path:
+            parser.error('--refresh and --rules need --tree-backend memory')
+
+    if options.max_bandwidth is not None:
+        try:
+            options.max_bandwidth = parse_size(options.max_bandwidth)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if options.hash_name != 'none':
+        try:
+            hashlib.new(options.hash_name)
+        except ValueError:
+            parser.error('unknown hash algorithm %r' % (options.hash_name,))
+
+    if options.watch and (not options.job_path or options.tree_backend != 'memory'):
+        parser.error('--watch needs --job and --tree-backend memory')
+
+    if options.archive:
+        if options.snapshot or options.verify:
+            parser.error('--archive can\'t be used with --snapshot or --verify')
+        if ARCHIVE_COMPRESSIONS[options.archive] not in tarfile.TarFile.OPEN_METH:
+            parser.error('%s archives need a newer python' % (options.archive,))
+        try:
+            options.archive_chunk_size = parse_size(options.archive_chunk_size)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if options.extract_path and len(args) != 2:
+        parser.error('--extract needs SOURCE_DIR (the archives) and DEST_DIR')
+
     # args
 
     """
@@ -70,8 +269,206 @@ FILTER_INCLUDE_ALL = 'I'
 FILTER_EXCLUDE_ALL = 'E'
 FILTER_PARTIAL = 'P'
 
+FILTERS = dict((f.encode('ascii'), f) for f in (FILTER_INCLUDE_ALL, FILTER_EXCLUDE_ALL, FILTER_PARTIAL))
+
 FILE_LIST_NAME = 'FILES.csv'
 
+SNAPSHOT_NAME_FORMAT = '%Y-%m-%d_%H%M%S'
+SNAPSHOT_NAME_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}_\d{6}$')
+# a snapshot is written under this suffix and only takes its dated name once complete
+SNAPSHOT_UNFINISHED_SUFFIX = '.unfinished'
+SNAPSHOT_NEW = 'new'
+SNAPSHOT_LINKED = 'linked'
+
+COPY_ENGINES = ('rsync', 'native')
+DEFAULT_HASH_NAME = 'sha256'
+
+VERIFY_QUICK = 'quick'
+VERIFY_CONTENT = 'content'
+VERIFY_HASHES = 'hashes'
+VERIFY_JOBS_PER_TASK = 64
+VERIFY_REPORT_NAME = 'verify.csv'
+DEFAULT_COPY_WORKERS = 4
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+COPY_JOBS_PER_TASK = 16
+# native copies record their progress in the job, with large files checkpointed every
+# COPY_CHECKPOINT_BYTES, so an interrupted copy can pick up where it stopped
+COPY_CHECKPOINT_NAME = 'copy-checkpoint.jsonl'
+COPY_CHECKPOINT_BYTES = 64 * 1024 * 1024
+RSYNC_PARTIAL_DIR = '.rsync-partial'
+# a line of rsync --info=progress2: bytes so far, percentage, rate, time and, once a file has been
+# transferred, (xfr#files, to-chk=...)
+RSYNC_PROGRESS_PATTERN = re.compile(br'^\s*([\d,]+)\s+\d+%(?:.*\(xfr#(\d+),)?')
+
+# archive output: the included files go into numbered tar archives of about --archive-chunk-size
+# each, with an index of the archive and offset (in the uncompressed tar) of every entry, so one
+# file can be restored by decompressing up to it in one archive
+ARCHIVE_COMPRESSIONS = dict(gzip='gz', bz2='bz2', lzma='xz')
+ARCHIVE_NAME_FORMAT = 'archive-%05d.tar.'
+ARCHIVE_NAME_PATTERN = re.compile(r'^archive-\d{5}\.tar\.(gz|bz2|xz)$')
+ARCHIVE_INDEX_NAME = 'archive-index.csv'
+DEFAULT_ARCHIVE_CHUNK_SIZE = '1G'
+
+COPY_DIRECTORY = 'directory'
+COPY_COPIED = 'copied'
+COPY_UNCHANGED = 'unchanged'
+COPY_LINKED = 'linked'
+COPY_IGNORED = 'ignored'
+COPY_VANISHED = 'vanished'
+COPY_FAILED = 'failed'
+COPY_STATUSES = (
+    COPY_DIRECTORY,
+    COPY_COPIED,
+    COPY_UNCHANGED,
+    COPY_LINKED,
+    COPY_IGNORED,
+    COPY_VANISHED,
+    COPY_FAILED,
+)
+
+# the errors a kernel-side copy fails with before copying anything when the files or file systems
+# don't support it, so the next method is tried
+KERNEL_COPY_UNSUPPORTED = set(getattr(errno, name) for name in (
+    'EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'EBADF') if hasattr(errno, name))
+
+DEFAULT_SCAN_WORKERS = 8
+
+LISTING_SCANDIR = 'scandir'
+LISTING_READDIR = 'readdir'
+LISTING_LISTDIR = 'listdir'
+# the type readdir gives a directory
+DT_DIR = 4
+
+ANALYTICS_NAME = 'analytics.json'
+ANALYTICS_TOP_COUNT = 20
+# (upper limit in days, label); files with no known modification time are counted separately
+ANALYTICS_AGE_BUCKETS = (
+    (7, 'under a week'),
+    (30, 'under a month'),
+    (365, 'under a year'),
+    (5 * 365, 'under 5 years'),
+    (None, '5 years or more'),
+)
+ANALYTICS_UNKNOWN_AGE = 'unknown'
+
+RULE_ACTIONS = dict(include='I', exclude='E')
+RULE_KINDS = ('glob', 'regex', 'size', 'age')
+RULE_COMPARISONS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+RULE_SIZE_UNITS = dict(B=1, K=1024, M=1024 ** 2, G=1024 ** 3, T=1024 ** 4)
+RULE_AGE_UNITS = dict(d=1, w=7, m=30, y=365)
+
+SEARCH_MAX_RESULTS = 1000
+SEARCH_WILDCARDS = re.compile(r'[*?[]')
+
+RUN_REPORT_NAME = 'report.json'
+RUN_HISTORY_NAME = 'reports.jsonl'
+RUN_PROGRESS_INTERVAL = 5.0
+
+# the escapes decode_text makes for bytes that aren't valid utf-8 (lone low surrogates, which on
+# narrow python 2 builds have to be told apart from the second half of a pair)
+ESCAPED_BYTE = re.compile(u'((?<![\ud800-\udbff])[\udc80-\udcff])')
+
+# the attributes of a DirTree node before nodes had __slots__, which --memory-usage compares with
+DIRTREE_LEGACY_ATTRIBUTES = (
+    '_DirTree__name',
+    '_DirTree__is_directory',
+    '_DirTree__parent',
+    '_DirTree__children',
+    '_DirTree__size',
+    '_DirTree__filtered_size',
+    '_DirTree__filter',
+    'treeview_iid',
+    'notes',
+)
+
+# tree file layout: header, then one fixed-width record per node in breadth-first order (so the
+# children of a node are consecutive records), then a table of the utf-8 names and notes.  The
+# size of a TREE_FILE_UNLISTED directory isn't known, and is written as 0.
+TREE_FILE_MAGIC = b'DIRTREE\0'
+TREE_FILE_VERSION = 1
+TREE_FILE_HEADER = struct.Struct('<8sIQQQ')
+TREE_FILE_NODE = struct.Struct('<QIqqQIQIddQBc')
+TREE_FILE_IS_DIRECTORY = 0x1
+TREE_FILE_HAS_STAMP = 0x2
+TREE_FILE_UNLISTED = 0x4
+
+# the stamp of a directory that was excluded when its scan reached it, and so was never listed.
+# It never matches a directory's real stamp, so the directory is listed once it's included again.
+UNLISTED_STAMP = (None, None, None)
+
+# a background scan is assembled on the UI thread in slices of at most SCAN_POLL_SECONDS, every
+# SCAN_POLL_INTERVAL_MS
+SCAN_POLL_SECONDS = 0.05
+SCAN_POLL_INTERVAL_MS = 100
+SCAN_LISTED = 'listed'
+SCAN_FINISHED = 'finished'
+
+# long enough to never expire, but keeps Queue.get() interruptible with Ctrl-C on python 2
+QUEUE_WAIT_FOREVER = 60 * 60 * 24 * 365
+
+# filter and notes edits go to a journal next to the tree file, which is folded back into the
+# tree file once it holds this many edits
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_COMPACT_ENTRIES = 1000
+
+# watch mode.  Names are the kernel's; creating, removing or renaming an entry re-lists its
+# directory, while modifying one only re-reads that entry.
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_BUFFER_SIZE = 64 * 1024
+WATCH_RELIST_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+WATCH_MASK = WATCH_RELIST_EVENTS | IN_MODIFY | IN_ATTRIB | IN_ONLYDIR | IN_DONT_FOLLOW
+WATCH_POLL_SECONDS = 1.0
+WATCH_CHECKPOINT_SECONDS = 60.0
+
+# trees too large for memory are kept in an SQLite database, one row per entry.  Ids are handed
+# out in listing order, so a parent's id is always lower than its children's.
+TREE_BACKENDS = ('memory', 'sqlite')
+SQLITE_TREE_NAME = 'tree.db'
+SQLITE_TREE_TABLE = '''
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    parent INTEGER,
+    name BLOB NOT NULL,
+    is_directory INTEGER NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    filtered_size INTEGER NOT NULL DEFAULT 0,
+    filter TEXT NOT NULL DEFAULT 'I',
+    notes TEXT,
+    mtime REAL,
+    depth INTEGER NOT NULL
+);
+'''
+# created after the rows are inserted, which is faster than keeping them up to date while scanning
+SQLITE_TREE_INDEXES = '''
+CREATE INDEX IF NOT EXISTS nodes_by_parent ON nodes (parent);
+CREATE INDEX IF NOT EXISTS nodes_by_depth ON nodes (depth, is_directory);
+'''
+SQLITE_NODE_COLUMNS = 'id, parent, name, is_directory, size, mtime'
+SQLITE_CHILD_ORDERS = dict(size='size DESC, id', name='lower(CAST(name AS TEXT)), id')
+SQLITE_SUBTREE = '''
+WITH RECURSIVE subtree(id) AS (
+    SELECT ?
+    UNION ALL
+    SELECT nodes.id FROM nodes JOIN subtree ON nodes.parent = subtree.id WHERE nodes.filter != ?
+)
+'''
+
 
 def friendly_decimal(num):
     num = round(num, 1)
@@ -88,19 +485,313 @@ def friendly_file_size(num):
     return "%f %s" % (friendly_decimal(num), 'YB')
 
 
-class DirTree:
+def escape_undecodable(error):
+    # python 2 has no surrogateescape error handler; this is the decoding half of it
+    if not isinstance(error, UnicodeDecodeError):
+        raise error
+    return u''.join(unichr(0xdc00 + ord(c)) for c in error.object[error.start:error.end]), error.end
+
+
+if str is bytes:
+    codecs.register_error('surrogateescape', escape_undecodable)
+
+
+def encode_text(text):
+    # the inverse of decode_text, so names that aren't valid utf-8 come back as the same bytes
+    if isinstance(text, bytes):
+        return text
+    if str is bytes:
+        # python 2's utf-8 encoder passes the escapes through, so they're turned back into bytes here
+        parts = ESCAPED_BYTE.split(text)
+        return b''.join(chr(ord(part) - 0xdc00) if i % 2 else part.encode('utf-8') for (i, part) in enumerate(parts))
+    return text.encode('utf-8', 'surrogateescape')
+
+
+def decode_text(data):
+    return data.decode('utf-8', 'surrogateescape')
+
+
+def decode_name(data):
+    # file names are kept as the file system's bytes on python 2, where paths are bytes, and as
+    # text with undecodable bytes escaped on python 3, so they round-trip through a saved tree
+    return data if str is bytes else decode_text(data)
+
+
+def parse_size(text):
+    # a number of bytes with an optional unit from RULE_SIZE_UNITS, e.g. "50M"
+    match = re.match(r'^\s*([0-9.]+)\s*([A-Za-z]?)\s*$', text)
+    unit = (match.group(2).upper() or 'B') if match else None
+    if unit not in RULE_SIZE_UNITS:
+        raise ValueError('expected a size like "50M", got %r' % (text,))
+    return float(match.group(1)) * RULE_SIZE_UNITS[unit]
+
+
+def directory_stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime, st.st_ctime, st.st_ino)
+
+
+def load_libc():
+    # the C library, for the system calls python 2's os module doesn't have; None where ctypes
+    # isn't available
+    if ctypes is None:
+        return None
+    return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+
+def load_readdir():
+    # Linux's readdir64 through ctypes, which like scandir gives each entry's type without a stat
+    # call, for python 2 without the scandir module.  Returns a function that yields the (byte
+    # string name, d_type) entries of a directory, or None where readdir64 isn't available.
+    if not sys.platform.startswith('linux'):
+        return None
+    libc = load_libc()
+    if libc is None or not hasattr(libc, 'readdir64'):
+        return None
+
+    class Dirent64(ctypes.Structure):
+        _fields_ = [
+            ('d_ino', ctypes.c_uint64),
+            ('d_off', ctypes.c_int64),
+            ('d_reclen', ctypes.c_ushort),
+            ('d_type', ctypes.c_ubyte),
+            ('d_name', ctypes.c_char * 256),
+        ]
+
+    libc.opendir.argtypes = (ctypes.c_char_p,)
+    libc.opendir.restype = ctypes.c_void_p
+    libc.readdir64.argtypes = (ctypes.c_void_p,)
+    libc.readdir64.restype = ctypes.POINTER(Dirent64)
+    libc.closedir.argtypes = (ctypes.c_void_p,)
+
+    def readdir(path):
+        handle = libc.opendir(encode_text(path))
+        if not handle:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        try:
+            while True:
+                # the end of the directory and an error both return NULL; only an error sets errno
+                ctypes.set_errno(0)
+                entry = libc.readdir64(handle)
+                if not entry:
+                    error = ctypes.get_errno()
+                    if error:
+                        raise OSError(error, os.strerror(error), path)
+                    return
+                name = entry.contents.d_name
+                if name not in (b'.', b'..'):
+                    yield name, entry.contents.d_type
+        finally:
+            libc.closedir(handle)
+
+    return readdir
+
+
+readdir = load_readdir() if scandir is None else None
+
+# how list_directory reads directories, which scan reports record: scandir, readdir (scandir's
+# approach through ctypes), or listdir, which has to stat every entry, directories included
+if scandir is not None:
+    LISTING_METHOD = LISTING_SCANDIR
+elif readdir is not None:
+    LISTING_METHOD = LISTING_READDIR
+else:
+    LISTING_METHOD = LISTING_LISTDIR
+
+
+def list_directory(path):
+    # uses scandir where possible so the file type comes from the directory entry itself and
+    # each file costs at most one stat call.  Returns (name, is directory, size, modification
+    # time) entries and the number of calls made, counting the directory read itself as one.
+    entries = []
+    syscalls = 1
+    if readdir is not None:
+        for (name, d_type) in readdir(path):
+            if not isinstance(path, bytes):
+                name = decode_text(name)
+            if d_type == DT_DIR:
+                entries.append((name, True, 0, None))
+                continue
+            # one stat gives the size, and follows symlinks (and entries of unknown type) to
+            # tell whether they're directories
+            syscalls += 1
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                entries.append((name, False, 0, None))
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                entries.append((name, True, 0, None))
+            else:
+                entries.append((name, False, st.st_size, st.st_mtime))
+    elif scandir is not None:
+        for entry in scandir(path):
+            try:
+                # a file is stat'ed for its size, and a symlink to tell whether it points at a
+                # directory; scandir keeps the result, so either costs one call
+                is_directory = entry.is_dir()
+                if entry.is_symlink() or not is_directory:
+                    syscalls += 1
+                size, mtime = 0, None
+                if not is_directory:
+                    st = entry.stat()
+                    size, mtime = st.st_size, st.st_mtime
+            except OSError:
+                is_directory, size, mtime = False, 0, None
+            entries.append((entry.name, is_directory, size, mtime))
+    else:
+        for name in os.listdir(path):
+            syscalls += 1
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                entries.append((name, False, 0, None))
+                continue
+            is_directory = stat.S_ISDIR(st.st_mode)
+            if is_directory:
+                entries.append((name, True, 0, None))
+            else:
+                entries.append((name, False, st.st_size, st.st_mtime))
+    return entries, syscalls
+
+
+class ListingPool:
+    """
+    Lists directories on a bounded set of worker threads.  Workers only do I/O; results are
+    handed back through a queue so the caller can assemble them on its own thread.
+    """
+
+    # whether the warning about listing directories without scandir has been printed
+    warned = False
+
+    def __init__(self, workers):
+        if LISTING_METHOD == LISTING_LISTDIR and not ListingPool.warned:
+            ListingPool.warned = True
+            print('Warning: the scandir module is not installed, so every entry is stat\'ed while '
+                  'scanning; "pip install scandir" makes scans faster', file=sys.stderr)
+        self.__results = Queue()
+        self.__tasks = None
+        self.__threads = []
+        self.directories = 0
+        self.entries = 0
+        self.syscalls = 0
+        if workers > 1:
+            self.__tasks = Queue()
+            for i in range(workers):
+                thread = threading.Thread(target=self.__work)
+                thread.daemon = True
+                thread.start()
+                self.__threads.append(thread)
+
+    def submit(self, key, path, stamp=None, files=None):
+        # files are names to stat again if the directory still matches its stamp
+        if self.__tasks is None:
+            self.__results.put(ListingPool.__list(key, path, stamp, files))
+        else:
+            self.__tasks.put((key, path, stamp, files))
+
+    def get(self, wait=True):
+        # without wait, returns None when no listing is ready
+        try:
+            if wait:
+                result = self.__results.get(True, QUEUE_WAIT_FOREVER)
+            else:
+                result = self.__results.get_nowait()
+        except Empty:
+            return None
+        key, path, stamp, entries, files, syscalls = result
+        if isinstance(entries, Exception):
+            raise entries
+        self.directories += 1
+        self.entries += len(entries) if entries else 0
+        self.syscalls += syscalls
+        return key, path, stamp, entries, files
+
+    @property
+    def stats(self):
+        return dict(directories=self.directories, entries=self.entries, syscalls=self.syscalls,
+                    listing=LISTING_METHOD)
+
+    def close(self):
+        for thread in self.__threads:
+            self.__tasks.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+    def __work(self):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                return
+            self.__results.put(ListingPool.__list(*task))
+
+    @staticmethod
+    def __list(key, path, stamp, files):
+        # entries is None when the directory still matches the stamp it was last listed with, and
+        # files are then the (name, size, modification time) of the files asked about
+        syscalls = 1
+        stats = []
+        try:
+            current = directory_stamp(path)
+            entries = None
+            if current != stamp:
+                entries, listing_syscalls = list_directory(path)
+                syscalls += listing_syscalls
+            else:
+                for name in files or ():
+                    syscalls += 1
+                    try:
+                        st = os.stat(os.path.join(path, name))
+                    except OSError:
+                        continue
+                    stats.append((name, st.st_size, st.st_mtime))
+        except OSError:
+            current, entries = None, []
+        except Exception as e:
+            current, entries = None, e
+        return key, path, current, entries, stats, syscalls
+
+
+class DirTree(object):
     filter_changed = None
+    journal = None
+
+    # trees can have tens of millions of nodes, so nodes carry no __dict__, files share an empty
+    # child tuple and names are interned.  Each scan, refresh and tree file interns into a table
+    # of its own (intern() takes only byte strings on python 2), which goes away with it, so names
+    # of entries that are gone aren't kept alive.
+    __slots__ = (
+        '__name',
+        '__is_directory',
+        '__parent',
+        '__children',
+        '__size',
+        '__filtered_size',
+        '__filter',
+        '__included',
+        '__excluded',
+        '__stamp',
+        '__lazy',
+        'treeview_iid',
+        '__notes',
+    )
 
     def __init__(self, name, is_directory, parent=None):
         self.__name = name
         self.__is_directory = is_directory
         self.__parent = parent
-        self.__children = []
+        self.__children = [] if is_directory else ()
         self.__size = 0
         self.__filtered_size = 0
         self.__filter = FILTER_INCLUDE_ALL
+        self.__included = 0
+        self.__excluded = 0
+        self.__stamp = None
+        self.__lazy = None
         self.treeview_iid = None
-        self.notes = None
+        self.__notes = None
 
     @property
     def name(self):
@@ -116,12 +807,22 @@ class DirTree:
 
     @property
     def children(self):
-        return tuple(self.__children)
+        return tuple(self.__kids())
+
+    @property
+    def has_children(self):
+        # doesn't read lazily loaded children
+        return self.__lazy is not None or len(self.__children) > 0
 
     @property
     def size(self):
         return self.__size
 
+    @property
+    def size_known(self):
+        # a directory that was excluded before it was ever listed looks empty
+        return self.__stamp is not UNLISTED_STAMP
+
     @property
     def filter(self):
         return self.__filter
@@ -130,84 +831,362 @@ class DirTree:
     def filtered_size(self):
         return self.__filtered_size
 
+    @property
+    def notes(self):
+        return self.__notes
+
+    @notes.setter
+    def notes(self, notes):
+        notes = notes or None
+        if notes != self.__notes:
+            self.__notes = notes
+            if DirTree.journal:
+                DirTree.journal.record(self, notes=notes)
+
+    @property
+    def mtime(self):
+        # files keep just their modification time where directories keep a full stamp
+        if self.__stamp is None or not self.__is_directory:
+            return self.__stamp
+        return self.__stamp[0]
+
     @property
     def path(self):
-        if self.parent:
-            return os.path.join(self.parent.path, self.name)
-        return self.name
-
-    def __set_filter(self, f, update_parent, update_children):
-        if update_children:
-            for child in self.children:
-                child.__set_filter(f, False, True)
-
-        self.__filter = f
-        if f is FILTER_EXCLUDE_ALL:
-            self.__filtered_size = 0
-        elif f is FILTER_INCLUDE_ALL:
-            self.__filtered_size = self.size
-        else:
-            self.__filtered_size = sum(child.filtered_size for child in self.children)
+        names = []
+        tree = self
+        while tree is not None:
+            names.append(tree.name)
+            tree = tree.parent
+        return ''.join(reversed(names))
 
-        if DirTree.filter_changed:
-            DirTree.filter_changed(self)
-
-        if update_parent:
-            parent = self.parent
-            while parent:
-                if all(child.filter == FILTER_EXCLUDE_ALL for child in parent.children):
-                    parent.__set_filter(FILTER_EXCLUDE_ALL, False, False)
-                elif all(child.filter == FILTER_INCLUDE_ALL for child in parent.children):
-                    parent.__set_filter(FILTER_INCLUDE_ALL, False, False)
-                else:
-                    parent.__set_filter(FILTER_PARTIAL, False, False)
-                parent = parent.parent
+    def memory_usage(self):
+        # returns (bytes used by this tree, including the intern tables still in use, bytes the
+        # same tree would take as the original nodes: a __dict__ of DIRTREE_LEGACY_ATTRIBUTES and a
+        # child list on every node, and no shared names)
+        class DictNode:
+            pass
+
+        dict_node = DictNode()
+        for attribute in DIRTREE_LEGACY_ATTRIBUTES:
+            setattr(dict_node, attribute, None)
+        dict_node_size = sys.getsizeof(dict_node) + sys.getsizeof(dict_node.__dict__)
+        empty_list_size = sys.getsizeof([])
+
+        used = 0
+        legacy = 0
+        seen_names = set()
+        tree_files = dict()
+        stack = [self]
+        while stack:
+            tree = stack.pop()
+            if tree.__lazy is not None:
+                tree_files[id(tree.__children)] = tree.__children
+                used += sys.getsizeof(tree.__lazy)
+            name_size = sys.getsizeof(tree.name)
+            if id(tree.name) not in seen_names:
+                seen_names.add(id(tree.name))
+                used += name_size
+            used += sys.getsizeof(tree)
+            legacy += dict_node_size + name_size
+            if tree.__lazy is not None:
+                legacy += empty_list_size
+            elif tree.is_directory:
+                used += sys.getsizeof(tree.__children)
+                legacy += sys.getsizeof(tree.__children)
+                stack.extend(tree.__children)
+            else:
+                legacy += empty_list_size
+        for tree_file in tree_files.values():
+            used += sys.getsizeof(tree_file.names)
+        return used, legacy
+
+    def __set_filter(self, f):
+        # a directory's filter follows from how many of its children are fully included or
+        # excluded, and its filtered size is the sum of theirs, so a change only has to walk up
+        # through ancestors for as long as it changes something
+        if self.__filter == f:
+            return
+        old_filter = self.__filter
+        old_filtered_size = self.__filtered_size
+        self.__set_subtree_filter(f)
+        delta = self.__filtered_size - old_filtered_size
+        new_filter = f
+        parent = self.parent
+        while parent and (old_filter != new_filter or delta):
+            parent.__count(old_filter, -1)
+            parent.__count(new_filter, 1)
+            parent.__filtered_size += delta
+            old_filter = parent.__filter
+            parent.__filter = parent.__derived_filter()
+            new_filter = parent.__filter
+            if DirTree.filter_changed:
+                DirTree.filter_changed(parent)
+            parent = parent.parent
+
+    def __set_subtree_filter(self, f):
+        # subtrees that are already entirely included or excluded are left alone
+        pending = [self]
+        while pending:
+            tree = pending.pop()
+            children = tree.__kids()
+            tree.__filter = f
+            tree.__filtered_size = 0 if f == FILTER_EXCLUDE_ALL else tree.size
+            tree.__included = len(children) if f == FILTER_INCLUDE_ALL else 0
+            tree.__excluded = len(children) if f == FILTER_EXCLUDE_ALL else 0
+            if f != FILTER_EXCLUDE_ALL and tree.__stamp is UNLISTED_STAMP:
+                tree.__reincluded()
+            if DirTree.filter_changed:
+                DirTree.filter_changed(tree)
+            pending.extend(child for child in children if child.__filter != f)
+
+    def __count(self, f, n):
+        if f == FILTER_INCLUDE_ALL:
+            self.__included += n
+        elif f == FILTER_EXCLUDE_ALL:
+            self.__excluded += n
+
+    def __recount(self):
+        children = self.__children
+        self.__included = sum(1 for child in children if child.__filter == FILTER_INCLUDE_ALL)
+        self.__excluded = sum(1 for child in children if child.__filter == FILTER_EXCLUDE_ALL)
+
+    def __derived_filter(self):
+        if self.__excluded == len(self.__children):
+            return FILTER_EXCLUDE_ALL
+        if self.__included == len(self.__children):
+            return FILTER_INCLUDE_ALL
+        return FILTER_PARTIAL
 
     def exclude_all(self):
-        self.__set_filter(FILTER_EXCLUDE_ALL, update_parent=True, update_children=True)
+        if DirTree.journal and self.__filter != FILTER_EXCLUDE_ALL:
+            DirTree.journal.record(self, filter=FILTER_EXCLUDE_ALL)
+        self.__set_filter(FILTER_EXCLUDE_ALL)
 
     def include_all(self):
-        self.__set_filter(FILTER_INCLUDE_ALL, update_parent=True, update_children=True)
+        if DirTree.journal and self.__filter != FILTER_INCLUDE_ALL:
+            DirTree.journal.record(self, filter=FILTER_INCLUDE_ALL)
+        self.__set_filter(FILTER_INCLUDE_ALL)
+
+    def apply_rules(self, rules):
+        # sets filters from FilterRules in one pass down the tree and re-adds filtered sizes in
+        # one pass back up, rather than propagating every change separately.  Entries no rule
+        # reaches keep their filter.  Directories that are excluded already are left alone, and
+        # so unread, if they stay excluded or no rule could include anything in them.  Returns the
+        # number of entries a rule matched.
+        matched = 0
+        directories = []
+        pending = [(self, '', None)]
+        while pending:
+            (tree, relpath, inherited) = pending.pop()
+            f = inherited
+            if tree is not self:
+                ruled = rules.match(relpath, tree.__is_directory, tree.__size, tree.mtime)
+                if ruled:
+                    matched += 1
+                    f = ruled
+            if not tree.__is_directory:
+                if f:
+                    tree.__filter = f
+                    tree.__filtered_size = 0 if f == FILTER_EXCLUDE_ALL else tree.__size
+            elif tree.__filter == FILTER_EXCLUDE_ALL and (f == FILTER_EXCLUDE_ALL or (
+                    f is None and not rules.includes)):
+                pass
+            elif f == FILTER_EXCLUDE_ALL:
+                # excluded directories aren't looked into
+                tree.__set_subtree_filter(f)
+            else:
+                if f:
+                    tree.__filter = f
+                directories.append(tree)
+                for child in tree.__kids():
+                    pending.append((child, relpath + child.__name, f))
+        # children come after their parent in the list, so reversed it finishes them first
+        for tree in reversed(directories):
+            children = tree.__children
+            tree.__recount()
+            if children:
+                tree.__filtered_size = sum(child.__filtered_size for child in children)
+                tree.__filter = tree.__derived_filter()
+            else:
+                tree.__filtered_size = 0 if tree.__filter == FILTER_EXCLUDE_ALL else tree.__size
+                if tree.__stamp is UNLISTED_STAMP:
+                    tree.__reincluded()
+        return matched
 
     def save(self, path):
-        with open(path, 'w') as fout:
-            fields = (
-                'id',
-                'name',
-                'is_directory',
-                'parent',
-                'size',
-                'filter',
-                'filtered_size',
-                'notes',
-            )
-            print(json.dumps(fields), file=fout)
-            self.__save(fields, fout)
+        # written next to the old file and renamed over it, since a loaded tree may still be
+        # reading from the old file
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as fout:
+            fout.write(TREE_FILE_HEADER.pack(TREE_FILE_MAGIC, TREE_FILE_VERSION, 0, 0, 0))
+            strings = tempfile.TemporaryFile()
+            try:
+                node_count = self.__save(fout, strings)
+                strings_offset = fout.tell()
+                strings.seek(0)
+                shutil.copyfileobj(strings, fout)
+            finally:
+                strings.close()
+            fout.seek(0)
+            fout.write(TREE_FILE_HEADER.pack(
+                TREE_FILE_MAGIC, TREE_FILE_VERSION, node_count, TREE_FILE_HEADER.size, strings_offset))
+        os.rename(temp_path, path)
 
-    def __save(self, fields, fout):
-        data = dict(
-            id=id(self),
-            name=self.name,
-            is_directory=self.is_directory,
-            parent=id(self.parent) if self.parent else None,
-            size=self.size,
-            filter=self.filter,
-            filtered_size=self.filtered_size,
-            notes=self.notes if self.notes else ''
-        )
-        values = [data[k] for k in fields]
-        print(json.dumps(values), file=fout)
-        for child in self.children:
-            child.__save(fields, fout)
+    def __save(self, fout, strings):
+        node_count = 0
+        next_index = 1
+        strings_size = 0
+        pending = deque([self])
+        while pending:
+            tree = pending.popleft()
+            children = tree.__kids()
+            name = encode_text(tree.name)
+            notes = encode_text(tree.notes if tree.notes else '')
+            flags = TREE_FILE_IS_DIRECTORY if tree.is_directory else 0
+            mtime, ctime, inode = 0, 0, 0
+            if tree.__stamp is UNLISTED_STAMP:
+                flags |= TREE_FILE_UNLISTED
+            elif tree.__stamp is not None:
+                flags |= TREE_FILE_HAS_STAMP
+                if tree.is_directory:
+                    mtime, ctime, inode = tree.__stamp
+                else:
+                    mtime = tree.__stamp
+            fout.write(TREE_FILE_NODE.pack(
+                next_index,
+                len(children),
+                tree.size,
+                tree.filtered_size,
+                strings_size,
+                len(name),
+                strings_size + len(name),
+                len(notes),
+                mtime,
+                ctime,
+                inode,
+                flags,
+                tree.filter.encode('ascii'),
+            ))
+            strings.write(name)
+            strings.write(notes)
+            strings_size += len(name) + len(notes)
+            next_index += len(children)
+            node_count += 1
+            pending.extend(children)
+        return node_count
 
     def sort_by_name(self):
-        self.__children.sort(key=lambda x: x.name.lower())
-        for child in self.__children:
-            child.sort_by_name()
+        # each directory is sorted before the walk reads its children
+        for (tree, relpath) in walk_tree(self):
+            if tree.__is_directory:
+                tree.__kids().sort(key=lambda x: x.name.lower())
 
     @staticmethod
     def load(path):
+        # only the root is read up front; the rest of the tree is read from the mapped file as
+        # children are first accessed
+        with open(path, 'rb') as fin:
+            magic = fin.read(len(TREE_FILE_MAGIC))
+        if magic != TREE_FILE_MAGIC:
+            return DirTree.__load_json(path)
+        return DirTree.__from_record(TreeFile(path), 0, None)
+
+    @staticmethod
+    def __from_record(tree_file, index, parent):
+        (
+            first_child,
+            child_count,
+            size,
+            filtered_size,
+            name_offset,
+            name_length,
+            notes_offset,
+            notes_length,
+            mtime,
+            ctime,
+            inode,
+            flags,
+            f,
+        ) = tree_file.record(index)
+        name = tree_file.name(name_offset, name_length)
+        tree = (DirTree if parent is not None else RootDirTree)(
+            name=tree_file.names.setdefault(name, name),
+            is_directory=bool(flags & TREE_FILE_IS_DIRECTORY),
+            parent=parent,
+        )
+        tree.__size = size
+        tree.__filter = FILTERS[f]
+        tree.__filtered_size = filtered_size
+        if notes_length:
+            tree.__notes = tree_file.text(notes_offset, notes_length)
+        if flags & TREE_FILE_HAS_STAMP:
+            tree.__stamp = (mtime, ctime, inode) if tree.__is_directory else mtime
+        elif flags & TREE_FILE_UNLISTED:
+            tree.__stamp = UNLISTED_STAMP
+        if child_count:
+            # until they're read, the children are found from this node's record
+            tree.__children = tree_file
+            tree.__lazy = index
+        return tree
+
+    def find(self, relpath):
+        # walks down from this node, loading only the directories on the way
+        tree = self
+        for part in decode_name(encode_text(relpath)).split('/'):
+            if not part:
+                continue
+            for child in tree.children:
+                if child.name in (part, part + '/'):
+                    tree = child
+                    break
+            else:
+                return None
+        return tree
+
+    def iter_names(self):
+        # breadth-first (name, parent position) pairs for the whole tree, where a position counts
+        # the pairs yielded before it.  Subtrees still in the tree file are read from its records
+        # directly rather than loaded as nodes.
+        pending = deque([(self, None, None, -1)])
+        position = 0
+        while pending:
+            (node, tree_file, index, parent) = pending.popleft()
+            if node is not None:
+                name = node.__name
+                if node.__lazy is not None:
+                    tree_file = node.__children
+                    (first_child, child_count) = tree_file.record(node.__lazy)[0:2]
+                    for i in range(first_child, first_child + child_count):
+                        pending.append((None, tree_file, i, position))
+                else:
+                    for child in node.__children:
+                        pending.append((child, None, None, position))
+            else:
+                record = tree_file.record(index)
+                (first_child, child_count) = record[0:2]
+                name = tree_file.name(record[4], record[5])
+                for i in range(first_child, first_child + child_count):
+                    pending.append((None, tree_file, i, position))
+            yield name, parent
+            position += 1
+
+    def __kids(self):
+        if self.__lazy is not None:
+            tree_file = self.__children
+            (first_child, child_count) = tree_file.record(self.__lazy)[0:2]
+            self.__lazy = None
+            self.__children = [
+                DirTree.__from_record(tree_file, index, self)
+                for index in range(first_child, first_child + child_count)
+            ]
+            self.__recount()
+        return self.__children
+
+    @staticmethod
+    def __load_json(path):
+        # jobs saved before the binary tree file format
         root = None
+        names = dict()
         with open(path, 'r') as fin:
             tree_by_id=dict()
             fields = json.loads(fin.readline())
@@ -217,96 +1196,1415 @@ class DirTree:
                 for i in range(len(values)):
                     data[fields[i]] = values[i]
                 parent = tree_by_id[data['parent']] if data['parent'] else None
+                name = decode_name(encode_text(data['name']))
                 tree = DirTree(
-                    name=data['name'],
+                    name=names.setdefault(name, name),
                     is_directory=data['is_directory'],
                     parent=parent,
                 )
                 tree.__size = data['size']
-                tree.__filter = data['filter'].strip()[0]
+                tree.__filter = FILTERS[data['filter'].strip()[0].encode('ascii')]
                 tree.__filtered_size = data['filtered_size']
-                tree.notes = data.get('notes', '').strip()
+                tree.__notes = data.get('notes', '').strip() or None
+                if data.get('mtime') is not None:
+                    tree.__stamp = (data['mtime'], data['ctime'], data['inode'])
                 if parent:
                     parent.__children.append(tree)
+                    parent.__count(tree.filter, 1)
                 else:
                     root = tree
                 tree_by_id[data['id']] = tree
         return root
 
     @staticmethod
-    def ls(path):
-        tree = DirTree.__ls(path, True)
-        tree.__name = path + '/'
+    def ls(path, workers=DEFAULT_SCAN_WORKERS, stats=None, analytics=None, rules=None):
+        # stats, when given, is a dict updated with the directories, entries and syscalls of the
+        # scan; analytics, a SpaceAnalytics that is fed every directory once its totals are final.
+        # FilterRules set the filter of entries as they are listed, and directories they exclude
+        # aren't listed.
+        tree = RootDirTree(path + '/', True)
+        pool = ListingPool(workers)
+        try:
+            DirTree.__ls(tree, path, pool, analytics, rules)
+        finally:
+            pool.close()
+            if stats is not None:
+                stats.update(pool.stats)
         return tree
 
+    def refresh(self, workers=DEFAULT_SCAN_WORKERS, stats=None, analytics=None):
+        # re-lists only directories whose stamp changed since they were last listed.  Files in the
+        # others are stat'ed again, since rewriting a file in place doesn't touch its directory.
+        pool = ListingPool(workers)
+        try:
+            return DirTree.__ls(self, self.path[:-1], pool, analytics)
+        finally:
+            pool.close()
+            if stats is not None:
+                stats.update(pool.stats)
+
     @staticmethod
-    def __ls(path, is_directory, parent=None):
-        tree = DirTree(os.path.basename(path) + ('/' if is_directory else ''), is_directory, parent)
-        if is_directory:
-            try:
-                for name in os.listdir(path):
-                    abspath = os.path.join(path, name)
-                    child = DirTree.__ls(abspath, os.path.isdir(abspath), tree)
-                    tree.__children.append(child)
-                    tree.__size += child.size
-                tree.__children.sort(reverse=True, key=lambda x: x.size)
-            except OSError:
-                pass
-        else:
+    def __ls(root, path, pool, analytics=None, rules=None):
+        state = dict(listed=0, unchanged=0, wait=True)
+        for (event, tree) in DirTree.__assemble(root, path, pool, analytics, state, set(), rules):
+            pass
+        return state['listed'], state['unchanged']
+
+    @staticmethod
+    def scan(path, workers=DEFAULT_SCAN_WORKERS, analytics=None, rules=None):
+        # starts listing in the background; the caller assembles the tree with TreeScan.poll()
+        tree = RootDirTree(path + '/', True)
+        pool = ListingPool(workers)
+        state = dict(listed=0, unchanged=0, wait=False)
+        unfinished = set()
+        steps = DirTree.__assemble(tree, path, pool, analytics, state, unfinished, rules, streaming=True)
+        return TreeScan(tree, pool, steps, state, unfinished)
+
+    @staticmethod
+    def __assemble(root, path, pool, analytics, state, unfinished, rules=None, streaming=False):
+        # directories are listed in parallel; a directory's size is final (and its children can be
+        # sorted) once every subdirectory below it has been listed.  Yields (SCAN_LISTED, tree) as
+        # directories are listed and (SCAN_FINISHED, tree) as their totals become final, or
+        # (None, None) when state['wait'] is off and nothing is ready.  unfinished holds the
+        # directories whose totals aren't final yet.
+        #
+        # While streaming, listed file sizes are added up the tree right away so partial totals can
+        # be shown, and excluded directories aren't listed at all.  Those re-included by the time
+        # everything else is listed are listed then.  Directories excluded by rules when they were
+        # first listed aren't listed either.  Directories left unlisted are marked with
+        # UNLISTED_STAMP, for list_unlisted() to list if they're included again.
+        root_path = path
+        names = dict()
+        DirTree.__submit(pool, root, path)
+        unfinished.add(root)
+        outstanding = 1
+        remaining = dict()
+        skipped = []
+        while outstanding:
+            result = pool.get(state['wait'])
+            if result is None:
+                yield None, None
+                continue
+            tree, path, stamp, entries, files = result
+            outstanding -= 1
+            if entries is None:
+                state['unchanged'] += 1
+                tree.__update_files(files)
+            else:
+                state['listed'] += 1
+                tree.__stamp = stamp
+                relpath = path[len(root_path) + 1:] + '/' if path != root_path else ''
+                tree.__merge_listing(entries, rules, relpath, names)
+                if streaming:
+                    tree.__add_listed_sizes()
+            subdirectories = 0
+            for child in tree.__kids():
+                if child.is_directory:
+                    child_path = os.path.join(path, child.name[:-1])
+                    if child.__filter == FILTER_EXCLUDE_ALL and (
+                            streaming or (rules and child.__stamp in (None, UNLISTED_STAMP))):
+                        skipped.append((child, child_path))
+                        continue
+                    DirTree.__submit(pool, child, child_path)
+                    unfinished.add(child)
+                    outstanding += 1
+                    subdirectories += 1
+            remaining[tree] = subdirectories
+            yield SCAN_LISTED, tree
+            while tree and remaining.get(tree) == 0:
+                del remaining[tree]
+                tree.__update_totals()
+                unfinished.discard(tree)
+                if analytics:
+                    analytics.add_directory(tree)
+                yield SCAN_FINISHED, tree
+                tree = tree.parent
+                if tree in remaining:
+                    remaining[tree] -= 1
+                else:
+                    # a skipped directory listed late, under directories that are final already
+                    while tree:
+                        tree.__update_totals()
+                        yield SCAN_FINISHED, tree
+                        tree = tree.parent
+            if not outstanding:
+                excluded = []
+                for (child, child_path) in skipped:
+                    if child.__filter == FILTER_EXCLUDE_ALL:
+                        excluded.append((child, child_path))
+                    else:
+                        DirTree.__submit(pool, child, child_path)
+                        unfinished.add(child)
+                        outstanding += 1
+                skipped = excluded
+        for (child, child_path) in skipped:
+            if child.__stamp is None:
+                child.__stamp = UNLISTED_STAMP
+
+    @staticmethod
+    def __submit(pool, tree, path):
+        files = None
+        if tree.__stamp not in (None, UNLISTED_STAMP):
+            files = [child.__name for child in tree.__kids() if not child.__is_directory]
+        pool.submit(tree, path, tree.__stamp, files)
+
+    def __update_files(self, files):
+        # the sizes and modification times of files in a directory that hasn't changed
+        stats = dict((name, (size, mtime)) for (name, size, mtime) in files)
+        for child in self.__kids():
+            if child.__name in stats:
+                (child.__size, child.__stamp) = stats[child.__name]
+                child.__filtered_size = 0 if child.__filter == FILTER_EXCLUDE_ALL else child.__size
+
+    def list_unlisted(self, workers=DEFAULT_SCAN_WORKERS):
+        # lists the directories in this tree that were excluded when their scan reached them, and
+        # so look empty, and have been included again since, along with everything under them.
+        # Returns the directories listed.
+        unlisted = self.__take_unlisted()
+        listed = []
+        if unlisted:
+            pool = ListingPool(workers)
             try:
-                tree.__size = os.path.getsize(path)
-            except OSError:
-                pass
-        tree.__filtered_size = tree.size
+                state = dict(listed=0, unchanged=0, wait=True)
+                for (event, tree) in DirTree.__assemble_unlisted(unlisted, pool, state, set()):
+                    if event == SCAN_LISTED:
+                        listed.append(tree)
+            finally:
+                pool.close()
+        return listed
+
+    def scan_unlisted(self, workers=DEFAULT_SCAN_WORKERS):
+        # list_unlisted() in the background, for the file chooser: returns a TreeScan to poll, or
+        # None when there's nothing to list
+        unlisted = self.__take_unlisted()
+        if not unlisted:
+            return None
+        pool = ListingPool(workers)
+        state = dict(listed=0, unchanged=0, wait=False)
+        unfinished = set()
+        steps = DirTree.__assemble_unlisted(unlisted, pool, state, unfinished)
+        return TreeScan(self, pool, steps, state, unfinished)
+
+    def __root(self):
+        tree = self
+        while tree.__parent is not None:
+            tree = tree.__parent
         return tree
 
+    def __reincluded(self):
+        # an unlisted directory that has been included again is remembered by its root, for
+        # list_unlisted() to list, so it doesn't have to look through the whole tree for it
+        self.__root().reincluded.add(self)
 
-class FileChooser(tk.Frame):
-    __HAS_NOTES_STRING = '*'
+    def __take_unlisted(self):
+        # the directories the root remembers that are in this tree, which it forgets, less those
+        # excluded or listed since
+        unlisted = []
+        reincluded = self.__root().reincluded
+        for tree in list(reincluded):
+            node = tree
+            while node is not None and node is not self:
+                node = node.__parent
+            if node is None:
+                continue
+            reincluded.discard(tree)
+            if tree.__stamp is UNLISTED_STAMP and tree.__filter != FILTER_EXCLUDE_ALL:
+                unlisted.append(tree)
+        return unlisted
 
-    def __init__(self, parent, tree):
-        tk.Frame.__init__(self, parent, background="white")
-        self.__parent = parent
-        self.__tree_by_iid = dict()
-        self.__expanded_by_iid = dict()
-        self.__focus_tree = None
+    @staticmethod
+    def __assemble_unlisted(unlisted, pool, state, unfinished):
+        for tree in unlisted:
+            for step in DirTree.__assemble(tree, tree.path[:-1], pool, None, state, unfinished):
+                yield step
 
-        self.__parent.title("Choose Files")
-        self.__center_window()
+    def __add_listed_sizes(self):
+        # provisional totals for a streaming scan; __update_totals replaces them once the subtree
+        # is done
+        size = 0
+        filtered_size = 0
+        for child in self.__children:
+            if not child.__is_directory:
+                size += child.__size
+                filtered_size += child.__filtered_size
+        tree = self
+        while tree:
+            tree.__size += size
+            tree.__filtered_size += filtered_size
+            tree = tree.__parent
 
-        self.rowconfigure(0, weight=1)
-        self.columnconfigure(0, weight=1)
-        self.pack(fill=tk.BOTH, expand=True)
+    def __merge_listing(self, entries, rules=None, relpath='', names=None):
+        # existing children keep their filter, notes and subtree; new ones follow the directory,
+        # or the first rule that matches them.  New names are interned in names.
+        existing = dict((child.name, child) for child in self.__kids())
+        children = []
+        for name, is_directory, size, mtime in entries:
+            name += '/' if is_directory else ''
+            child = existing.get(name)
+            if child is None:
+                child = DirTree(names.setdefault(name, name) if names is not None else name, is_directory, self)
+                if self.filter == FILTER_EXCLUDE_ALL:
+                    child.__filter = FILTER_EXCLUDE_ALL
+                elif rules:
+                    child.__filter = rules.match(relpath + name, is_directory, size, mtime) or child.__filter
+            if not is_directory:
+                child.__size = size
+                child.__filtered_size = 0 if child.filter == FILTER_EXCLUDE_ALL else size
+                child.__stamp = mtime
+            children.append(child)
+        self.__children = children
 
-        self.__treeview = ttk.Treeview(self, columns=('size', 'filtered_size', 'notes'))
-        ysb = ttk.Scrollbar(self, orient='vertical', command=self.__treeview.yview)
-        xsb = ttk.Scrollbar(self, orient='horizontal', command=self.__treeview.xview)
-        self.__treeview.configure(yscroll=ysb.set, xscroll=xsb.set)
-        self.__treeview.configure(yscroll=ysb.set)
-        self.__treeview.heading('#0', text='Path', anchor='w')
-        self.__treeview.heading('size', text='Size', anchor='e')
-        self.__treeview.heading('filtered_size', text='Filtered Size', anchor='e')
-        self.__treeview.heading('notes', text='Notes')
-        self.__treeview.column('#0', stretch=True)
-        self.__treeview.column('size', anchor='e', width=100, stretch=False)
-        self.__treeview.column('filtered_size', anchor='e', width=100, stretch=False)
-        self.__treeview.column('notes', width=40, anchor=tk.CENTER, stretch=False)
-        self.__treeview.tag_configure('exclude', foreground='gray')
+    def relist(self):
+        # re-reads this directory alone, for a watcher that saw it change, and returns the children
+        # added and removed.  New subdirectories are left empty for the caller to relist, and totals
+        # are left to refresh_totals().
+        path = self.path[:-1]
+        try:
+            stamp = directory_stamp(path)
+            entries, syscalls = list_directory(path)
+        except OSError:
+            stamp, entries = None, []
+        before = self.__kids()
+        self.__stamp = stamp
+        self.__merge_listing(entries)
+        old = set(before)
+        new = set(self.__children)
+        added = [child for child in self.__children if child not in old]
+        removed = [child for child in before if child not in new]
+        return added, removed
 
-        self.__treeview.bind('<Button-2>', self.__treeview_rightclick)
-        self.__treeview.bind('<Button-3>', self.__treeview_rightclick)
-        self.__treeview.bind('<KeyPress>', self.__treeview_keypress)
-        self.__treeview.bind('<<TreeviewSelect>>', self.__treeview_select)
-        self.__treeview.bind('<<TreeviewOpen>>', self.__treeview_open)
-        self.__treeview.bind('<<TreeviewClose>>', self.__treeview_close)
+    def restat(self, name):
+        # re-reads the size and modification time of the file with the given (byte string) name,
+        # leaving totals to refresh_totals().  Returns whether anything changed.
+        for child in self.__kids():
+            if not child.__is_directory and encode_text(child.__name) == name:
+                try:
+                    st = os.stat(os.path.join(self.path, child.__name))
+                except OSError:
+                    # removed, which its directory hears about too
+                    return False
+                if (st.st_size, st.st_mtime) == (child.__size, child.__stamp):
+                    return False
+                child.__size = st.st_size
+                child.__filtered_size = 0 if child.__filter == FILTER_EXCLUDE_ALL else st.st_size
+                child.__stamp = st.st_mtime
+                return True
+        return False
 
-        self.__treeview.grid(row=0, column=0, sticky='nsew')
-        ysb.grid(row=0, column=1, sticky='ns')
-        xsb.grid(row=1, column=0, sticky='ew')
+    @staticmethod
+    def refresh_totals(trees):
+        # brings the totals of the given directories and everything above them up to date, each
+        # directory once and deepest first
+        depths = dict()
+        for tree in trees:
+            chain = []
+            while tree is not None and tree not in depths:
+                chain.append(tree)
+                tree = tree.__parent
+            depth = depths[tree] + 1 if tree is not None else 0
+            for node in reversed(chain):
+                depths[node] = depth
+                depth += 1
+        for tree in sorted(depths, key=depths.get, reverse=True):
+            tree.__update_totals()
 
-        details_frame = tk.Frame(self)
+    def __update_totals(self):
+        children = self.__kids()
+        self.__size = sum(child.size for child in children)
+        children.sort(reverse=True, key=lambda x: x.size)
+        self.__recount()
+        if not children:
+            self.__filtered_size = 0 if self.filter == FILTER_EXCLUDE_ALL else self.size
+        else:
+            self.__filtered_size = sum(child.filtered_size for child in children)
+            self.__filter = self.__derived_filter()
+
+
+class RootDirTree(DirTree):
+    """
+    The root of a DirTree, which also remembers the unlisted directories in the tree that have
+    been included again.
+    """
+
+    __slots__ = ('reincluded',)
+
+    def __init__(self, name, is_directory, parent=None):
+        DirTree.__init__(self, name, is_directory, parent)
+        self.reincluded = set()
+
+
+class TreeScan(object):
+    """
+    A scan running behind the file chooser.  Directories are listed on the pool's threads, and
+    poll() assembles whatever listings are ready on the caller's thread, a slice at a time, so
+    the tree can be browsed and edited while it fills in.
+    """
+
+    def __init__(self, tree, pool, steps, state, unfinished):
+        self.tree = tree
+        self.done = False
+        self.error = None
+        self.on_finished = None
+        self.__pool = pool
+        self.__steps = steps
+        self.__state = state
+        self.__unfinished = unfinished
+
+    @property
+    def listed(self):
+        return self.__state['listed']
+
+    @property
+    def stats(self):
+        return self.__pool.stats
+
+    def is_provisional(self, tree):
+        # directories whose totals are still growing
+        return tree in self.__unfinished
+
+    def poll(self, limit=SCAN_POLL_SECONDS):
+        # returns the directories listed and the directories finished since the last poll.  An
+        # error ends the scan, and is kept in error.
+        listed = []
+        finished = []
+        deadline = time.time() + limit
+        try:
+            for (event, tree) in self.__steps:
+                if event is None:
+                    break
+                (listed if event == SCAN_LISTED else finished).append(tree)
+                if time.time() >= deadline:
+                    break
+            else:
+                self.__finish()
+        except Exception as e:
+            self.error = e
+            self.__finish()
+        return listed, finished
+
+    def finish(self):
+        # waits for the rest of the scan, and raises the error it ended with, if any
+        self.__state['wait'] = True
+        try:
+            for (event, tree) in self.__steps:
+                pass
+        finally:
+            self.__finish()
+        if self.error is not None:
+            raise self.error
+
+    def __finish(self):
+        if self.done:
+            return
+        self.done = True
+        self.__pool.close()
+        if self.on_finished:
+            self.on_finished(self)
+
+
+class Inotify(object):
+    """
+    The few inotify calls watch mode needs, through ctypes so there's nothing to install.  Linux
+    only; elsewhere the constructor raises OSError.
+    """
+
+    def __init__(self):
+        libc = load_libc()
+        if libc is None or not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available on this system')
+        libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.__libc = libc
+        self.__fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            self.__raise()
+
+    def __raise(self, path=None):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    def add_watch(self, path, mask):
+        wd = self.__libc.inotify_add_watch(self.__fd, encode_text(path), mask)
+        if wd < 0:
+            self.__raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        # fails harmlessly when the directory is already gone
+        self.__libc.inotify_rm_watch(self.__fd, wd)
+
+    def read(self, timeout=None):
+        # returns (watch descriptor, mask, cookie, name) events, or none once timeout passes
+        if not select.select([self.__fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.__fd, INOTIFY_BUFFER_SIZE)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            events.append((wd, mask, cookie, data[offset:offset + length].rstrip(b'\0')))
+            offset += length
+        return events
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+
+class TreeWatcher(object):
+    """
+    Keeps a DirTree in step with the file system by watching every directory in it with inotify.
+    Each poll() re-lists the directories whose entries changed and re-reads the files that were
+    modified, then recomputes totals once for every directory above them.  Renames look like a
+    removal and a creation, so a renamed directory is listed afresh.
+    """
+
+    def __init__(self, tree, workers=DEFAULT_SCAN_WORKERS):
+        self.__tree = tree
+        self.__workers = workers
+        self.__inotify = Inotify()
+        self.__tree_by_wd = dict()
+        self.__wd_by_tree = dict()
+        # directories that couldn't be watched, e.g. for lack of inotify watches
+        self.unwatched = 0
+        self.__watch(tree)
+
+    @property
+    def watched(self):
+        return len(self.__wd_by_tree)
+
+    def __watch(self, tree):
+        for (node, path) in walk_tree(tree, tree.path):
+            if node.is_directory and node not in self.__wd_by_tree:
+                self.__watch_directory(node, path)
+
+    def __watch_directory(self, tree, path):
+        try:
+            wd = self.__inotify.add_watch(path, WATCH_MASK)
+        except OSError:
+            self.unwatched += 1
+            return False
+        # a directory moved within the tree keeps its watch descriptor, so it may be reused here
+        self.__tree_by_wd[wd] = tree
+        self.__wd_by_tree[tree] = wd
+        return True
+
+    def __unwatch(self, tree):
+        for (node, path) in walk_tree(tree):
+            wd = self.__wd_by_tree.pop(node, None)
+            if wd is not None and self.__tree_by_wd.get(wd) is node:
+                del self.__tree_by_wd[wd]
+                self.__inotify.rm_watch(wd)
+
+    def poll(self, timeout=WATCH_POLL_SECONDS):
+        # waits up to timeout for changes and applies them.  Returns the number of directories
+        # whose contents changed.
+        relist = set()
+        restat = set()
+        for (wd, mask, cookie, name) in self.__inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                return self.__resync()
+            tree = self.__tree_by_wd.get(wd)
+            if tree is None or not name:
+                continue
+            if mask & WATCH_RELIST_EVENTS:
+                relist.add(tree)
+            else:
+                restat.add((tree, name))
+        changed = set()
+        # parents first, so directories removed along with their parent aren't listed.  New
+        # directories are watched before they're listed, so nothing created in them is missed.
+        pending = deque((tree, False) for tree in sorted(relist, key=lambda tree: len(tree.path)))
+        while pending:
+            (tree, is_new) = pending.popleft()
+            if not is_new and tree not in self.__wd_by_tree:
+                continue
+            (added, removed) = tree.relist()
+            changed.add(tree)
+            for child in removed:
+                if child.is_directory:
+                    self.__unwatch(child)
+            for child in added:
+                if child.is_directory:
+                    self.__watch_directory(child, child.path)
+                    pending.append((child, True))
+        for (tree, name) in restat:
+            if tree in self.__wd_by_tree and tree.restat(name):
+                changed.add(tree)
+        DirTree.refresh_totals(changed)
+        return len(changed)
+
+    def __resync(self):
+        # the kernel dropped events, so everything is watched again and changed directories are
+        # re-listed.  Files modified in place in the meantime keep their old size.
+        for wd in self.__tree_by_wd:
+            self.__inotify.rm_watch(wd)
+        self.__tree_by_wd.clear()
+        self.__wd_by_tree.clear()
+        self.__watch(self.__tree)
+        (listed, unchanged) = self.__tree.refresh(self.__workers)
+        # directories the refresh added need watches too
+        self.unwatched = 0
+        self.__watch(self.__tree)
+        return listed
+
+    def close(self):
+        self.__inotify.close()
+
+
+def read_json_lines(path):
+    # the records of an append-only file of JSON lines.  A line torn by a crash ends it and is cut
+    # off, so later records don't land after it.
+    records = []
+    good_size = 0
+    with open(path, 'rb') as fin:
+        for line in fin:
+            try:
+                if not line.endswith(b'\n'):
+                    break
+                records.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                break
+            good_size += len(line)
+    if good_size < os.path.getsize(path):
+        with open(path, 'r+b') as fout:
+            fout.truncate(good_size)
+    return records
+
+
+class TreeJournal(object):
+    """
+    Append-only record of filter and notes edits to a saved tree, one JSON object per line, so
+    saving a session costs as much as the edits made in it.  The journal is replayed on top of
+    the tree file when a job is loaded, and emptied whenever the whole tree is saved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = 0
+        self.__file = None
+
+    def replay(self, tree):
+        # returns the number of edits applied
+        if not os.path.exists(self.path):
+            return 0
+        applied = 0
+        for edit in read_json_lines(self.path):
+            self.entries += 1
+            node = tree.find(edit['path'])
+            if node is None:
+                continue
+            if 'notes' in edit:
+                node.notes = edit['notes']
+            elif edit['filter'] == FILTER_EXCLUDE_ALL:
+                node.exclude_all()
+            else:
+                node.include_all()
+            applied += 1
+        return applied
+
+    def record(self, tree, **edit):
+        # flushed right away, so the edit survives a crash of the chooser
+        names = []
+        while tree.parent is not None:
+            names.append(tree.name)
+            tree = tree.parent
+        names.reverse()
+        edit['path'] = ''.join(name if isinstance(name, type(u'')) else decode_text(name) for name in names)
+        if self.__file is None:
+            self.__file = open(self.path, 'ab')
+        self.__file.write((json.dumps(edit, sort_keys=True) + '\n').encode('utf-8'))
+        self.__file.flush()
+        self.entries += 1
+
+    @property
+    def needs_compaction(self):
+        return self.entries >= JOURNAL_COMPACT_ENTRIES
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def clear(self):
+        # the edits are in the tree file now
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.entries = 0
+
+
+class SqliteTree(object):
+    """
+    A directory tree kept in an SQLite database instead of in memory.  Nodes are SqliteNode
+    proxies that read their rows as they're needed, so only the directories being looked at take
+    memory, and the file chooser, file lists and copy engines walk them like DirTree nodes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.order = 'size'
+        self.treeview_iids = dict()
+        # the copy engines walk the tree on a pool thread while the main thread reads totals, so
+        # the connection is shared and every statement holds the lock
+        self.__lock = threading.RLock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.create_function('name_matches', 2, SqliteTree.__name_matches)
+        self.__connection.executescript(SQLITE_TREE_TABLE)
+
+    @staticmethod
+    def ls(path, db_path, workers=DEFAULT_SCAN_WORKERS, stats=None):
+        # lists the directory into a new database, a directory's rows at a time, then adds up
+        # directory sizes one depth at a time from the bottom
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        store = SqliteTree(db_path)
+        insert = 'INSERT INTO nodes (id, parent, name, is_directory, size, filtered_size, mtime, depth) ' \
+                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+        store.execute(insert, (0, None, SqliteTree.blob(path + '/'), 1, 0, 0, None, 0), commit=False)
+        next_id = 1
+        max_depth = 0
+        pool = ListingPool(workers)
+        try:
+            pool.submit((0, 0), path)
+            outstanding = 1
+            while outstanding:
+                ((parent, depth), parent_path, stamp, entries, files) = pool.get()
+                outstanding -= 1
+                if stamp is not None:
+                    store.execute('UPDATE nodes SET mtime = ? WHERE id = ?', (stamp[0], parent), commit=False)
+                rows = []
+                for name, is_directory, size, mtime in entries:
+                    if is_directory:
+                        pool.submit((next_id, depth + 1), os.path.join(parent_path, name))
+                        outstanding += 1
+                        name += '/'
+                    rows.append((next_id, parent, SqliteTree.blob(name), is_directory, size, size, mtime, depth + 1))
+                    next_id += 1
+                max_depth = max(max_depth, depth + 1) if rows else max_depth
+                store.executemany(insert, rows)
+        finally:
+            pool.close()
+            if stats is not None:
+                stats.update(pool.stats)
+        store.executescript(SQLITE_TREE_INDEXES)
+        for depth in range(max_depth - 1, -1, -1):
+            store.execute(
+                'UPDATE nodes SET size = (SELECT COALESCE(SUM(size), 0) FROM nodes AS child '
+                'WHERE child.parent = nodes.id) WHERE depth = ? AND is_directory', (depth,), commit=False)
+        store.execute('UPDATE nodes SET filtered_size = size WHERE is_directory')
+        return store.root
+
+    @staticmethod
+    def load(db_path):
+        store = SqliteTree(db_path)
+        store.executescript(SQLITE_TREE_INDEXES)
+        return store.root
+
+    @property
+    def root(self):
+        return self.node(0)
+
+    def node(self, node_id):
+        rows = self.query('SELECT %s FROM nodes WHERE id = ?' % (SQLITE_NODE_COLUMNS,), (node_id,))
+        return SqliteNode(self, *rows[0]) if rows else None
+
+    def query(self, sql, args=()):
+        # rows are fetched right away, so cursors never outlive the lock
+        with self.__lock:
+            return self.__connection.execute(sql, args).fetchall()
+
+    def execute(self, sql, args=(), commit=True):
+        with self.__lock:
+            self.__connection.execute(sql, args)
+            if commit:
+                self.__connection.commit()
+
+    def executemany(self, sql, rows):
+        with self.__lock:
+            self.__connection.executemany(sql, rows)
+
+    def executescript(self, sql):
+        with self.__lock:
+            self.__connection.executescript(sql)
+
+    def commit(self):
+        with self.__lock:
+            self.__connection.commit()
+
+    @staticmethod
+    def blob(text):
+        # names are stored as the bytes DirTree.save writes, so any file name round-trips
+        return sqlite3.Binary(encode_text(text))
+
+    @staticmethod
+    def file_name(blob):
+        return decode_name(bytes(blob))
+
+    @staticmethod
+    def __name_matches(name, query):
+        # the same matching as NameIndex.search, run inside the query
+        name = decode_text(bytes(name)).lower()
+        if SEARCH_WILDCARDS.search(query):
+            return re.match(u'%s/?$' % (translate_glob(query, '/'),), name) is not None
+        return query in name
+
+
+class SqliteNode(object):
+    """
+    A row of a SqliteTree with the interface of a DirTree node.  Name, type, size and time are
+    read with the row; filters, filtered sizes and notes are read and written through to the
+    database, so two proxies for the same row always agree.
+    """
+
+    __slots__ = (
+        '__store',
+        '__id',
+        '__parent_id',
+        '__name',
+        '__is_directory',
+        '__size',
+        '__mtime',
+    )
+
+    def __init__(self, store, node_id, parent_id, name, is_directory, size, mtime):
+        self.__store = store
+        self.__id = node_id
+        self.__parent_id = parent_id
+        self.__name = SqliteTree.file_name(name)
+        self.__is_directory = bool(is_directory)
+        self.__size = size
+        self.__mtime = mtime
+
+    def __eq__(self, other):
+        return isinstance(other, SqliteNode) and self.__store is other.__store and self.__id == other.__id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.__id)
+
+    @property
+    def store(self):
+        return self.__store
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def is_directory(self):
+        return self.__is_directory
+
+    @property
+    def parent(self):
+        return self.__store.node(self.__parent_id) if self.__parent_id is not None else None
+
+    @property
+    def children(self):
+        if not self.__is_directory:
+            return ()
+        store = self.__store
+        rows = store.query('SELECT %s FROM nodes WHERE parent = ? ORDER BY %s' % (
+            SQLITE_NODE_COLUMNS, SQLITE_CHILD_ORDERS[store.order]), (self.__id,))
+        return tuple(SqliteNode(store, *row) for row in rows)
+
+    @property
+    def has_children(self):
+        return self.__is_directory and bool(
+            self.__store.query('SELECT 1 FROM nodes WHERE parent = ? LIMIT 1', (self.__id,)))
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def size_known(self):
+        # every directory is listed when the database is filled
+        return True
+
+    @property
+    def filter(self):
+        # the module's constants, so comparisons with "is" keep working
+        return FILTERS[self.__column('filter').encode('ascii')]
+
+    @property
+    def filtered_size(self):
+        return self.__column('filtered_size')
+
+    @property
+    def notes(self):
+        return self.__column('notes')
+
+    @notes.setter
+    def notes(self, notes):
+        notes = notes or None
+        if notes != self.notes:
+            self.__store.execute('UPDATE nodes SET notes = ? WHERE id = ?', (notes, self.__id))
+
+    @property
+    def mtime(self):
+        return self.__mtime
+
+    @property
+    def path(self):
+        names = []
+        tree = self
+        while tree is not None:
+            names.append(tree.name)
+            tree = tree.parent
+        return ''.join(reversed(names))
+
+    @property
+    def treeview_iid(self):
+        return self.__store.treeview_iids.get(self.__id)
+
+    @treeview_iid.setter
+    def treeview_iid(self, iid):
+        if iid is None:
+            self.__store.treeview_iids.pop(self.__id, None)
+        else:
+            self.__store.treeview_iids[self.__id] = iid
+
+    def __column(self, column):
+        return self.__store.query('SELECT %s FROM nodes WHERE id = ?' % (column,), (self.__id,))[0][0]
+
+    def __set_filter(self, f):
+        # the subtree is updated with one statement, skipping parts of it already set to the
+        # filter, then ancestors are recounted for as long as that changes something
+        if self.filter == f:
+            return
+        store = self.__store
+        store.execute(
+            SQLITE_SUBTREE + 'UPDATE nodes SET filter = ?, filtered_size = size * ? WHERE id IN subtree',
+            (self.__id, f, f, int(f != FILTER_EXCLUDE_ALL)), commit=False)
+        ancestors = []
+        parent = self.parent
+        while parent:
+            (count, included, excluded, filtered_size) = store.query(
+                'SELECT COUNT(*), SUM(filter = ?), SUM(filter = ?), SUM(filtered_size) FROM nodes '
+                'WHERE parent = ?', (FILTER_INCLUDE_ALL, FILTER_EXCLUDE_ALL, parent.__id))[0]
+            new_filter = FILTER_PARTIAL
+            if excluded == count:
+                new_filter = FILTER_EXCLUDE_ALL
+            elif included == count:
+                new_filter = FILTER_INCLUDE_ALL
+            if new_filter == parent.filter and filtered_size == parent.filtered_size:
+                break
+            store.execute('UPDATE nodes SET filter = ?, filtered_size = ? WHERE id = ?',
+                          (new_filter, filtered_size, parent.__id), commit=False)
+            ancestors.append(parent)
+            parent = parent.parent
+        store.commit()
+        if DirTree.filter_changed:
+            # only rows shown in the chooser need to hear about it
+            pending = [self]
+            while pending:
+                tree = pending.pop()
+                DirTree.filter_changed(tree)
+                pending.extend(child for child in tree.children if child.__id in store.treeview_iids)
+            for tree in ancestors:
+                DirTree.filter_changed(tree)
+
+    def exclude_all(self):
+        self.__set_filter(FILTER_EXCLUDE_ALL)
+
+    def include_all(self):
+        self.__set_filter(FILTER_INCLUDE_ALL)
+
+    def find(self, relpath):
+        tree = self
+        for part in relpath.split('/'):
+            if not part:
+                continue
+            store = tree.__store
+            rows = store.query('SELECT %s FROM nodes WHERE parent = ? AND name IN (?, ?)' % (SQLITE_NODE_COLUMNS,),
+                               (tree.__id, SqliteTree.blob(part), SqliteTree.blob(part + '/')))
+            if not rows:
+                return None
+            tree = SqliteNode(store, *rows[0])
+        return tree
+
+    def sort_by_name(self):
+        # children are sorted as they're read
+        self.__store.order = 'name'
+
+    def save(self, path):
+        # edits are written through as they're made
+        self.__store.commit()
+
+    def scan_unlisted(self, workers=DEFAULT_SCAN_WORKERS):
+        # every directory is listed when the database is filled, so there's never anything to list
+        return None
+
+
+class SqliteNameIndex(object):
+    """
+    NameIndex over a SqliteTree, searched with a query over the names table rather than a copy of
+    every name in memory.  Entries are row ids.
+    """
+
+    def __init__(self, tree):
+        self.__store = tree.store
+
+    def __len__(self):
+        return self.__store.query('SELECT COUNT(*) FROM nodes')[0][0]
+
+    def search(self, query, limit=SEARCH_MAX_RESULTS):
+        if not isinstance(query, type(u'')):
+            query = decode_text(query)
+        query = query.lower()
+        if not query:
+            return []
+        rows = self.__store.query('SELECT id FROM nodes WHERE name_matches(name, ?) ORDER BY id LIMIT ?', (query, limit))
+        return [row[0] for row in rows]
+
+    def names(self, entry):
+        names = []
+        node = self.__store.node(entry)
+        while node is not None:
+            names.append(node.name)
+            node = node.parent
+        names.reverse()
+        return names
+
+    def path(self, entry):
+        return ''.join(self.names(entry))
+
+    def node(self, tree, entry):
+        return self.__store.node(entry)
+
+
+class SpaceAnalytics(object):
+    """
+    Space aggregates gathered while a tree is assembled, so questions about where the space goes
+    don't need another walk: the largest files and directories (kept in bounded heaps), files
+    and bytes per extension, and files and bytes per age.
+    """
+
+    def __init__(self, top_count=ANALYTICS_TOP_COUNT, now=None):
+        self.__top_count = top_count
+        self.__now = time.time() if now is None else now
+        self.__sequence = itertools.count()
+        self.__top_files = []
+        self.__top_directories = []
+        self.__extensions = dict()
+        self.__ages = [[0, 0] for bucket in ANALYTICS_AGE_BUCKETS + ((None, ANALYTICS_UNKNOWN_AGE),)]
+
+    @staticmethod
+    def from_tree(tree, top_count=ANALYTICS_TOP_COUNT):
+        # for trees loaded from jobs saved without analytics
+        # directories are added after everything below them, in the order a scan finishes them
+        analytics = SpaceAnalytics(top_count)
+        for (node, relpath) in walk_tree(tree, post_order=True):
+            if node.is_directory:
+                analytics.add_directory(node)
+        return analytics
+
+    def add_directory(self, tree):
+        # takes the directory and the files directly in it; subdirectories are added on their own
+        if tree.parent is not None:
+            self.__push(self.__top_directories, tree)
+        for child in tree.children:
+            if not child.is_directory:
+                self.__add_file(child)
+
+    def __add_file(self, tree):
+        size = tree.size
+        self.__push(self.__top_files, tree)
+        extension = os.path.splitext(tree.name)[1].lower()
+        counts = self.__extensions.get(extension)
+        if counts is None:
+            counts = self.__extensions[extension] = [0, 0]
+        counts[0] += 1
+        counts[1] += size
+        counts = self.__ages[-1]
+        if tree.mtime is not None:
+            age = (self.__now - tree.mtime) / (24 * 60 * 60)
+            for (i, (days, label)) in enumerate(ANALYTICS_AGE_BUCKETS):
+                if days is None or age < days:
+                    counts = self.__ages[i]
+                    break
+        counts[0] += 1
+        counts[1] += size
+
+    def __push(self, heap, tree):
+        # a min-heap of the largest entries seen so far, so most entries cost one comparison
+        if len(heap) < self.__top_count:
+            heapq.heappush(heap, (tree.size, next(self.__sequence), tree))
+        elif tree.size > heap[0][0]:
+            heapq.heapreplace(heap, (tree.size, next(self.__sequence), tree))
+
+    def to_dict(self):
+        def text(value):
+            return value if isinstance(value, type(u'')) else decode_text(value)
+
+        def largest(heap):
+            return [dict(path=text(tree.path), size=size) for (size, i, tree) in sorted(heap, reverse=True)]
+
+        labels = [label for (days, label) in ANALYTICS_AGE_BUCKETS] + [ANALYTICS_UNKNOWN_AGE]
+        return dict(
+            created=datetime.fromtimestamp(self.__now).isoformat(),
+            top_files=largest(self.__top_files),
+            top_directories=largest(self.__top_directories),
+            extensions=dict(
+                (text(extension), dict(files=files, bytes=size))
+                for (extension, (files, size)) in self.__extensions.items()),
+            ages=[dict(age=label, files=files, bytes=size) for (label, (files, size)) in zip(labels, self.__ages)],
+        )
+
+
+def format_analytics(data, extension_count=ANALYTICS_TOP_COUNT):
+    # report lines for a SpaceAnalytics.to_dict() result
+    lines = []
+    for (title, key) in (('Largest directories', 'top_directories'), ('Largest files', 'top_files')):
+        lines.append(title)
+        lines.extend('  %10s  %s' % (friendly_file_size(entry['size']), entry['path']) for entry in data[key])
+        lines.append('')
+    lines.append('Extensions by size')
+    extensions = sorted(data['extensions'].items(), key=lambda item: item[1]['bytes'], reverse=True)
+    for (extension, counts) in extensions[:extension_count]:
+        lines.append('  %10s  %10s files  %s' % (
+            friendly_file_size(counts['bytes']),
+            friendly_decimal(counts['files']),
+            extension if extension else '(none)',
+        ))
+    if len(extensions) > extension_count:
+        lines.append('  ... and %d more' % (len(extensions) - extension_count,))
+    lines.append('')
+    lines.append('Files by age (last modified)')
+    for counts in data['ages']:
+        lines.append('  %10s  %10s files  %s' % (
+            friendly_file_size(counts['bytes']),
+            friendly_decimal(counts['files']),
+            counts['age'],
+        ))
+    return lines
+
+
+class TreeFile(object):
+    """
+    A saved tree file, mapped into memory.  Node records and their names are read as DirTree.load()
+    reaches them, so a subtree that's never opened is never decoded.
+    """
+
+    def __init__(self, path):
+        # intern table for the names of nodes loaded from this file
+        self.names = dict()
+        with open(path, 'rb') as fin:
+            self.__map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.node_count, self.__nodes_offset, self.__strings_offset) = \
+            TREE_FILE_HEADER.unpack_from(self.__map, 0)
+        if magic != TREE_FILE_MAGIC:
+            raise ValueError('%s is not a tree file' % (path,))
+        if version != TREE_FILE_VERSION:
+            raise ValueError('Unsupported tree file version %d' % (version,))
+
+    def record(self, index):
+        return TREE_FILE_NODE.unpack_from(self.__map, self.__nodes_offset + index * TREE_FILE_NODE.size)
+
+    def text(self, offset, length):
+        start = self.__strings_offset + offset
+        return decode_text(self.__map[start:start + length])
+
+    def name(self, offset, length):
+        start = self.__strings_offset + offset
+        return decode_name(self.__map[start:start + length])
+
+
+def translate_glob(pattern, separator):
+    # like fnmatch.translate, but wildcards never match the separator, except for ** when the
+    # separator is a slash
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == '*' and separator == '/' and pattern[i:i + 1] == '*':
+            parts.append('.*')
+            i += 1
+        elif c == '*':
+            parts.append('[^%s]*' % (separator,))
+        elif c == '?':
+            parts.append('[^%s]' % (separator,))
+        elif c == '[':
+            j = i
+            if j < len(pattern) and pattern[j] == '!':
+                j += 1
+            if j < len(pattern) and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j < 0:
+                parts.append('\\[')
+                continue
+            chars = pattern[i:j].replace('\\', '\\\\')
+            i = j + 1
+            if chars.startswith('!'):
+                parts.append('[^%s%s]' % (separator, chars[1:]))
+            else:
+                parts.append('[%s]' % (chars,))
+        else:
+            parts.append(re.escape(c))
+    return ''.join(parts)
+
+
+def glob_to_regex(pattern):
+    # matches whole names in a NameIndex, whose names are separated by NULs.  Directory names end
+    # in a slash, which the pattern doesn't need to spell out.
+    return '(?:^|(?<=\\0))%s/?(?=\\0|$)' % (translate_glob(pattern, '\\0'),)
+
+
+class FilterRules(object):
+    """
+    Include and exclude rules, with the glob rules compiled into one matcher.  A rules file has one
+    rule per line, "include" or "exclude" followed by a predicate:
+
+        glob PATTERN    a name, or a path from the top when the pattern has a slash in it; a
+                        trailing slash only matches directories, and ** crosses directories
+        regex PATTERN   searched for in the path from the top, where directories end in a slash
+        size OP SIZE    file size, e.g. "size > 4G" (B, K, M, G or T)
+        age OP AGE      time since a file was modified, e.g. "age > 5y" (d, w, m or y)
+
+    The first rule that matches an entry sets its filter.  Blank lines and lines starting with #
+    are ignored.
+    """
+
+    def __init__(self, rules, now=None):
+        # rules are (action, kind, argument) tuples.  Glob rules become alternatives of one regex,
+        # each followed by an empty group naming its rule, so a single match finds the first of
+        # them that applies.  Regex rules are compiled on their own, since their groups, flags and
+        # backreferences would change meaning inside a bigger pattern.
+        self.__now = time.time() if now is None else now
+        self.__filters = []
+        self.__regexes = []
+        self.__comparisons = []
+        alternatives = []
+        for (i, (action, kind, argument)) in enumerate(rules):
+            self.__filters.append(RULE_ACTIONS[action])
+            if kind == 'glob':
+                alternatives.append('(?:%s)(?P<_rule%d>)' % (FilterRules.__glob_pattern(argument), i))
+            elif kind == 'regex':
+                self.__regexes.append((i, re.compile(argument)))
+            else:
+                (op, value) = FilterRules.__comparison(kind, argument)
+                self.__comparisons.append((i, kind, RULE_COMPARISONS[op], value))
+        self.__pattern = re.compile('|'.join(alternatives)) if alternatives else None
+        # whether any rule includes entries, which only such a rule can do inside an excluded directory
+        self.includes = FILTER_INCLUDE_ALL in self.__filters
+
+    @staticmethod
+    def load(path):
+        rules = []
+        with open(path) as fin:
+            for (number, line) in enumerate(fin, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                words = line.split(None, 2)
+                if len(words) < 3 or words[0] not in RULE_ACTIONS or words[1] not in RULE_KINDS:
+                    raise ValueError('%s:%d: expected "include|exclude glob|regex|size|age ...", got %r' % (
+                        path, number, line))
+                try:
+                    FilterRules([tuple(words)])
+                except (ValueError, re.error) as e:
+                    raise ValueError('%s:%d: %s' % (path, number, e))
+                rules.append(tuple(words))
+        return FilterRules(rules)
+
+    @staticmethod
+    def __glob_pattern(pattern):
+        directories_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = '/' in pattern
+        body = translate_glob(pattern.lstrip('/'), '/')
+        return '%s%s%s\\Z' % ('' if anchored else '(?:.*/)?', body, '/' if directories_only else '/?')
+
+    @staticmethod
+    def __comparison(kind, argument):
+        match = re.match(r'^(>=|<=|>|<)\s*([0-9.]+)\s*([A-Za-z]?)$', argument.strip())
+        if not match:
+            raise ValueError('expected a comparison like "> 4G", got %r' % (argument,))
+        (op, number, unit) = match.groups()
+        units = RULE_SIZE_UNITS if kind == 'size' else RULE_AGE_UNITS
+        unit = (unit.upper() or 'B') if kind == 'size' else (unit or 'd')
+        if unit not in units:
+            raise ValueError('unknown %s unit %r' % (kind, unit))
+        if kind == 'size':
+            return op, float(number) * units[unit]
+        return op, float(number) * units[unit] * 24 * 60 * 60
+
+    def match(self, relpath, is_directory, size, mtime):
+        # returns the filter of the first matching rule, or None
+        first = len(self.__filters)
+        if self.__pattern is not None:
+            match = self.__pattern.match(relpath)
+            if match:
+                first = int(match.lastgroup[len('_rule'):])
+        for (i, regex) in self.__regexes:
+            if i >= first:
+                break
+            if regex.search(relpath):
+                first = i
+                break
+        for (i, kind, compare, value) in self.__comparisons:
+            if i >= first:
+                break
+            if is_directory:
+                continue
+            if kind == 'size':
+                actual = size
+            elif mtime is None:
+                continue
+            else:
+                actual = self.__now - mtime
+            if compare(actual, value):
+                first = i
+                break
+        return self.__filters[first] if first < len(self.__filters) else None
+
+
+class NameIndex(object):
+    """
+    Case-insensitive search over every name in a tree.  Names are joined into one text with a NUL
+    between them, so a substring or glob search runs as a single find or regex scan, and a match
+    offset maps back to its entry by bisecting the sorted name offsets.  Entries remember their
+    parent entry, so paths are only built for the matches.
+    """
+
+    def __init__(self, tree):
+        self.__names = []
+        self.__parents = array('l')
+        self.__offsets = array('l')
+        text = []
+        offset = 0
+        for (name, parent) in tree.iter_names():
+            if not isinstance(name, type(u'')):
+                name = decode_text(name)
+            self.__names.append(name)
+            self.__parents.append(parent)
+            self.__offsets.append(offset)
+            text.append(name.lower())
+            offset += len(name) + 1
+        self.__text = u'\0'.join(text)
+
+    def __len__(self):
+        return len(self.__names)
+
+    def search(self, query, limit=SEARCH_MAX_RESULTS):
+        # queries with *, ? or [...] are globs matched against whole names; anything else matches
+        # anywhere in a name.  Returns entries in tree order, at most one per name.
+        if not isinstance(query, type(u'')):
+            query = decode_text(query)
+        query = query.lower()
+        if not query:
+            return []
+        entries = []
+        if SEARCH_WILDCARDS.search(query):
+            for match in re.finditer(glob_to_regex(query), self.__text):
+                entries.append(bisect_right(self.__offsets, match.start()) - 1)
+                if len(entries) >= limit:
+                    break
+            return entries
+        start = self.__text.find(query)
+        while start >= 0 and len(entries) < limit:
+            entry = bisect_right(self.__offsets, start) - 1
+            entries.append(entry)
+            if entry + 1 >= len(self.__offsets):
+                break
+            start = self.__text.find(query, self.__offsets[entry + 1])
+        return entries
+
+    def names(self, entry):
+        # names from the root down to the entry
+        names = []
+        while entry >= 0:
+            names.append(self.__names[entry])
+            entry = self.__parents[entry]
+        names.reverse()
+        return names
+
+    def path(self, entry):
+        return ''.join(self.names(entry))
+
+    def node(self, tree, entry):
+        return tree.find(''.join(self.names(entry)[1:]))
+
+
+class FileChooser(tk.Frame):
+    __HAS_NOTES_STRING = '*'
+
+    def __init__(self, parent, tree, unload_collapsed=False, index=None, analytics=None, scan=None):
+        tk.Frame.__init__(self, parent, background="white")
+        self.__parent = parent
+        self.__root_tree = tree
+        self.__index = index
+        self.__index_partial = False
+        self.__analytics = analytics
+        self.__scan = scan
+        # directories included again after the scan, and the TreeScan listing what was unlisted
+        # under the first of them
+        self.__unlisted_roots = []
+        self.__listing = None
+        self.__relisted = 0
+        self.__search_results = []
+        self.__tree_by_iid = dict()
+        self.__expanded_by_iid = dict()
+        self.__placeholder_by_iid = dict()
+        self.__unload_collapsed = unload_collapsed
+        self.__focus_tree = None
+        self.__dirty = set()
+        self.__flush_id = None
+        self.__flush_count = 0
+        self.__flushed_rows = 0
+        self.__flush_time = 0.0
+        self.__max_flush_time = 0.0
+
+        self.__parent.title("Choose Files")
+        self.__center_window()
+
+        self.rowconfigure(0, weight=1)
+        self.columnconfigure(0, weight=1)
+        self.pack(fill=tk.BOTH, expand=True)
+
+        self.__treeview = ttk.Treeview(self, columns=('size', 'filtered_size', 'notes'))
+        ysb = ttk.Scrollbar(self, orient='vertical', command=self.__treeview.yview)
+        xsb = ttk.Scrollbar(self, orient='horizontal', command=self.__treeview.xview)
+        self.__treeview.configure(yscroll=ysb.set, xscroll=xsb.set)
+        self.__treeview.configure(yscroll=ysb.set)
+        self.__treeview.heading('#0', text='Path', anchor='w')
+        self.__treeview.heading('size', text='Size', anchor='e')
+        self.__treeview.heading('filtered_size', text='Filtered Size', anchor='e')
+        self.__treeview.heading('notes', text='Notes')
+        self.__treeview.column('#0', stretch=True)
+        self.__treeview.column('size', anchor='e', width=100, stretch=False)
+        self.__treeview.column('filtered_size', anchor='e', width=100, stretch=False)
+        self.__treeview.column('notes', width=40, anchor=tk.CENTER, stretch=False)
+        self.__treeview.tag_configure('exclude', foreground='gray')
+
+        self.__treeview.bind('<Button-2>', self.__treeview_rightclick)
+        self.__treeview.bind('<Button-3>', self.__treeview_rightclick)
+        self.__treeview.bind('<KeyPress>', self.__treeview_keypress)
+        self.__treeview.bind('<<TreeviewSelect>>', self.__treeview_select)
+        self.__treeview.bind('<<TreeviewOpen>>', self.__treeview_open)
+        self.__treeview.bind('<<TreeviewClose>>', self.__treeview_close)
+
+        self.__treeview.grid(row=0, column=0, sticky='nsew')
+        ysb.grid(row=0, column=1, sticky='ns')
+        xsb.grid(row=1, column=0, sticky='ew')
+
+        details_frame = tk.Frame(self)
         details_frame.grid(row=0, column=2, rowspan=2, sticky='ne', padx=5, pady=5)
         tk.Label(details_frame, text='Details', font=tkf.Font(weight='bold')).pack()
+        self.__scan_status = tk.Label(details_frame, text='')
+        self.__scan_status.pack(anchor='w')
         tk.Label(details_frame, text='Full Path:').pack(anchor='w')
         self.__path_text = tk.Entry(details_frame, width=40, highlightthickness=0, relief=tk.FLAT, state='readonly')
         self.__path_text.pack(fill=tk.X)
@@ -314,9 +2612,26 @@ class FileChooser(tk.Frame):
         self.__notes_text = tk.Text(details_frame, width=40, height=15, bd=2, relief=tk.SUNKEN, highlightthickness=0)
         self.__notes_text.pack(fill=tk.X)
         tk.Button(details_frame, text='Show File', command=self.__show_button_pressed).pack(ipady=20)
+        tk.Button(details_frame, text='Space Analytics', command=self.__analytics_button_pressed).pack()
+        tk.Label(details_frame, text='Search (name or glob):').pack(anchor='w')
+        self.__search_text = tk.Entry(details_frame, width=40)
+        self.__search_text.pack(fill=tk.X)
+        self.__search_text.bind('<Return>', self.__search)
+        self.__search_status = tk.Label(details_frame, text='')
+        self.__search_status.pack(anchor='w')
+        self.__search_list = tk.Listbox(details_frame, width=40, height=12)
+        self.__search_list.pack(fill=tk.X)
+        self.__search_list.bind('<<ListboxSelect>>', self.__search_result_selected)
 
         self.__process_tree(tree)
         DirTree.filter_changed = self.__tree_filter_changed
+        if scan is not None:
+            self.after(SCAN_POLL_INTERVAL_MS, self.__poll_scan)
+
+    @property
+    def flush_timings(self):
+        # (batches, rows updated, total seconds, slowest batch in seconds)
+        return self.__flush_count, self.__flushed_rows, self.__flush_time, self.__max_flush_time
 
     def __center_window(self):
         w = 1280
@@ -327,25 +2642,54 @@ class FileChooser(tk.Frame):
         y = (sh - h)/2
         self.__parent.geometry('%dx%d+%d+%d' % (w, h, x, y))
 
-    def __process_tree(self, tree, view_parent=None):
+    def __process_tree(self, tree):
+        # only the root and its children are inserted up front; the rest is inserted as
+        # directories are expanded
+        iid = self.__insert(tree, '', expanded=True)
+        self.__populate(iid)
+
+    def __insert(self, tree, view_parent, expanded=False):
         iid = self.__treeview.insert(
-            '' if view_parent is None else view_parent,
+            view_parent,
             'end',
             text=tree.name,
-            open=(view_parent is None),
+            open=expanded,
             tags=('exclude',) if tree.filter == FILTER_EXCLUDE_ALL else tuple(),
-            values=(
-                friendly_file_size(tree.size),
-                friendly_file_size(tree.filtered_size),
-                FileChooser.__HAS_NOTES_STRING if tree.notes else ''
-            )
+            values=self.__row_values(tree),
         )
-        self.__expanded_by_iid[iid] = (view_parent is None)
+        self.__expanded_by_iid[iid] = expanded
         self.__tree_by_iid[iid] = tree
         tree.treeview_iid = iid
 
-        for child in tree.children:
-            self.__process_tree(child, iid)
+        if tree.has_children:
+            # gives the item an expand button until its children are inserted
+            self.__placeholder_by_iid[iid] = self.__treeview.insert(iid, 'end')
+        return iid
+
+    def __populate(self, iid):
+        placeholder = self.__placeholder_by_iid.pop(iid, None)
+        if placeholder is None:
+            return False
+        self.__treeview.delete(placeholder)
+        for child in self.__tree_by_iid[iid].children:
+            self.__insert(child, iid)
+        return True
+
+    def __unload(self, iid):
+        items = list(self.__treeview.get_children(iid))
+        if not items or iid in self.__placeholder_by_iid:
+            return
+        pending = list(items)
+        while pending:
+            item = pending.pop()
+            pending.extend(self.__treeview.get_children(item))
+            self.__placeholder_by_iid.pop(item, None)
+            self.__expanded_by_iid.pop(item, None)
+            tree = self.__tree_by_iid.pop(item, None)
+            if tree is not None:
+                tree.treeview_iid = None
+        self.__treeview.delete(*items)
+        self.__placeholder_by_iid[iid] = self.__treeview.insert(iid, 'end')
 
     def __treeview_rightclick(self, event):
         # select row under mouse
@@ -355,7 +2699,7 @@ class FileChooser(tk.Frame):
             self.__treeview.selection_set(iid)
             tree = self.__tree_by_iid[iid]
             if tree.filter is FILTER_EXCLUDE_ALL:
-                tree.include_all()
+                self.__include(tree)
             else:
                 tree.exclude_all()
         else:
@@ -372,7 +2716,51 @@ class FileChooser(tk.Frame):
         elif event.char == 'i':
             for iid in self.__treeview.selection():
                 tree = self.__tree_by_iid[iid]
-                tree.include_all()
+                self.__include(tree)
+
+    def __include(self, tree):
+        # directories that were excluded before the scan got to them are listed now, in the
+        # background, so their contents show up.  A scan still running lists them itself.
+        tree.include_all()
+        if self.__scan is None or self.__scan.done:
+            self.__unlisted_roots.append(tree)
+            if self.__listing is None:
+                self.__list_unlisted()
+
+    def __list_unlisted(self):
+        while self.__unlisted_roots and self.__listing is None:
+            self.__listing = self.__unlisted_roots.pop(0).scan_unlisted()
+        if self.__listing is not None:
+            self.after(SCAN_POLL_INTERVAL_MS, self.__poll_listing)
+
+    def __poll_listing(self):
+        (listed, finished) = self.__listing.poll()
+        self.__show_listed(listed, finished)
+        if self.__listing.error is not None:
+            print('Listing included directories failed: %s' % (self.__listing.error,), file=sys.stderr)
+            self.__scan_status.config(text='Listing included directories failed: %s' % (self.__listing.error,))
+            self.__relisted += self.__listing.listed
+            self.__listing = None
+            self.__list_unlisted()
+        elif self.__listing.done:
+            self.__relisted += self.__listing.listed
+            self.__listing = None
+            self.__scan_status.config(text='Listed %s included directories' % (friendly_decimal(self.__relisted),))
+            self.__list_unlisted()
+        else:
+            self.__scan_status.config(text='Listing included directories: %s so far' % (
+                friendly_decimal(self.__relisted + self.__listing.listed),))
+            self.after(SCAN_POLL_INTERVAL_MS, self.__poll_listing)
+
+    def finish_listing(self):
+        # once the chooser is closed, waits for the directories being listed since they were
+        # included again, and returns how many directories were listed while it was open.  Those
+        # still waiting their turn are left to DirTree.list_unlisted().
+        if self.__listing is not None:
+            self.__listing.finish()
+            self.__relisted += self.__listing.listed
+            self.__listing = None
+        return self.__relisted
 
     def __treeview_select(self, event):
         self.commit()
@@ -389,25 +2777,52 @@ class FileChooser(tk.Frame):
     def commit(self):
         if self.__focus_tree:
             self.__focus_tree.notes = self.__notes_text.get(1.0, tk.END).strip()
-            self.__update_treeview_item(self.__focus_tree)
+            if self.__focus_tree.treeview_iid:
+                self.__update_treeview_item(self.__focus_tree)
 
     def __treeview_open(self, event):
         iid = self.__treeview.focus()
         self.__expanded_by_iid[iid] = True
-        tree = self.__tree_by_iid[iid]
-        self.__update_treeview(tree)
+        if not self.__populate(iid):
+            tree = self.__tree_by_iid[iid]
+            self.__update_treeview(tree)
 
     def __treeview_close(self, event):
         iid = self.__treeview.focus()
         self.__expanded_by_iid[iid] = False
+        if self.__unload_collapsed:
+            self.__unload(iid)
 
     def __update_treeview(self, tree):
-        updated = self.__tree_filter_changed(tree)
-        if updated:
-            for child in tree.children:
-                self.__update_treeview(child)
+        # rows below one that didn't need refreshing are left alone
+        pending = [tree]
+        while pending:
+            tree = pending.pop()
+            if self.__refresh_item(tree):
+                pending.extend(tree.children)
+
+    def __tree_filter_changed(self, tree):
+        # a bulk include/exclude touches every node below it; rows are collected here and
+        # refreshed once Tk is idle
+        if tree.treeview_iid:
+            self.__dirty.add(tree)
+            if self.__flush_id is None:
+                self.__flush_id = self.after_idle(self.__flush)
+
+    def __flush(self):
+        start_time = time.time()
+        self.__flush_id = None
+        dirty = self.__dirty
+        self.__dirty = set()
+        for tree in dirty:
+            if self.__refresh_item(tree):
+                self.__flushed_rows += 1
+        elapsed_time = time.time() - start_time
+        self.__flush_count += 1
+        self.__flush_time += elapsed_time
+        self.__max_flush_time = max(self.__max_flush_time, elapsed_time)
 
-    def __tree_filter_changed(self, tree, force=False):
+    def __refresh_item(self, tree, force=False):
         if tree.treeview_iid:
             parent_iid = self.__treeview.parent(tree.treeview_iid)
             is_visible = self.__expanded_by_iid[parent_iid] if parent_iid else True
@@ -420,62 +2835,287 @@ class FileChooser(tk.Frame):
         self.__treeview.item(
             tree.treeview_iid,
             tags=('exclude',) if tree.filter == FILTER_EXCLUDE_ALL else tuple(),
-            values=(
-                friendly_file_size(tree.size),
-                friendly_file_size(tree.filtered_size),
-                FileChooser.__HAS_NOTES_STRING if tree.notes else ''
-            )
+            values=self.__row_values(tree),
+        )
+
+    def __row_values(self, tree):
+        # sizes still being added up by a background scan are marked as lower bounds, and those of
+        # directories that were never listed as unknown
+        provisional = '+' if any(
+            scan is not None and scan.is_provisional(tree) for scan in (self.__scan, self.__listing)) else ''
+        return (
+            friendly_file_size(tree.size) + provisional if tree.size_known else '?',
+            friendly_file_size(tree.filtered_size) + provisional,
+            FileChooser.__HAS_NOTES_STRING if tree.notes else ''
         )
 
+    def __poll_scan(self):
+        (listed, finished) = self.__scan.poll()
+        self.__show_listed(listed, finished)
+        if self.__scan.error is not None:
+            print('Scan failed: %s' % (self.__scan.error,), file=sys.stderr)
+            self.__scan_status.config(text='Scan failed after %s directories: %s' % (
+                friendly_decimal(self.__scan.listed), self.__scan.error))
+        elif self.__scan.done:
+            self.__scan_status.config(text='Scan complete: %s directories' % (friendly_decimal(self.__scan.listed),))
+        else:
+            self.__scan_status.config(text='Scanning: %s directories so far' % (friendly_decimal(self.__scan.listed),))
+            self.after(SCAN_POLL_INTERVAL_MS, self.__poll_scan)
+
+    def __show_listed(self, listed, finished=()):
+        # adds rows for what was found in newly listed directories, and refreshes the sizes above
+        changed = set(finished)
+        for tree in listed:
+            iid = tree.treeview_iid
+            if iid and iid not in self.__placeholder_by_iid:
+                if self.__expanded_by_iid[iid]:
+                    for child in tree.children:
+                        if not child.treeview_iid:
+                            self.__insert(child, iid)
+                elif tree.has_children and not self.__treeview.get_children(iid):
+                    self.__placeholder_by_iid[iid] = self.__treeview.insert(iid, 'end')
+            # listed files add to the size of every directory above them
+            while tree is not None and tree not in changed:
+                changed.add(tree)
+                tree = tree.parent
+        for tree in changed:
+            self.__refresh_item(tree)
+
     def __show_button_pressed(self):
         if self.__focus_tree:
             show_file(self.__focus_tree.path)
 
+    def __analytics_button_pressed(self):
+        analytics = self.__analytics
+        if analytics is None:
+            analytics = SpaceAnalytics.from_tree(self.__root_tree).to_dict()
+            if self.__scan is None or self.__scan.done:
+                self.__analytics = analytics
+        window = tk.Toplevel(self)
+        window.title('Space Analytics' if self.__scan is None or self.__scan.done else 'Space Analytics (scan in progress)')
+        text = tk.Text(window, width=100, height=40, font=tkf.Font(family='Courier'))
+        text.pack(fill=tk.BOTH, expand=True)
+        text.insert(tk.END, '\n'.join(format_analytics(analytics)))
+        text.config(state=tk.DISABLED)
+
+    def __search(self, event=None):
+        start_time = time.time()
+        query = self.__search_text.get().strip()
+        if query.startswith(self.__root_tree.name):
+            # a full path jumps straight to it
+            self.reveal(self.__root_tree.find(query[len(self.__root_tree.name):]))
+            return
+        if self.__index is None or self.__index_partial:
+            self.__index = NameIndex(self.__root_tree)
+            self.__index_partial = self.__scan is not None and not self.__scan.done
+        self.__search_results = self.__index.search(query)
+        self.__search_list.delete(0, tk.END)
+        for entry in self.__search_results:
+            self.__search_list.insert(tk.END, self.__index.path(entry))
+        self.__search_status.config(text='%d%s matches in %.0f ms' % (
+            len(self.__search_results),
+            '+' if len(self.__search_results) >= SEARCH_MAX_RESULTS else '',
+            (time.time() - start_time) * 1000,
+        ))
+
+    def __search_result_selected(self, event=None):
+        selection = self.__search_list.curselection()
+        if selection:
+            self.reveal(self.__index.node(self.__root_tree, self.__search_results[int(selection[0])]))
+
+    def reveal(self, tree):
+        # expands every directory above the node, inserting rows as needed, then selects it
+        if tree is None:
+            return
+        ancestors = []
+        parent = tree.parent
+        while parent is not None:
+            ancestors.append(parent)
+            parent = parent.parent
+        for ancestor in reversed(ancestors):
+            iid = ancestor.treeview_iid
+            self.__treeview.item(iid, open=True)
+            if not self.__expanded_by_iid[iid]:
+                self.__expanded_by_iid[iid] = True
+                if not self.__populate(iid):
+                    self.__update_treeview(ancestor)
+        self.__treeview.focus(tree.treeview_iid)
+        self.__treeview.selection_set(tree.treeview_iid)
+        self.__treeview.see(tree.treeview_iid)
+
+
+def walk_tree(tree, relpath='', prune=None, post_order=False):
+    # yields (node, relpath) for the tree and everything below it in tree order, each directory
+    # before its contents or, with post_order, after them.  The stack is a list rather than the
+    # call stack, so depth is only limited by memory.  Paths are built by appending a name to its
+    # parent's path, so directory paths end in a slash.  The contents of directories for which
+    # prune(node) is true are skipped; prune is called once the directory has been yielded, so it
+    # can go by what the caller did with it.
+    pending = [(tree, relpath, False)]
+    while pending:
+        (node, relpath, visited) = pending.pop()
+        if visited:
+            yield node, relpath
+            continue
+        if post_order:
+            pending.append((node, relpath, True))
+        else:
+            yield node, relpath
+        if node.is_directory and not (prune and prune(node)):
+            for child in reversed(node.children):
+                pending.append((child, relpath + child.name, False))
+
+
+def is_excluded(tree):
+    return tree.filter == FILTER_EXCLUDE_ALL
+
 
-def write_file_list(tree, writer, relpath='', recurse=True):
-    if tree.filter != FILTER_EXCLUDE_ALL:
+def write_file_list(tree, writer, relpath='', recurse=True, snapshot=None):
+    # everything below an excluded directory is excluded too
+    for (node, path) in walk_tree(tree, relpath, is_excluded) if recurse else [(tree, relpath)]:
+        if node.filter == FILTER_EXCLUDE_ALL:
+            continue
         data = dict(
-            path=relpath.encode('ascii', errors='replace'),
-            size=tree.filtered_size,
-            is_directory=tree.is_directory,
+            path=encode_text(path),
+            size=node.filtered_size,
+            is_directory=node.is_directory,
         )
+        if snapshot and not node.is_directory:
+            data['snapshot'] = snapshot.file_status(path, node.size)
         writer.writerow(data)
-    if recurse:
-        for child in tree.children:
-            write_file_list(child, writer, os.path.join(relpath, child.name))
 
 
-def write_readme(tree, fout, source_dir_path, parent_path=None):
-    if parent_path is None:
-        print('Overview', file=fout)
-        print('========', file=fout)
-        print('', file=fout)
-        now = datetime.now()
-        print('Files in this directory were copied using backup.py on %s at %s.' % (
-            now.strftime('%b %-d, %Y'),
-            now.strftime('%-I:%M %p'),
-        ), file=fout)
-        print('', file=fout)
-        print('Source directory: %s' % (source_dir_path,), file=fout)
-        print('Total size: %s' % (friendly_file_size(tree.filtered_size),), file=fout)
-        print('', file=fout)
-        print('A full list of files can be found in %s' % (FILE_LIST_NAME), file=fout)
+def write_readme(tree, fout, source_dir_path, snapshot=None):
+    print('Overview', file=fout)
+    print('========', file=fout)
+    print('', file=fout)
+    now = datetime.now()
+    print('Files in this directory were copied using backup.py on %s at %s.' % (
+        now.strftime('%b %-d, %Y'),
+        now.strftime('%-I:%M %p'),
+    ), file=fout)
+    print('', file=fout)
+    print('Source directory: %s' % (source_dir_path,), file=fout)
+    print('Total size: %s' % (friendly_file_size(tree.filtered_size),), file=fout)
+    print('', file=fout)
+    print('A full list of files can be found in %s' % (FILE_LIST_NAME), file=fout)
+    print('', file=fout)
+    if snapshot:
+        print('New files: %d (%s)' % (snapshot.new_files, friendly_file_size(snapshot.new_bytes)), file=fout)
+        if snapshot.previous_path:
+            print('Files hard-linked from snapshot %s: %d (%s)' % (
+                os.path.basename(snapshot.previous_path),
+                snapshot.linked_files,
+                friendly_file_size(snapshot.linked_bytes),
+            ), file=fout)
         print('', file=fout)
-        print('', file=fout)
-        print('File Notes', file=fout)
-        print('==========', file=fout)
-    path = ''
-    if parent_path is not None:
-        path = os.path.join(parent_path, tree.name)
-    if tree.notes and tree.filter != FILTER_EXCLUDE_ALL:
-        print('', file=fout)
-        print(path, file=fout)
-        print('', file=fout)
-        for line in tree.notes.split('\n'):
-            line = line.strip()
-            print('    ' + line, file=fout)
-    for child in tree.children:
-        write_readme(child, fout, None, path)
+    print('', file=fout)
+    print('File Notes', file=fout)
+    print('==========', file=fout)
+    for (node, path) in walk_tree(tree, prune=is_excluded):
+        if node.notes and node.filter != FILTER_EXCLUDE_ALL:
+            print('', file=fout)
+            print(path, file=fout)
+            print('', file=fout)
+            for line in node.notes.split('\n'):
+                line = line.strip()
+                print('    ' + line, file=fout)
+
+
+def is_linkable(path, st, previous_path):
+    # the test rsync --link-dest uses to decide a file or symlink can be shared with the previous
+    # snapshot; ownership only counts when it can be preserved.  Symlinks keep no mode or time, so
+    # theirs have to point at the same place.  Raises OSError when there's nothing at previous_path.
+    previous = os.lstat(previous_path)
+    if stat.S_IFMT(previous.st_mode) != stat.S_IFMT(st.st_mode):
+        return False
+    if os.geteuid() == 0 and (previous.st_uid, previous.st_gid) != (st.st_uid, st.st_gid):
+        return False
+    if stat.S_ISLNK(st.st_mode):
+        return os.readlink(previous_path) == os.readlink(path)
+    return stat.S_ISREG(st.st_mode) and (
+        previous.st_size == st.st_size and
+        int(previous.st_mtime) == int(st.st_mtime) and
+        stat.S_IMODE(previous.st_mode) == stat.S_IMODE(st.st_mode)
+    )
+
+
+def link_entry(src_path, dst_path):
+    # a hard link to src_path itself, even when it's a symlink
+    if os.link in getattr(os, 'supports_follow_symlinks', ()):
+        os.link(src_path, dst_path, follow_symlinks=False)
+    else:
+        os.link(src_path, dst_path)
+
+
+class Snapshot(object):
+    """
+    A dated directory per run under the destination.  Files that haven't changed since the
+    previous snapshot are hard-linked to it instead of being copied.  Until finish() the snapshot
+    is written under SNAPSHOT_UNFINISHED_SUFFIX, so a run that is cut short never becomes the
+    previous snapshot, and the next run carries on with it (and its copy checkpoint) instead of
+    starting a new one.
+    """
+
+    def __init__(self, dest_root, src_root):
+        names = sorted(
+            name for name in os.listdir(dest_root) if os.path.isdir(os.path.join(dest_root, name))
+        ) if os.path.isdir(dest_root) else []
+        finished = [name for name in names if SNAPSHOT_NAME_PATTERN.match(name)]
+        unfinished = [
+            name[:-len(SNAPSHOT_UNFINISHED_SUFFIX)] for name in names
+            if name.endswith(SNAPSHOT_UNFINISHED_SUFFIX) and
+            SNAPSHOT_NAME_PATTERN.match(name[:-len(SNAPSHOT_UNFINISHED_SUFFIX)])
+        ]
+        self.resumed = bool(unfinished)
+        name = unfinished[-1] if unfinished else datetime.now().strftime(SNAPSHOT_NAME_FORMAT)
+        self.name = name
+        self.path = os.path.join(dest_root, name + SNAPSHOT_UNFINISHED_SUFFIX)
+        self.previous_path = os.path.join(dest_root, finished[-1]) if finished else None
+        self.dest_root = dest_root
+        self.src_root = src_root
+        self.new_files = 0
+        self.new_bytes = 0
+        self.linked_files = 0
+        self.linked_bytes = 0
+
+    def file_status(self, relpath, size):
+        # predicts what rsync --link-dest will do with a file, counted at its size in the tree like
+        # the files of a native copy
+        path = os.path.join(self.src_root, relpath)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return SNAPSHOT_NEW
+        linked = False
+        if self.previous_path:
+            try:
+                linked = is_linkable(path, st, os.path.join(self.previous_path, relpath))
+            except OSError:
+                pass
+        return self.count(linked, size)
+
+    def count(self, linked, size):
+        if linked:
+            self.linked_files += 1
+            self.linked_bytes += size
+            return SNAPSHOT_LINKED
+        self.new_files += 1
+        self.new_bytes += size
+        return SNAPSHOT_NEW
+
+    def count_copied(self, counts, sizes):
+        # the totals of a native copy into the snapshot, from the tally copy_tree_native() returns.
+        # Files it found unchanged were copied into the snapshot by the run that was cut short.
+        self.new_files = counts[COPY_COPIED] + counts[COPY_UNCHANGED]
+        self.new_bytes = sizes[COPY_COPIED] + sizes[COPY_UNCHANGED]
+        self.linked_files = counts[COPY_LINKED]
+        self.linked_bytes = sizes[COPY_LINKED]
+
+    def finish(self):
+        path = os.path.join(self.dest_root, self.name)
+        os.rename(self.path, path)
+        self.path = path
 
 
 def show_file(path):
@@ -483,18 +3123,88 @@ def show_file(path):
         subprocess.call(["open", "-R", path])
 
 
-def copy_tree(tree, src_root, dst_root, exclusions_path):
-    if os.uname()[0] != 'Darwin':
-        raise NotImplementedError('Platform not supported')
+def escape_rsync_pattern(text, wildcards=False):
+    # rsync only treats backslashes as escapes in patterns that contain wildcards
+    if wildcards or any(c in text for c in '*?['):
+        return re.sub(r'([\\*?\[\]])', r'\\\1', text)
+    return text
+
+
+def collect_rsync_rules(tree, relpath, exclusions, inclusions, compact=False):
+    # exclusions are the top-most excluded entries, when compact with excluded siblings that share
+    # an extension collapsed into one wildcard when no other sibling matches it; inclusions are the
+    # top-most fully included entries.  Only partly included directories are looked into.
+    for (node, path) in walk_tree(tree, relpath, lambda node: node.filter != FILTER_PARTIAL):
+        if node.filter == FILTER_EXCLUDE_ALL:
+            # below the top, excluded entries are covered by their parent's rules
+            if path == relpath:
+                exclusions.append(escape_rsync_pattern(path))
+            continue
+        if node.filter == FILTER_INCLUDE_ALL:
+            inclusions.append(path[1:] if path != '/' else '.')
+            continue
+
+        children = node.children
+        groups = dict()
+        for child in children:
+            if child.filter == FILTER_EXCLUDE_ALL:
+                extension = os.path.splitext(child.name.rstrip('/'))[1]
+                groups.setdefault((child.is_directory, extension), []).append(child)
+
+        for (is_directory, extension), excluded in groups.items():
+            if compact and extension and len(excluded) > 1 and not any(
+                    child.filter != FILTER_EXCLUDE_ALL and fnmatch.fnmatchcase(child.name.rstrip('/'), '*' + extension)
+                    for child in children):
+                exclusions.append(escape_rsync_pattern(path, wildcards=True) + '*' +
+                                  escape_rsync_pattern(extension, wildcards=True) + ('/' if is_directory else ''))
+            else:
+                for child in excluded:
+                    exclusions.append(escape_rsync_pattern(path + child.name))
+
+
+def write_rsync_rules(tree, path, compact=False):
+    # writes an exclude list of exact paths, and returns the rsync arguments that use it.  When
+    # compact, its wildcards also exclude new files with the same extension, and a list of the
+    # included paths is written instead if that's shorter, which leaves out new files that aren't
+    # inside one of them.
+    exclusions = []
+    inclusions = []
+    collect_rsync_rules(tree, '/', exclusions, inclusions, compact)
+    if compact and len(inclusions) < len(exclusions):
+        with open(path, 'wb') as f:
+            for relpath in inclusions:
+                f.write(encode_text(relpath) + b'\0')
+        return ['--files-from=' + path, '--from0']
+    with open(path, 'wb') as f:
+        for pattern in exclusions:
+            f.write(encode_text(pattern) + b'\n')
+    return ['--exclude-from=' + path]
+
+
+def rsync_version():
+    # (major, minor), or None if it can't be told
+    try:
+        output = subprocess.check_output(['rsync', '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.search(br'version (\d+)\.(\d+)', output)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def parse_rsync_progress(line):
+    # returns (files, bytes) from a line of --info=progress2, or None for any other line
+    match = RSYNC_PROGRESS_PATTERN.match(line)
+    if not match:
+        return None
+    return int(match.group(2) or 0), int(match.group(1).replace(b',', b''))
 
-    with open(exclusions_path, 'w') as f:
-        def write_exclusions(tree, relpath='/'):
-            if tree.filter == FILTER_EXCLUDE_ALL:
-                print(relpath.replace('[', '\\[').replace(']', '\\]').replace('?', '\\?'), file=f)
-                return
-            for child in tree.children:
-                write_exclusions(child, os.path.join(relpath, child.name))
-        write_exclusions(tree)
+
+def copy_tree(tree, src_root, dst_root, exclusions_path, link_dest=None, bandwidth=None, compact_rules=False,
+              on_progress=None):
+    # on_progress(files, bytes) is called as rsync reports its progress, which needs rsync 3.1.
+    # Returns the files rsync transferred, or None if it didn't say.
+    rules = write_rsync_rules(tree, exclusions_path, compact_rules)
+    progress = on_progress is not None and (rsync_version() or (0, 0)) >= (3, 1)
 
     # -v, --verbose               increase verbosity
     # -r, --recursive             recurse into directories
@@ -508,51 +3218,1211 @@ def copy_tree(tree, src_root, dst_root, exclusions_path):
     #     --specials              preserve special files
     #     --safe-links            ignore symlinks that point outside the tree
     # -W, --whole-file            copy files whole (w/o delta-xfer algorithm)
+    #     --partial-dir=DIR       put a partially transferred file into DIR
+    #     --info=progress2        show total transfer progress
+
+    #     --bwlimit=RATE          limit socket I/O bandwidth (KiB per second)
+    #     --link-dest=DIR         hardlink to files in DIR when unchanged
+    #     --exclude-from=FILE     read exclude patterns from FILE
+    #     --files-from=FILE       read list of source-file names from FILE
+    # -0, --from0                 all *from/filter files are delimited by 0s
 
-    proc = subprocess.Popen([
-        'rsync',
-        '-vrlptgoD',
-        '--safe-links',
-        '--exclude-from=' + exclusions_path,
-        #'--whole-file',
-        src_root + '/',
-        dst_root + '/',
-    ])
+    try:
+        proc = subprocess.Popen([
+            'rsync',
+            '-vrlptgoD',
+            '--safe-links',
+            # a file cut off by a failure is kept, and the next run carries on from it
+            '--partial-dir=' + RSYNC_PARTIAL_DIR,
+            #'--whole-file',
+        ] + rules + (['--link-dest=' + link_dest] if link_dest else []) + (
+            ['--bwlimit=%d' % (max(1, bandwidth // 1024),)] if bandwidth else []) + (
+            ['--info=progress2'] if progress else []) + [
+            src_root + '/',
+            dst_root + '/',
+        ], stdout=subprocess.PIPE if progress else None)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        raise OSError('Copy failed!  rsync was not found (--copy-engine native needs no rsync)')
+    files = None
+    if progress:
+        # progress lines end in carriage returns; they're taken out of the output passed on
+        pending = b''
+        previous_end = b'\n'
+        while True:
+            data = os.read(proc.stdout.fileno(), 65536)
+            lines = re.split(br'([\r\n])', pending + (data if data or not pending else b'\n'))
+            pending = lines.pop()
+            for (line, end) in zip(lines[0::2], lines[1::2]):
+                parsed = parse_rsync_progress(line)
+                if parsed:
+                    files = parsed[0]
+                    on_progress(*parsed)
+                elif line or (end == b'\n' and previous_end == b'\n'):
+                    sys.stdout.write(line + b'\n')
+                previous_end = end
+            if not data:
+                break
+        sys.stdout.flush()
+        proc.stdout.close()
     ret = proc.wait()
     if ret != 0:
         raise OSError('Copy failed!  Return code = %d' % (ret,))
+    return files
+
+
+def is_safe_link(target, relpath):
+    # same rule as rsync --safe-links: absolute links, and relative links that climb out of the
+    # copied tree, are unsafe
+    if os.path.isabs(target):
+        return False
+    depth = relpath.count('/')
+    for part in target.split('/'):
+        if part == '..':
+            depth -= 1
+            if depth < 0:
+                return False
+        elif part and part != '.':
+            depth += 1
+    return True
+
+
+def load_kernel_copy_methods():
+    # kernel-side copies, in order of preference; each takes (in fd, out fd, count), advances the
+    # file positions and raises OSError.  Python 2's os has neither call, so there they're bound
+    # from libc through ctypes.
+    methods = []
+    libc = None
+    if not (hasattr(os, 'copy_file_range') and hasattr(os, 'sendfile')):
+        libc = load_libc()
+
+    def check(result):
+        if result < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return result
+
+    if hasattr(os, 'copy_file_range'):
+        methods.append(lambda infd, outfd, count: os.copy_file_range(infd, outfd, count))
+    elif libc is not None and hasattr(libc, 'copy_file_range'):
+        copy_file_range = libc.copy_file_range
+        copy_file_range.argtypes = (
+            ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)
+        copy_file_range.restype = ctypes.c_ssize_t
+        methods.append(lambda infd, outfd, count: check(copy_file_range(infd, None, outfd, None, count, 0)))
+    # sendfile takes other arguments elsewhere
+    linux = sys.platform.startswith('linux')
+    if linux and hasattr(os, 'sendfile'):
+        methods.append(lambda infd, outfd, count: os.sendfile(outfd, infd, None, count))
+    elif linux and libc is not None and hasattr(libc, 'sendfile'):
+        sendfile = libc.sendfile
+        sendfile.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t)
+        sendfile.restype = ctypes.c_ssize_t
+        methods.append(lambda infd, outfd, count: check(sendfile(outfd, infd, None, count)))
+    return methods
+
+
+KERNEL_COPY_METHODS = load_kernel_copy_methods()
+
+
+def copy_file_contents(fsrc, fdst, digest=None, throttle=None, on_progress=None):
+    # lets the kernel copy the data where possible, so it never passes through this process.  A
+    # digest is then taken from a second read of the source (by name) that follows the copy, mostly
+    # out of the page cache, so it describes the source as read rather than what reached fdst.
+    # Without a kernel copy the data is hashed on the way through.  With a throttle, every chunk
+    # waits for its share of the budget.  on_progress(bytes copied) is called after every chunk.
+    # Copies from the files' current positions.
+    copied = 0
+    fhash = None
+    try:
+        for method in KERNEL_COPY_METHODS:
+            try:
+                while True:
+                    if digest is not None and fhash is None:
+                        fhash = open(fsrc.name, 'rb')
+                        fhash.seek(fsrc.tell())
+                    n = method(fsrc.fileno(), fdst.fileno(), COPY_CHUNK_SIZE)
+                    if n <= 0:
+                        return
+                    copied += n
+                    if fhash is not None:
+                        digest.update(fhash.read(n))
+                    if throttle:
+                        throttle.take(n)
+                    if on_progress:
+                        on_progress(copied)
+            except OSError as e:
+                if copied or e.errno not in KERNEL_COPY_UNSUPPORTED:
+                    raise
+    finally:
+        if fhash is not None:
+            fhash.close()
+    while True:
+        data = fsrc.read(COPY_CHUNK_SIZE)
+        if not data:
+            return
+        if throttle:
+            throttle.take(len(data))
+        if digest is not None:
+            digest.update(data)
+        fdst.write(data)
+        copied += len(data)
+        if on_progress:
+            on_progress(copied)
+
+
+def copy_metadata(path, st, current=None):
+    # -o, -g, -p and -t.  Ownership changes that aren't permitted are skipped, like rsync does
+    # for non-super-users.
+    is_link = stat.S_ISLNK(st.st_mode)
+    uid = st.st_uid if os.geteuid() == 0 else -1
+    if current is None or (uid != -1 and current.st_uid != uid) or current.st_gid != st.st_gid:
+        try:
+            os.lchown(path, uid, st.st_gid)
+        except OSError as e:
+            if e.errno != errno.EPERM:
+                raise
+    if is_link:
+        return
+    if current is None or stat.S_IMODE(current.st_mode) != stat.S_IMODE(st.st_mode):
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+    if current is None or current.st_mtime != st.st_mtime:
+        os.utime(path, (st.st_atime, st.st_mtime))
+
+
+def hash_contents(f, digest):
+    # from the start of an open file to its end
+    f.seek(0)
+    while True:
+        data = f.read(COPY_CHUNK_SIZE)
+        if not data:
+            return
+        digest.update(data)
+
+
+def file_list_row_path(tree, relpath):
+    # FILES.csv paths are the exact utf-8 (or, for names that aren't utf-8, file system) bytes,
+    # with a trailing slash on directories
+    if tree.is_directory and relpath:
+        relpath += '/'
+    return encode_text(relpath)
+
+
+def load_file_hashes(path, hash_name):
+    # hashes recorded by an earlier run, so files that aren't copied this time keep theirs.  Lists
+    # written before paths were exact turned every non-ascii character into "?", so a path that
+    # turns up twice is left out, and those files are hashed again.
+    hashes = dict()
+    ambiguous = set()
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            reader = DictReader(f)
+            if hash_name in (reader.fieldnames or ()):
+                for row in reader:
+                    if row['is_directory'] != 'True':
+                        if row['path'] in hashes:
+                            ambiguous.add(row['path'])
+                        hashes[row['path']] = row[hash_name]
+    for relpath in ambiguous:
+        del hashes[relpath]
+    return hashes
+
+
+def partial_path(dst_path):
+    # where a file is written until it's complete
+    return os.path.join(os.path.dirname(dst_path), '.%s.partial' % (os.path.basename(dst_path),))
+
+
+def remove_existing(path, current):
+    if current is None:
+        return
+    if stat.S_ISDIR(current.st_mode):
+        raise OSError(errno.EISDIR, 'Directory in the way', path)
+    os.remove(path)
+
+
+def copy_entry(src_path, dst_path, relpath, link_path=None, hash_name=None, known_digest=None, throttle=None,
+               checkpoint=None):
+    # returns (status, bytes copied, hex digest of the file's contents if hash_name is given).
+    # Files that are linked or unchanged aren't read again; they keep known_digest, the hash an
+    # earlier run recorded, if any.  With a CopyCheckpoint, a .partial file left by an interrupted copy is carried on from.
+    st = os.lstat(src_path)
+    try:
+        current = os.lstat(dst_path)
+    except OSError:
+        current = None
+
+    if link_path and (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+        try:
+            if is_linkable(src_path, st, link_path):
+                remove_existing(dst_path, current)
+                link_entry(link_path, dst_path)
+                return COPY_LINKED, 0, known_digest
+        except OSError as e:
+            # some file systems can't hard-link symlinks; those are made again instead
+            if e.errno not in (errno.ENOENT, errno.EMLINK) and not (
+                    stat.S_ISLNK(st.st_mode) and e.errno in (errno.EPERM, errno.EOPNOTSUPP)):
+                raise
+
+    if stat.S_ISREG(st.st_mode):
+        if (current is not None and stat.S_ISREG(current.st_mode) and current.st_size == st.st_size
+                and int(current.st_mtime) == int(st.st_mtime)):
+            copy_metadata(dst_path, st, current)
+            if checkpoint:
+                known_digest = checkpoint.finished(relpath, st, hash_name) or known_digest
+            return COPY_UNCHANGED, 0, known_digest
+        temp_path = partial_path(dst_path)
+        digest = hashlib.new(hash_name) if hash_name else None
+        offset = checkpoint.resume(relpath, st, temp_path) if checkpoint else 0
+        saved = [offset]
+        try:
+            with open(src_path, 'rb') as fsrc:
+                with open(temp_path, 'r+b' if offset else 'wb') as fdst:
+                    on_progress = None
+                    if offset:
+                        # what's already there only has to be read back for the digest
+                        fdst.truncate(offset)
+                        if digest is not None:
+                            hash_contents(fdst, digest)
+                        fdst.seek(offset)
+                        fsrc.seek(offset)
+                    if checkpoint and st.st_size - offset > COPY_CHECKPOINT_BYTES:
+
+                        def on_progress(copied):
+                            position = offset + copied
+                            if position - saved[0] >= COPY_CHECKPOINT_BYTES:
+                                # the data has to be on disk before the checkpoint says so
+                                fdst.flush()
+                                os.fsync(fdst.fileno())
+                                checkpoint.record(relpath, st, offset=position)
+                                saved[0] = position
+                    copy_file_contents(fsrc, fdst, digest, throttle, on_progress)
+        except EnvironmentError:
+            # kept only when the checkpoint says how much of it the next copy can carry on from
+            if not saved[0]:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            raise
+        copy_metadata(temp_path, st)
+        remove_existing(dst_path, current)
+        os.rename(temp_path, dst_path)
+        hex_digest = digest.hexdigest() if digest else None
+        if checkpoint:
+            checkpoint.record(relpath, st, digest=hex_digest, hash_name=hash_name)
+        return COPY_COPIED, st.st_size - offset, hex_digest
+
+    if stat.S_ISLNK(st.st_mode):
+        target = os.readlink(src_path)
+        if not is_safe_link(target, relpath):
+            return COPY_IGNORED, 0, None
+        if current is not None and stat.S_ISLNK(current.st_mode) and os.readlink(dst_path) == target:
+            return COPY_UNCHANGED, 0, None
+        remove_existing(dst_path, current)
+        os.symlink(target, dst_path)
+        copy_metadata(dst_path, st)
+        return COPY_COPIED, 0, None
+
+    if stat.S_ISDIR(st.st_mode):
+        # was a file when the tree was scanned
+        return COPY_IGNORED, 0, None
+
+    # devices, fifos and sockets (-D)
+    if (current is not None and stat.S_IFMT(current.st_mode) == stat.S_IFMT(st.st_mode)
+            and current.st_rdev == st.st_rdev):
+        copy_metadata(dst_path, st, current)
+        return COPY_UNCHANGED, 0, None
+    remove_existing(dst_path, current)
+    os.mknod(dst_path, st.st_mode, st.st_rdev)
+    copy_metadata(dst_path, st)
+    return COPY_COPIED, 0, None
+
+
+def run_copy_job(job):
+    (tree, relpath, src_path, dst_path, link_path, hash_name, known_digest, throttle, checkpoint, result) = job
+    if result is not None:
+        return result
+    try:
+        # every entry costs an operation, whether or not it's copied
+        if throttle:
+            throttle.take(0)
+        status, size, digest = copy_entry(
+            src_path, dst_path, relpath, link_path, hash_name, known_digest, throttle, checkpoint)
+        return tree, relpath, status, size, digest, None
+    except EnvironmentError as e:
+        if e.errno == errno.ENOENT and not os.path.lexists(src_path):
+            return tree, relpath, COPY_VANISHED, 0, None, None
+        return tree, relpath, COPY_FAILED, 0, None, str(e)
+    except UnicodeError as e:
+        return tree, relpath, COPY_FAILED, 0, None, str(e)
+
+
+def iter_copy_jobs(tree, src_root, dst_root, directories, link_dest=None, hash_name=None, known_hashes=None,
+                   throttle=None, checkpoint=None):
+    # runs on the pool's task thread.  Directories are created here, before any of their contents
+    # are handed to a worker.  Problems with an entry come back as its result rather than being
+    # raised, since an exception here would end the pool's input early.  Directories that couldn't
+    # be made aren't looked into.
+    unmade = set()
+    for (tree, relpath) in walk_tree(tree, prune=lambda node: is_excluded(node) or node in unmade):
+        if tree.filter == FILTER_EXCLUDE_ALL:
+            continue
+        if tree.is_directory:
+            relpath = relpath[:-1]
+        src_path = dst_path = link_path = known_digest = None
+        result = None
+        try:
+            src_path = os.path.join(src_root, relpath)
+            dst_path = os.path.join(dst_root, relpath)
+            if tree.is_directory:
+                try:
+                    st = os.lstat(src_path)
+                    if stat.S_ISDIR(st.st_mode):
+                        try:
+                            current = os.lstat(dst_path)
+                        except OSError:
+                            current = None
+                        if current is None or not stat.S_ISDIR(current.st_mode):
+                            remove_existing(dst_path, current)
+                            os.mkdir(dst_path)
+                        directories.append((dst_path, st))
+                        result = (tree, relpath, COPY_DIRECTORY, 0, None, None)
+                    else:
+                        unmade.add(tree)
+                except EnvironmentError as e:
+                    unmade.add(tree)
+                    if e.errno == errno.ENOENT and not os.path.lexists(src_path):
+                        result = (tree, relpath, COPY_VANISHED, 0, None, None)
+                    else:
+                        result = (tree, relpath, COPY_FAILED, 0, None, str(e))
+            link_path = os.path.join(link_dest, relpath) if link_dest else None
+            known_digest = known_hashes.get(file_list_row_path(tree, relpath)) if known_hashes else None
+        except UnicodeError as e:
+            # a name the file system encoding can't hold
+            unmade.add(tree)
+            result = (tree, relpath, COPY_FAILED, 0, None, str(e))
+        yield (tree, relpath, src_path, dst_path, link_path, hash_name, known_digest, throttle, checkpoint, result)
+
+
+class Throttle(object):
+    """
+    Token buckets for bytes and I/O operations per second, shared by the copy workers.  A taker
+    goes into debt for what it takes and sleeps it off, so takers are served in turn and chunks
+    bigger than a second's budget still get through.
+    """
+
+    def __init__(self, bytes_per_second=None, operations_per_second=None):
+        self.__rates = (bytes_per_second, operations_per_second)
+        # up to a second's worth can be used in a burst
+        self.__levels = [rate or 0 for rate in self.__rates]
+        self.__time = time.time()
+        self.__lock = threading.Lock()
+        self.waited = 0.0
+
+    def take(self, size, operations=1):
+        with self.__lock:
+            now = time.time()
+            elapsed = now - self.__time
+            self.__time = now
+            wait = 0
+            for (i, (rate, amount)) in enumerate(zip(self.__rates, (size, operations))):
+                if rate:
+                    self.__levels[i] = min(rate, self.__levels[i] + elapsed * rate) - amount
+                    wait = max(wait, -self.__levels[i] / rate)
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledFile(object):
+    """
+    A file read within a Throttle's byte budget, for readers such as tarfile that take a file.
+    Reads cost no operations.
+    """
+
+    def __init__(self, f, throttle):
+        self.__file = f
+        self.__throttle = throttle
+
+    def read(self, size=-1):
+        data = self.__file.read(size)
+        if data:
+            self.__throttle.take(len(data), operations=0)
+        return data
+
+
+class CopyCheckpoint(object):
+    """
+    Progress of a native copy, kept in the job so a copy cut short by a failure or a reboot can
+    carry on: one JSON object per line for every file copied and, for large files, for every
+    COPY_CHECKPOINT_BYTES written to its .partial file.  The first line names the destination, and
+    a checkpoint for another destination is started over.  Counts what this copy resumed and what
+    it had to copy again.
+    """
+
+    def __init__(self, path, dst_root):
+        self.path = path
+        self.resumed_files = 0
+        self.resumed_bytes = 0
+        self.recopied_files = 0
+        self.recopied_bytes = 0
+        self.finished_files = 0
+        self.swept_files = 0
+        self.__previous = dict()
+        self.__carried_on = set()
+        self.__lock = threading.Lock()
+        dest = decode_text(encode_text(dst_root))
+        if os.path.exists(path) and self.__load(dest):
+            # carried on, so records of files this copy doesn't get to aren't lost
+            self.__file = open(path, 'ab')
+        else:
+            self.__file = open(path, 'wb')
+            self.__write(dict(dest=dest))
+
+    def __load(self, dest):
+        # returns whether the checkpoint is for this destination
+        records = read_json_lines(self.path)
+        for record in records:
+            if 'dest' in record:
+                if record['dest'] != dest:
+                    return False
+                continue
+            self.__previous[record['path']] = record
+        return len(records) > 0
+
+    @staticmethod
+    def __key(relpath):
+        return relpath if isinstance(relpath, type(u'')) else decode_text(relpath)
+
+    def __write(self, record):
+        with self.__lock:
+            self.__file.write((json.dumps(record, sort_keys=True) + '\n').encode('utf-8'))
+            self.__file.flush()
+
+    def __matching(self, relpath, st):
+        record = self.__previous.get(CopyCheckpoint.__key(relpath))
+        if record and record['size'] == st.st_size and record['mtime'] == st.st_mtime:
+            return record
+        return None
+
+    def record(self, relpath, st, offset=None, digest=None, hash_name=None):
+        # a file written up to offset, or copied in full
+        record = dict(path=CopyCheckpoint.__key(relpath), size=st.st_size, mtime=st.st_mtime)
+        if offset is not None:
+            record['offset'] = offset
+        elif digest:
+            record[hash_name] = digest
+        self.__write(record)
+
+    def finished(self, relpath, st, hash_name=None):
+        # for a file found already copied; returns its digest if the previous copy recorded one
+        record = self.__matching(relpath, st)
+        if not record or 'offset' in record:
+            return None
+        with self.__lock:
+            self.finished_files += 1
+        return record.get(hash_name) if hash_name else None
+
+    def resume(self, relpath, st, partial_path):
+        # returns how much of a .partial file left by the previous copy can be kept
+        record = self.__previous.get(CopyCheckpoint.__key(relpath))
+        if not record or 'offset' not in record:
+            return 0
+        try:
+            partial_size = os.path.getsize(partial_path)
+        except OSError:
+            partial_size = -1
+        usable = self.__matching(relpath, st) is not None and partial_size >= record['offset']
+        with self.__lock:
+            self.__carried_on.add(CopyCheckpoint.__key(relpath))
+            if usable:
+                self.resumed_files += 1
+                self.resumed_bytes += record['offset']
+            else:
+                self.recopied_files += 1
+                self.recopied_bytes += record['offset']
+        return record['offset'] if usable else 0
+
+    def sweep(self, dst_root):
+        # once a copy has gone through, removes the .partial files the previous one left that this
+        # one had no use for, such as those of files excluded or gone since
+        for (key, record) in self.__previous.items():
+            if 'offset' in record and key not in self.__carried_on:
+                try:
+                    os.remove(partial_path(os.path.join(dst_root, encode_text(key))))
+                    self.swept_files += 1
+                except OSError:
+                    pass
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def clear(self):
+        # the copy completed
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def copy_tree_native(
+        tree,
+        src_root,
+        dst_root,
+        workers=DEFAULT_COPY_WORKERS,
+        link_dest=None,
+        hash_name=None,
+        known_hashes=None,
+        on_copied=None,
+        throttle=None,
+        checkpoint=None):
+    # copies the included part of the tree the way `rsync -rlptgoD --safe-links` would, on a pool
+    # of worker threads, skipping files whose size and modification time already match.  With
+    # link_dest, unchanged files are hard-linked from there (like rsync --link-dest).
+    #
+    # Returns the number of entries with each status, the size of the files (symlinks and devices
+    # included) with each status, and the bytes actually written.
+    #
+    # on_copied(tree, relpath, status, digest) is called on this thread for every entry, in tree
+    # order, as soon as it has been copied.  With hash_name, digest is the file's content hash;
+    # files that aren't copied take theirs from known_hashes, keyed by FILES.csv path.  A Throttle
+    # is shared by all the workers.  A CopyCheckpoint records progress as files are copied and
+    # lets this copy carry on from an interrupted one; the .partial files that one left and this
+    # one didn't need are removed once it has gone through.
+    counts = dict((status, 0) for status in COPY_STATUSES)
+    sizes = dict((status, 0) for status in COPY_STATUSES)
+    copied_bytes = 0
+    errors = []
+    directories = []
+    # pool.imap() quietly stops taking jobs when the generator feeding it raises, so anything
+    # raised there is kept and raised once the pool has finished
+    listing = dict(error=None)
+
+    def jobs():
+        try:
+            for job in iter_copy_jobs(
+                    tree, src_root, dst_root, directories, link_dest, hash_name, known_hashes, throttle, checkpoint):
+                yield job
+        except Exception as e:
+            listing['error'] = e
+
+    pool = ThreadPool(workers)
+    try:
+        for (node, relpath, status, size, digest, error) in pool.imap(run_copy_job, jobs(), COPY_JOBS_PER_TASK):
+            counts[status] += 1
+            if not node.is_directory:
+                sizes[status] += node.size
+            copied_bytes += size
+            if on_copied:
+                on_copied(node, relpath, status, digest)
+            if status == COPY_FAILED:
+                errors.append((relpath, error))
+                print('Could not copy %s: %s' % (relpath, error), file=sys.stderr)
+            elif status == COPY_VANISHED:
+                print('File vanished: %s' % (relpath,), file=sys.stderr)
+    finally:
+        pool.close()
+        pool.join()
+    if listing['error'] is not None:
+        raise listing['error']
+
+    # directory times are set last, since copying into a directory changes its modification time
+    for (dst_path, st) in reversed(directories):
+        try:
+            copy_metadata(dst_path, st)
+        except EnvironmentError as e:
+            errors.append((dst_path, str(e)))
+
+    if errors:
+        raise OSError('Copy failed!  %d errors' % (len(errors),))
+    if checkpoint:
+        checkpoint.sweep(dst_root)
+    return counts, sizes, copied_bytes
+
+
+def plan_archive_chunks(tree, src_root, dst_root, compression, chunk_size):
+    # splits the included part of the tree into archives in tree order, starting a new archive once
+    # the files in the current one add up to chunk_size.  Runs before any archive is written, so
+    # that nothing can fail inside the pool's input.  Links to directories are archived as links,
+    # without the contents they lead to.  Returns ([(archive path, src_root, compression,
+    # [relpath])], [(relpath, error)]).
+    suffix = ARCHIVE_COMPRESSIONS[compression]
+    chunks = []
+    failed = []
+    relpaths = []
+    size = 0
+    link = None
+    for (node, relpath) in walk_tree(tree, prune=is_excluded):
+        if not relpath or node.filter == FILTER_EXCLUDE_ALL:
+            continue
+        if link and relpath.startswith(link):
+            continue
+        name = relpath[:-1] if node.is_directory else relpath
+        if node.is_directory:
+            try:
+                if os.path.islink(os.path.join(src_root, name)):
+                    link = relpath
+            except UnicodeError as e:
+                failed.append((name, str(e)))
+                link = relpath
+                continue
+        relpaths.append(name)
+        if not node.is_directory:
+            size += node.size
+        if size >= chunk_size:
+            chunks.append((os.path.join(dst_root, ARCHIVE_NAME_FORMAT % (len(chunks),) + suffix),
+                           src_root, compression, relpaths))
+            relpaths = []
+            size = 0
+    if relpaths:
+        chunks.append((os.path.join(dst_root, ARCHIVE_NAME_FORMAT % (len(chunks),) + suffix),
+                       src_root, compression, relpaths))
+    return chunks, failed
+
+
+def write_archive_chunk(job):
+    # runs on a worker thread; the compressors release the GIL, so chunks compress in parallel.
+    # Returns the archive path, its (relpath, offset, size) index rows, the relpaths of entries
+    # that vanished or that tar can't hold (sockets and the like), (relpath, error) for entries
+    # that couldn't be read, and the archive's size.  The archive only takes its name once complete.
+    # on_entry(size) is called as each entry is written.  With a throttle, every entry costs an
+    # operation and its data is read within the byte budget.
+    (path, src_root, compression, relpaths, on_entry, throttle) = job
+    rows = []
+    skipped = []
+    failed = []
+    partial_path = path + '.partial'
+    archive = tarfile.open(partial_path, 'w:' + ARCHIVE_COMPRESSIONS[compression], encoding='utf-8')
+    try:
+        for relpath in relpaths:
+            offset = archive.offset
+            src_path = None
+            try:
+                src_path = os.path.join(src_root, relpath)
+                # every file is written in full, even a second name of one already in the archive,
+                # since a link member can't be extracted on its own
+                archive.inodes.clear()
+                if throttle:
+                    throttle.take(0)
+                info = archive.gettarinfo(src_path, arcname=relpath)
+                source = open(src_path, 'rb') if info is not None and info.isreg() else None
+            except EnvironmentError as e:
+                # nothing has been written for an entry that can't be opened
+                if e.errno == errno.ENOENT and not os.path.lexists(src_path):
+                    skipped.append(relpath)
+                else:
+                    failed.append((relpath, str(e)))
+                continue
+            except UnicodeError as e:
+                failed.append((relpath, str(e)))
+                continue
+            if info is None:
+                skipped.append(relpath)
+                continue
+            try:
+                archive.addfile(info, ThrottledFile(source, throttle) if source and throttle else source)
+            finally:
+                if source:
+                    source.close()
+            rows.append((relpath, offset, info.size))
+            if on_entry:
+                on_entry(info.size)
+    finally:
+        archive.close()
+    os.rename(partial_path, path)
+    return path, rows, skipped, failed, os.path.getsize(path)
+
+
+def archive_tree(tree, src_root, dst_root, compression, chunk_size, workers=DEFAULT_COPY_WORKERS, index_writer=None,
+                 on_progress=None, throttle=None):
+    # writes the included part of the tree to dst_root as tar archives of about chunk_size each,
+    # one worker per archive, and the index of where each entry went to index_writer as archives
+    # complete, in tree order.  on_progress(entries, bytes) is called, one worker at a time, as
+    # each entry is archived.  Archives left over from an earlier, larger run are removed once
+    # every entry has been accounted for.  Returns (archives, entries, bytes of the entries,
+    # archived bytes).
+    (chunks, errors) = plan_archive_chunks(tree, src_root, dst_root, compression, chunk_size)
+    on_entry = None
+    if on_progress:
+        progress = [0, 0]
+        lock = threading.Lock()
+
+        def on_entry(size):
+            with lock:
+                progress[0] += 1
+                progress[1] += size
+                on_progress(*progress)
+    for (relpath, error) in errors:
+        print('Could not archive %s: %s' % (relpath, error), file=sys.stderr)
+    planned = sum(len(relpaths) for (path, root, name, relpaths) in chunks)
+    accounted = 0
+    written = set()
+    entries = 0
+    entry_bytes = 0
+    archived_bytes = 0
+    pool = ThreadPool(workers)
+    try:
+        jobs = [chunk + (on_entry, throttle) for chunk in chunks]
+        for (path, rows, skipped, failed, size) in pool.imap(write_archive_chunk, jobs):
+            written.add(os.path.basename(path))
+            entries += len(rows)
+            entry_bytes += sum(member_size for (relpath, offset, member_size) in rows)
+            accounted += len(rows) + len(skipped) + len(failed)
+            archived_bytes += size
+            for relpath in skipped:
+                print('Skipped %s (vanished, or not a file tar can hold)' % (relpath,), file=sys.stderr)
+            for (relpath, error) in failed:
+                errors.append((relpath, error))
+                print('Could not archive %s: %s' % (relpath, error), file=sys.stderr)
+            if index_writer:
+                for (relpath, offset, member_size) in rows:
+                    index_writer.writerow(dict(
+                        path=encode_text(relpath),
+                        archive=os.path.basename(path),
+                        offset=offset,
+                        size=member_size,
+                    ))
+    finally:
+        pool.close()
+        pool.join()
+
+    if errors or accounted != planned:
+        raise OSError('Archive failed!  %d errors, %d of %d entries accounted for' % (
+            len(errors), accounted, planned))
+    for name in os.listdir(dst_root):
+        if ARCHIVE_NAME_PATTERN.match(name) and name not in written:
+            os.remove(os.path.join(dst_root, name))
+    return len(written), entries, entry_bytes, archived_bytes
+
+
+def extract_archived(archive_root, relpath, dst_root):
+    # restores one entry using the index, decompressing its archive only as far as the entry
+    relpath = encode_text(relpath.strip('/'))
+    with open(os.path.join(archive_root, ARCHIVE_INDEX_NAME), 'rb') as f:
+        for row in DictReader(f):
+            if encode_text(row['path']) == relpath:
+                break
+        else:
+            raise KeyError('%s is not in the archives in %s' % (decode_text(relpath), archive_root))
+    archive = tarfile.open(os.path.join(archive_root, row['archive']), 'r:*', encoding='utf-8')
+    try:
+        # seeking the decompressed stream skips the entries before this one without parsing them
+        archive.fileobj.seek(int(row['offset']))
+        entry = tarfile.open(fileobj=archive.fileobj, mode='r:', encoding='utf-8')
+        member = entry.next()
+        if member is None or encode_text(member.name) != relpath:
+            raise ValueError('%s has no entry for %s at offset %s' % (
+                row['archive'], decode_text(relpath), row['offset']))
+        entry.extract(member, dst_root)
+    finally:
+        archive.close()
+    return member
+
+
+def hash_mapped_file(path, hash_name):
+    digest = hashlib.new(hash_name)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in range(0, size, COPY_CHUNK_SIZE):
+                    digest.update(mapped[offset:offset + COPY_CHUNK_SIZE])
+            finally:
+                mapped.close()
+    return digest.hexdigest(), size
+
+
+def verify_entry(job):
+    # returns (relpath, problem or None, bytes hashed)
+    (relpath, src_path, dst_path, mode, hash_name, expected_digest) = job
+    hashed = 0
+    try:
+        if mode != VERIFY_HASHES and os.path.islink(src_path) and not is_safe_link(os.readlink(src_path), relpath):
+            # never copied
+            return relpath, None, hashed
+
+        try:
+            dst_st = os.lstat(dst_path)
+        except OSError:
+            if mode == VERIFY_HASHES and expected_digest is None:
+                # not listed in FILES.csv, so it was never copied
+                return relpath, None, hashed
+            return relpath, 'missing from destination', hashed
+
+        if mode == VERIFY_HASHES:
+            if not stat.S_ISREG(dst_st.st_mode):
+                return relpath, None, hashed
+            if not expected_digest:
+                return relpath, 'no recorded hash', hashed
+            digest, hashed = hash_mapped_file(dst_path, hash_name)
+            return relpath, None if digest == expected_digest else 'content differs from recorded hash', hashed
+
+        try:
+            src_st = os.lstat(src_path)
+        except OSError:
+            return relpath, 'missing from source', hashed
+        if stat.S_IFMT(src_st.st_mode) != stat.S_IFMT(dst_st.st_mode):
+            return relpath, 'file type differs', hashed
+        if stat.S_ISLNK(src_st.st_mode):
+            if os.readlink(src_path) != os.readlink(dst_path):
+                return relpath, 'link target differs', hashed
+            return relpath, None, hashed
+        if not stat.S_ISREG(src_st.st_mode):
+            return relpath, None, hashed
+        if src_st.st_size != dst_st.st_size:
+            return relpath, 'size differs', hashed
+        if int(src_st.st_mtime) != int(dst_st.st_mtime):
+            return relpath, 'modification time differs', hashed
+        if mode == VERIFY_CONTENT:
+            src_digest, src_size = hash_mapped_file(src_path, hash_name)
+            dst_digest, dst_size = hash_mapped_file(dst_path, hash_name)
+            hashed = src_size + dst_size
+            if src_digest != dst_digest:
+                return relpath, 'content differs', hashed
+        return relpath, None, hashed
+    except (EnvironmentError, UnicodeError) as e:
+        return relpath, str(e), hashed
+
+
+def list_verify_jobs(tree, src_root, dst_root, mode, hash_name, expected_hashes):
+    # lists every job before any is handed to the pool, since an exception inside the pool's input
+    # can leave it waiting forever.  Returns the jobs and (relpath, error) for entries that
+    # couldn't be listed.
+    jobs = []
+    errors = []
+    # directories that aren't looked into: links to directories, which are copied as links and
+    # checked as one, and directories whose paths can't be made
+    skipped = set()
+    for (tree, relpath) in walk_tree(tree, prune=lambda node: is_excluded(node) or node in skipped):
+        if tree.filter == FILTER_EXCLUDE_ALL:
+            continue
+        if tree.is_directory:
+            relpath = relpath[:-1]
+        try:
+            src_path = os.path.join(src_root, relpath)
+            if tree.is_directory:
+                if os.path.islink(src_path):
+                    skipped.add(tree)
+                else:
+                    continue
+            # keyed on the exact FILES.csv path, so names that differ only outside ascii don't collide
+            expected_digest = expected_hashes.get(file_list_row_path(tree, relpath)) if expected_hashes else None
+            jobs.append((
+                relpath,
+                src_path,
+                os.path.join(dst_root, relpath),
+                mode,
+                hash_name,
+                expected_digest,
+            ))
+        except UnicodeError as e:
+            skipped.add(tree)
+            errors.append((relpath, str(e)))
+    return jobs, errors
+
+
+def verify_tree(tree, src_root, dst_root, mode=VERIFY_QUICK, hash_name=DEFAULT_HASH_NAME, workers=None,
+                on_mismatch=None):
+    # compares the included files of the tree with a finished backup.  Quick checks compare size
+    # and modification time; content checks also hash both copies, and hash checks compare the
+    # destination with the hashes recorded in its FILES.csv without reading the source.  Hashing
+    # is spread over worker processes.
+    expected_hashes = None
+    if mode == VERIFY_HASHES:
+        expected_hashes = load_file_hashes(os.path.join(dst_root, FILE_LIST_NAME), hash_name)
+    (jobs, errors) = list_verify_jobs(tree, src_root, dst_root, mode, hash_name, expected_hashes)
+    checked = 0
+    mismatches = 0
+    hashed_bytes = 0
+    for (relpath, error) in errors:
+        # entries that can't be checked count against the backup
+        mismatches += 1
+        if on_mismatch:
+            on_mismatch(relpath, 'could not be checked: %s' % (error,))
+    workers = workers or cpu_count()
+    pool = ThreadPool(workers) if mode == VERIFY_QUICK else Pool(workers)
+    try:
+        for (relpath, problem, hashed) in pool.imap_unordered(verify_entry, jobs, VERIFY_JOBS_PER_TASK):
+            checked += 1
+            hashed_bytes += hashed
+            if problem:
+                mismatches += 1
+                if on_mismatch:
+                    on_mismatch(relpath, problem)
+    finally:
+        pool.close()
+        pool.join()
+    return checked, mismatches, hashed_bytes
+
+
+def write_json(path, data):
+    # replaces the file in one step, so readers never see a partial report
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2, separators=(',', ': '), sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def cpu_time():
+    # includes waited-for child processes, so rsync and the hashing pool are counted too
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RunReport(object):
+    """
+    Machine-readable record of a run.  Each phase gets its wall and cpu time, files and bytes
+    processed, rates and peak memory; the report is rewritten as phases end and, at most every
+    few seconds, as copy progress comes in.  Finished runs are also appended to a history file
+    next to it, one JSON object per line.
+
+    Phases can overlap, as a background scan does with the chooser; end() ends the phase begun
+    most recently.
+    """
+
+    def __init__(self, path=None, history_path=None):
+        self.__path = path
+        self.__history_path = history_path
+        self.__phases = []
+        self.__saved_time = 0
+        self.data = dict(
+            started=datetime.now().isoformat(),
+            finished=None,
+            arguments=sys.argv[1:],
+            phases=[],
+            progress=None,
+        )
+
+    def begin(self, name):
+        self.__phases.append(dict(name=name, wall=time.time(), cpu=cpu_time()))
+        self.data['progress'] = None
+
+    def end(self, files=None, bytes=None, **counters):
+        # returns the wall time of the phase
+        started = self.__phases.pop()
+        wall = time.time() - started['wall']
+        phase = dict(
+            name=started['name'],
+            wall_seconds=wall,
+            cpu_seconds=cpu_time() - started['cpu'],
+            files=files,
+            bytes=bytes,
+            files_per_second=files / max(wall, 0.001) if files is not None else None,
+            mb_per_second=bytes / max(wall, 0.001) / (1024 * 1024) if bytes is not None else None,
+            peak_rss_bytes=peak_rss(),
+        )
+        phase.update(counters)
+        self.data['phases'].append(phase)
+        self.save()
+        return wall
+
+    def progress(self, files, bytes, total_bytes=None):
+        started = self.__phases[-1]
+        wall = time.time() - started['wall']
+        self.data['progress'] = dict(
+            phase=started['name'],
+            wall_seconds=wall,
+            files=files,
+            bytes=bytes,
+            total_bytes=total_bytes,
+            files_per_second=files / max(wall, 0.001),
+            mb_per_second=bytes / max(wall, 0.001) / (1024 * 1024),
+        )
+        if time.time() - self.__saved_time >= RUN_PROGRESS_INTERVAL:
+            self.save()
+
+    def finish(self):
+        self.data['finished'] = datetime.now().isoformat()
+        self.data['progress'] = None
+        self.save()
+        if self.__history_path:
+            with open(self.__history_path, 'a') as f:
+                f.write(json.dumps(self.data, sort_keys=True) + '\n')
+
+    def save(self):
+        self.__saved_time = time.time()
+        if self.__path:
+            write_json(self.__path, self.data)
 
 
 if __name__ == '__main__':
     (options, args) = parse_command_line()
 
+    if options.extract_path:
+        start_time = time.time()
+        member = extract_archived(os.path.abspath(args[0]), options.extract_path, os.path.abspath(args[1]))
+        print('Restored %s (%s)' % (member.name, friendly_file_size(member.size)))
+        print('Completed in %.1f seconds' % (time.time() - start_time,))
+        sys.exit(0)
+
     tree_file_path = None
     file_list_path = None
+    journal = None
+    report = RunReport()
     if options.job_path:
         if not os.path.exists(options.job_path):
             os.makedirs(options.job_path)
-        tree_file_path = os.path.join(options.job_path, 'tree.dat')
+        if options.tree_backend == 'sqlite':
+            # the database is written as edits are made, so needs no journal
+            tree_file_path = os.path.join(options.job_path, SQLITE_TREE_NAME)
+        else:
+            tree_file_path = os.path.join(options.job_path, 'tree.dat')
+            journal = TreeJournal(tree_file_path + JOURNAL_SUFFIX)
+        report = RunReport(
+            os.path.join(options.job_path, RUN_REPORT_NAME),
+            os.path.join(options.job_path, RUN_HISTORY_NAME))
 
-    start_time = time.time()
+    rules = FilterRules.load(options.rules_path) if options.rules_path else None
 
+    tree_changed = True
+    loaded = False
+    analytics = None
+    analytics_path = os.path.join(options.job_path, ANALYTICS_NAME) if options.job_path else None
+    scan = None
     if tree_file_path and os.path.exists(tree_file_path):
         print('Loading directory tree ...')
-        tree = DirTree.load(tree_file_path)
+        report.begin('load')
+        tree_changed = False
+        loaded = True
+        if journal:
+            tree = DirTree.load(tree_file_path)
+            replayed = journal.replay(tree)
+            if replayed:
+                print('Replayed %d edits from the journal' % (replayed,))
+        else:
+            tree = SqliteTree.load(tree_file_path)
+        if os.path.exists(analytics_path):
+            with open(analytics_path) as f:
+                analytics = json.load(f)
+        elapsed_time = report.end(
+            bytes=os.path.getsize(tree_file_path), journal_entries=journal.entries if journal else 0)
+        print('Completed in %.1f seconds' % (elapsed_time,))
+    elif not options.quiet and not options.watch and options.tree_backend == 'memory':
+        # the chooser opens right away and fills in as directories are listed
+        print('Scanning directory in the background ...')
+        report.begin('scan')
+        source_dir_path = os.path.abspath(args[0])
+        space_analytics = SpaceAnalytics()
+        scan = DirTree.scan(source_dir_path, options.scan_workers, space_analytics, rules)
+        tree = scan.tree
+
+        def scan_finished(scan):
+            elapsed_time = report.end(files=scan.stats['entries'], bytes=tree.size, **scan.stats)
+            print('Scan %s in %.1f seconds' % ('failed' if scan.error else 'completed', elapsed_time))
+
+        scan.on_finished = scan_finished
     else:
         print('Scanning directory ...')
+        report.begin('scan')
         source_dir_path = os.path.abspath(args[0])
-        tree = DirTree.ls(source_dir_path)
+        scan_stats = dict()
+        if options.tree_backend == 'sqlite':
+            # analytics would hold on to nodes, so they're gathered from the database when asked for
+            tree = SqliteTree.ls(source_dir_path, tree_file_path, options.scan_workers, scan_stats)
+        else:
+            space_analytics = SpaceAnalytics()
+            tree = DirTree.ls(source_dir_path, options.scan_workers, scan_stats, space_analytics, rules)
+            analytics = space_analytics.to_dict()
+        elapsed_time = report.end(
+            files=scan_stats['entries'], bytes=tree.size, **scan_stats)
+        print('Completed in %.1f seconds' % (elapsed_time,))
+
+    if options.refresh and not tree_changed:
+        print('Refreshing directory tree ...')
+        report.begin('refresh')
+        scan_stats = dict()
+        space_analytics = SpaceAnalytics()
+        (listed, unchanged) = tree.refresh(options.scan_workers, scan_stats, space_analytics)
+        analytics = space_analytics.to_dict()
+        tree_changed = True
+        elapsed_time = report.end(
+            files=scan_stats['entries'], unchanged_directories=unchanged, **scan_stats)
+        print('Re-listed %d of %d directories' % (listed, listed + unchanged))
+        print('Completed in %.1f seconds' % (elapsed_time,))
+
+    # scans apply the rules as they go
+    if rules and loaded:
+        print('Applying rules ...')
+        report.begin('rules')
+        matched = tree.apply_rules(rules)
+        tree_changed = True
+        elapsed_time = report.end(files=matched)
+        print('Rules matched %d entries' % (matched,))
+        print('Completed in %.1f seconds' % (elapsed_time,))
+
+    def save_tree():
+        print('Saving directory tree ...')
+        report.begin('save')
+        tree.save(tree_file_path)
+        if journal:
+            journal.clear()
+        if analytics is not None:
+            write_json(analytics_path, analytics)
+        elapsed_time = report.end(bytes=os.path.getsize(tree_file_path))
+        print('Completed in %.1f seconds' % (elapsed_time,))
+
+    # saved before the chooser opens, so its edits only have to be journaled
+    if tree_file_path and tree_changed and scan is None:
+        save_tree()
 
-    elapsed_time = time.time() - start_time
-    print('Completed in %.1f seconds' % (elapsed_time,))
+    if options.watch:
+        watcher = TreeWatcher(tree, options.scan_workers)
+        print('Watching %d directories for changes (Ctrl-C to stop) ...' % (watcher.watched,))
+        if watcher.unwatched:
+            print('Could not watch %d directories; raise fs.inotify.max_user_watches to watch them' % (
+                watcher.unwatched,))
+        # analytics would go stale as the tree changes; they're gathered again when asked for
+        analytics = None
+        if os.path.exists(analytics_path):
+            os.remove(analytics_path)
+        report.begin('watch')
+        changes = 0
+        unsaved = 0
+        checkpoint_time = time.time()
+        try:
+            while True:
+                changed = watcher.poll()
+                changes += changed
+                unsaved += changed
+                if unsaved and time.time() - checkpoint_time >= WATCH_CHECKPOINT_SECONDS:
+                    save_tree()
+                    unsaved = 0
+                    checkpoint_time = time.time()
+        except KeyboardInterrupt:
+            print('')
+        finally:
+            watcher.close()
+            if unsaved:
+                save_tree()
+        elapsed_time = report.end(directories=changes)
+        report.finish()
+        print('Applied changes to %d directories' % (changes,))
+        print('Completed in %.1f seconds' % (elapsed_time,))
+        sys.exit(0)
 
+    # directories listed in the chooser after they were included again
+    relisted = 0
     if not options.quiet:
+        # a database is searched in place; names in memory are indexed on the first search
+        index = SqliteNameIndex(tree) if options.tree_backend == 'sqlite' else None
+
         root = tk.Tk()
 
         print('Launching file chooser ...')
-        start_time = time.time()
-        chooser = FileChooser(root, tree)
-        elapsed_time = time.time() - start_time
+        report.begin('chooser')
+        chooser = FileChooser(root, tree, options.unload_collapsed, index, analytics, scan)
+        elapsed_time = report.end()
         print('Completed in %.1f seconds' % (elapsed_time,))
 
         def close_handler():
@@ -560,46 +4430,319 @@ if __name__ == '__main__':
             root.destroy()
 
         root.protocol('WM_DELETE_WINDOW', close_handler)
-        root.mainloop()
+        # a tree still being scanned isn't saved yet, so its edits go in with the whole tree
+        DirTree.journal = journal if scan is None else None
+        try:
+            root.mainloop()
+        finally:
+            DirTree.journal = None
+            if journal:
+                journal.close()
 
-        if tree_file_path:
-            print('Saving directory tree ...')
-            start_time = time.time()
-            tree.save(tree_file_path)
-            elapsed_time = time.time() - start_time
-            print('Completed in %.1f seconds' % (elapsed_time,))
+        relisted = chooser.finish_listing()
 
-    if not options.dry_run:
-        print('Copying files ...')
-        start_time = time.time()
+        (batches, rows, flush_time, max_flush_time) = chooser.flush_timings
+        if batches:
+            print('Refreshed %d rows in %d batches (%.1f ms total, %.1f ms slowest)' % (
+                rows, batches, flush_time * 1000, max_flush_time * 1000))
+
+        if scan is not None:
+            if not scan.done:
+                print('Finishing scan ...')
+            # raises the error a scan ended with, rather than saving what it got to
+            scan.finish()
+            analytics = space_analytics.to_dict()
+            if tree_file_path:
+                save_tree()
+
+    # directories that were excluded before they were ever listed, and have been included again
+    if options.tree_backend == 'memory':
+        listed = relisted + len(tree.list_unlisted(options.scan_workers))
+        if listed:
+            print('Listed %d directories included again since they were last scanned' % (listed,))
+            # their contents aren't in the analytics
+            analytics = None
+            if analytics_path and os.path.exists(analytics_path):
+                os.remove(analytics_path)
+            if tree_file_path:
+                save_tree()
+
+    if journal and journal.needs_compaction:
+        print('Compacting job journal ...')
+        report.begin('compact')
+        entries = journal.entries
+        tree.save(tree_file_path)
+        journal.clear()
+        elapsed_time = report.end(bytes=os.path.getsize(tree_file_path), journal_entries=entries)
+        print('Completed in %.1f seconds' % (elapsed_time,))
+
+    if options.memory_usage and options.tree_backend == 'sqlite':
+        print('Directory tree is kept in %s (%s on disk)' % (
+            tree_file_path, friendly_file_size(os.path.getsize(tree_file_path))))
+    elif options.memory_usage:
+        (used, legacy) = tree.memory_usage()
+        print('Directory tree takes %s (%s less than one object dict per entry)' % (
+            friendly_file_size(used),
+            friendly_file_size(legacy - used),
+        ))
+
+    if options.analytics:
+        if analytics is None:
+            analytics = SpaceAnalytics.from_tree(tree).to_dict()
+            if analytics_path:
+                write_json(analytics_path, analytics)
+        print('')
+        for line in format_analytics(analytics):
+            # paths come back as text, which python 2 only prints to a pipe when it's ascii
+            print(encode_text(line) if str is bytes else line)
+
+    if options.verify:
+        print('Verifying files ...')
+        report.begin('verify')
         source_dir_path = os.path.abspath(args[0])
         dest_dir_path = os.path.abspath(args[1])
+        if options.snapshot:
+            dest_dir_path = Snapshot(dest_dir_path, source_dir_path).previous_path
+            if not dest_dir_path:
+                raise OSError('No snapshots found in %s' % (os.path.abspath(args[1]),))
+            print('Checking snapshot %s' % (os.path.basename(dest_dir_path),))
+
+        report_file = None
+        report_writer = None
+        if options.job_path:
+            report_file = open(os.path.join(options.job_path, VERIFY_REPORT_NAME), 'wb')
+            report_writer = DictWriter(report_file, fieldnames=('path', 'problem'))
+            report_writer.writeheader()
+
+        def report_mismatch(relpath, problem):
+            print('Mismatch: %s (%s)' % (relpath, problem))
+            if report_writer:
+                report_writer.writerow(dict(path=encode_text(relpath), problem=problem))
+
+        try:
+            (checked, mismatches, hashed_bytes) = verify_tree(
+                tree,
+                source_dir_path,
+                dest_dir_path,
+                options.verify,
+                options.hash_name if options.hash_name != 'none' else DEFAULT_HASH_NAME,
+                options.verify_workers,
+                report_mismatch)
+        finally:
+            if report_file:
+                report_file.close()
+
+        elapsed_time = report.end(files=checked, bytes=hashed_bytes, mismatches=mismatches)
+        report.finish()
+        print('Checked %d files, %d mismatches' % (checked, mismatches))
+        print('%.0f files/sec, %s/sec hashed' % (
+            checked / max(elapsed_time, 0.001),
+            friendly_file_size(hashed_bytes / max(elapsed_time, 0.001)),
+        ))
+        print('Completed in %.1f seconds' % (elapsed_time,))
+        if mismatches:
+            sys.exit(1)
+
+    elif not options.dry_run:
+        print('Archiving files ...' if options.archive else 'Copying files ...')
+        report.begin('copy')
+        source_dir_path = os.path.abspath(args[0])
+        dest_dir_path = os.path.abspath(args[1])
+
+        snapshot = None
+        link_dest = None
+        if options.snapshot:
+            snapshot = Snapshot(dest_dir_path, source_dir_path)
+            dest_dir_path = snapshot.path
+            link_dest = snapshot.previous_path
+            print('%s snapshot %s ...' % ('Carrying on with' if snapshot.resumed else 'Writing', snapshot.name))
 
         if not os.path.exists(dest_dir_path):
             os.makedirs(dest_dir_path)
 
         tree.sort_by_name()
 
-        readme_path = os.path.join(dest_dir_path, 'README.txt')
-        with open(readme_path, 'w') as f:
-            write_readme(tree, f, source_dir_path)
+        copy_engine = options.copy_engine
+        if copy_engine is None:
+            copy_engine = 'rsync' if os.uname()[0] == 'Darwin' else 'native'
+
+        throttle = None
+        if options.max_bandwidth or options.max_iops:
+            throttle = Throttle(options.max_bandwidth, options.max_iops)
+        if options.max_iops and copy_engine == 'rsync' and not options.archive:
+            # not an error, so a scheduler can hand every job the same options
+            print('Warning: rsync can\'t limit IOPS, so --max-iops is ignored', file=sys.stderr)
+
+        file_list_fields = ('path', 'is_directory', 'size')
+        if snapshot:
+            file_list_fields += ('snapshot',)
+        hash_name = None
+        if copy_engine == 'native' and not options.archive and options.hash_name != 'none':
+            hash_name = options.hash_name
+            file_list_fields += (hash_name,)
 
         file_list_path = os.path.join(dest_dir_path, FILE_LIST_NAME)
+        readme_path = os.path.join(dest_dir_path, 'README.txt')
+
+        if options.archive:
+            with open(file_list_path, 'wb') as file_list_file:
+                file_list_writer = DictWriter(file_list_file, fieldnames=file_list_fields)
+                file_list_writer.writeheader()
+                write_file_list(tree, file_list_writer)
+
+            with open(readme_path, 'w') as f:
+                write_readme(tree, f, source_dir_path)
+
+            with open(os.path.join(dest_dir_path, ARCHIVE_INDEX_NAME), 'wb') as index_file:
+                index_writer = DictWriter(index_file, fieldnames=('path', 'archive', 'offset', 'size'))
+                index_writer.writeheader()
+                (archives, entries, entry_bytes, archived_bytes) = archive_tree(
+                    tree,
+                    source_dir_path,
+                    dest_dir_path,
+                    options.archive,
+                    options.archive_chunk_size,
+                    options.copy_workers,
+                    index_writer,
+                    lambda entries, entry_bytes: report.progress(entries, entry_bytes, tree.filtered_size),
+                    throttle)
 
-        with open(file_list_path, 'wb') as file_list_file:
-            file_list_writer = DictWriter(file_list_file, fieldnames=(
-                'path',
-                'is_directory',
-                'size',
+            print('Archived %d entries (%s) into %d archives (%s)' % (
+                entries,
+                friendly_file_size(entry_bytes),
+                archives,
+                friendly_file_size(archived_bytes),
             ))
-            file_list_writer.writeheader()
-            write_file_list(tree, file_list_writer)
+            copy_stats = dict(
+                files=entries,
+                bytes=entry_bytes,
+                archives=archives,
+                archived_bytes=archived_bytes,
+                engine='archive',
+            )
+        elif copy_engine == 'rsync':
+            with open(file_list_path, 'wb') as file_list_file:
+                file_list_writer = DictWriter(file_list_file, fieldnames=file_list_fields)
+                file_list_writer.writeheader()
+                write_file_list(tree, file_list_writer, snapshot=snapshot)
 
-        copy_tree(
-            tree,
-            source_dir_path,
-            dest_dir_path,
-            os.path.join(options.job_path if options.job_path else tempfile.gettempdir(), 'exclusions.txt'))
+            with open(readme_path, 'w') as f:
+                write_readme(tree, f, source_dir_path, snapshot=snapshot)
 
-        elapsed_time = time.time() - start_time
-        print('Completed in %.1f seconds' % (elapsed_time,))
\ No newline at end of file
+            transferred = copy_tree(
+                tree,
+                source_dir_path,
+                dest_dir_path,
+                os.path.join(options.job_path if options.job_path else tempfile.gettempdir(), 'exclusions.txt'),
+                link_dest,
+                options.max_bandwidth,
+                options.compact_rsync_rules,
+                lambda files, copied_bytes: report.progress(files, copied_bytes, tree.filtered_size))
+            copy_stats = dict(files=transferred, bytes=tree.filtered_size, engine=copy_engine)
+        else:
+            # FILES.csv is written as files are copied, with hashes computed by the copy workers
+            known_hashes = None
+            if hash_name:
+                known_hashes = load_file_hashes(
+                    os.path.join(link_dest if link_dest else dest_dir_path, FILE_LIST_NAME), hash_name)
+
+            copy_progress = dict(files=0, bytes=0)
+            checkpoint = None
+            if options.job_path:
+                checkpoint = CopyCheckpoint(os.path.join(options.job_path, COPY_CHECKPOINT_NAME), dest_dir_path)
+
+            with open(file_list_path, 'wb') as file_list_file:
+                file_list_writer = DictWriter(file_list_file, fieldnames=file_list_fields)
+                file_list_writer.writeheader()
+
+                def write_copied(node, relpath, status, digest):
+                    if status in (COPY_IGNORED, COPY_VANISHED, COPY_FAILED):
+                        return
+                    if not node.is_directory:
+                        copy_progress['files'] += 1
+                        copy_progress['bytes'] += node.size
+                        report.progress(copy_progress['files'], copy_progress['bytes'], tree.filtered_size)
+                    data = dict(
+                        path=file_list_row_path(node, relpath),
+                        size=node.filtered_size,
+                        is_directory=node.is_directory,
+                    )
+                    if snapshot and not node.is_directory:
+                        data['snapshot'] = SNAPSHOT_LINKED if status == COPY_LINKED else SNAPSHOT_NEW
+                    if hash_name:
+                        data[hash_name] = digest if digest else ''
+                    file_list_writer.writerow(data)
+
+                try:
+                    (counts, sizes, copied_bytes) = copy_tree_native(
+                        tree,
+                        source_dir_path,
+                        dest_dir_path,
+                        options.copy_workers,
+                        link_dest,
+                        hash_name,
+                        known_hashes,
+                        write_copied,
+                        throttle,
+                        checkpoint)
+                finally:
+                    # kept for the next run unless the copy went through
+                    if checkpoint:
+                        checkpoint.close()
+                if checkpoint:
+                    checkpoint.clear()
+
+            # the README and the console report the same tally
+            if snapshot:
+                snapshot.count_copied(counts, sizes)
+            with open(readme_path, 'w') as f:
+                write_readme(tree, f, source_dir_path, snapshot=snapshot)
+
+            print('Copied %d files (%s), %d unchanged (%s), %d linked (%s)' % (
+                counts[COPY_COPIED],
+                friendly_file_size(sizes[COPY_COPIED]),
+                counts[COPY_UNCHANGED],
+                friendly_file_size(sizes[COPY_UNCHANGED]),
+                counts[COPY_LINKED],
+                friendly_file_size(sizes[COPY_LINKED]),
+            ))
+            if checkpoint and (checkpoint.resumed_files or checkpoint.recopied_files or checkpoint.finished_files or
+                               checkpoint.swept_files):
+                print('Resumed %d partly copied files (%s kept), %d copied again (%s lost), %d already done, '
+                      '%d no longer needed' % (
+                          checkpoint.resumed_files,
+                          friendly_file_size(checkpoint.resumed_bytes),
+                          checkpoint.recopied_files,
+                          friendly_file_size(checkpoint.recopied_bytes),
+                          checkpoint.finished_files,
+                          checkpoint.swept_files,
+                      ))
+            copy_stats = dict(
+                files=copy_progress['files'],
+                bytes=copy_progress['bytes'],
+                copied_bytes=copied_bytes,
+                directories=counts[COPY_DIRECTORY],
+                engine=copy_engine,
+                throttled_seconds=throttle.waited if throttle else 0,
+            )
+            if checkpoint:
+                copy_stats.update(
+                    resumed_files=checkpoint.resumed_files,
+                    resumed_bytes=checkpoint.resumed_bytes,
+                    recopied_files=checkpoint.recopied_files,
+                    recopied_bytes=checkpoint.recopied_bytes,
+                    finished_files=checkpoint.finished_files,
+                    swept_files=checkpoint.swept_files,
+                )
+            copy_stats.update(
+                ('%s_files' % (status,), counts[status]) for status in COPY_STATUSES if status != COPY_DIRECTORY)
+
+        if snapshot:
+            # only now can it be the previous snapshot of the next run
+            snapshot.finish()
+        elapsed_time = report.end(**copy_stats)
+        report.finish()
+        print('Completed in %.1f seconds' % (elapsed_time,))
+
+    else:
+        report.finish()
\ No newline at end of file
@@ -0,0 +1,1010 @@
+"""
+Tests for backup.py, which run it the way cron and backup-scheduler.py do, with its output piped.
+
+    python -m unittest test_backup
+
+"""
+
+from __future__ import print_function
+from csv import DictReader
+import errno
+import hashlib
+import imp
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    import backup
+except ImportError:
+    # backup.py needs Tkinter
+    backup = None
+
+BACKUP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backup.py')
+BENCHMARK_PATH = os.path.join(os.path.dirname(BACKUP_PATH), 'backup-benchmark.py')
+SCHEDULER_PATH = os.path.join(os.path.dirname(BACKUP_PATH), 'backup-scheduler.py')
+
+
+@unittest.skipIf(backup is None, 'backup.py could not be imported')
+class BackupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.path, 'source')
+        os.mkdir(self.source_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, relpath, data):
+        path = os.path.join(self.source_path, relpath)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def run_backup(self, *args):
+        # returns what was printed; check_output pipes stdout
+        env = dict(os.environ, LANG='C.UTF-8')
+        env.pop('LC_ALL', None)
+        return subprocess.check_output(
+            [sys.executable, BACKUP_PATH, '-q', '--job', os.path.join(self.path, 'job')] + list(args),
+            stderr=subprocess.STDOUT,
+            env=env)
+
+    def entries(self, tree):
+        # (relpath, size, filter) for every entry of a tree, in tree order
+        return [(relpath, node.size, node.filter) for (node, relpath) in backup.walk_tree(tree)]
+
+    def test_list_directory(self):
+        self.write('file', b'12345')
+        os.mkdir(os.path.join(self.source_path, 'dir'))
+        os.symlink('dir', os.path.join(self.source_path, 'dir-link'))
+        os.symlink('file', os.path.join(self.source_path, 'file-link'))
+        os.symlink('missing', os.path.join(self.source_path, 'broken-link'))
+        expected = [
+            ('broken-link', False, 0, None),
+            ('dir', True, 0, None),
+            ('dir-link', True, 0, None),
+            ('file', False, 5, os.stat(os.path.join(self.source_path, 'file')).st_mtime),
+            ('file-link', False, 5, os.stat(os.path.join(self.source_path, 'file')).st_mtime),
+        ]
+        (entries, syscalls) = backup.list_directory(self.source_path)
+        self.assertEqual(sorted(entries), expected)
+        # the directory read, then a stat for everything but the directory
+        self.assertEqual(syscalls, 5 if backup.LISTING_METHOD != backup.LISTING_LISTDIR else 6)
+
+        # every entry is stat'ed without scandir or readdir
+        saved = (backup.scandir, backup.readdir)
+        (backup.scandir, backup.readdir) = (None, None)
+        try:
+            (entries, syscalls) = backup.list_directory(self.source_path)
+        finally:
+            (backup.scandir, backup.readdir) = saved
+        self.assertEqual(sorted(entries), expected)
+        self.assertEqual(syscalls, 6)
+
+    def test_scan_in_parallel(self):
+        for i in range(5):
+            os.makedirs(os.path.join(self.source_path, 'd%d' % (i,), 'e'))
+            self.write('d%d/e/f' % (i,), b'x' * i)
+        stats = dict()
+        tree = backup.DirTree.ls(self.source_path, workers=4, stats=stats)
+        self.assertEqual(self.entries(tree), self.entries(backup.DirTree.ls(self.source_path, workers=1)))
+        self.assertEqual(tree.size, 10)
+        self.assertEqual((stats['directories'], stats['entries'], stats['listing']),
+                         (11, 15, backup.LISTING_METHOD))
+
+    def test_refresh_matches_a_new_scan(self):
+        for name in ('a', 'b', 'c'):
+            os.makedirs(os.path.join(self.source_path, name, 'sub'))
+            self.write(name + '/sub/file', b'123456')
+        self.write('top', b'1')
+        tree_path = os.path.join(self.path, 'tree.dat')
+        tree = backup.DirTree.ls(self.source_path)
+        tree.find('b').exclude_all()
+        tree.save(tree_path)
+
+        # rewritten in place, which leaves its directory alone
+        with open(os.path.join(self.source_path, 'a/sub/file'), 'r+b') as f:
+            f.write(b'12345678901234')
+        self.write('b/new', b'12')
+        os.remove(os.path.join(self.source_path, 'c/sub/file'))
+        os.mkdir(os.path.join(self.source_path, 'd'))
+
+        tree = backup.DirTree.load(tree_path)
+        (listed, unchanged) = tree.refresh()
+        self.assertEqual((listed, unchanged), (4, 4))
+        expected = backup.DirTree.ls(self.source_path)
+        expected.find('b').exclude_all()
+        self.assertEqual(sorted(self.entries(tree)), sorted(self.entries(expected)))
+        self.assertEqual(tree.find('a/sub/file').size, 14)
+        self.assertEqual(tree.size, 14 + 2 + 6 + 1)
+
+    def test_compact_nodes(self):
+        for name in ('a', 'b'):
+            os.makedirs(os.path.join(self.source_path, name, 'sub'))
+            self.write(name + '/sub/same', b'x')
+        tree = backup.DirTree.ls(self.source_path)
+        self.assertFalse(hasattr(tree, '__dict__'))
+        # names are interned
+        (a, b) = (tree.find('a/sub/same'), tree.find('b/sub/same'))
+        self.assertIsNot(a, b)
+        self.assertIs(a.name, b.name)
+        (used, legacy) = tree.memory_usage()
+        self.assertLess(used, legacy)
+
+        # directories whose children haven't been read keep just the index of their record
+        tree_path = os.path.join(self.path, 'tree.dat')
+        tree.save(tree_path)
+        tree = backup.DirTree.load(tree_path)
+        self.assertIsInstance(tree.find('a')._DirTree__lazy, int)
+        self.assertLess(tree.memory_usage()[0], used)
+        self.assertEqual(tree.find('b/sub/same').size, 1)
+        self.assertIsNone(tree.find('b/sub')._DirTree__lazy)
+
+    def test_save_and_load(self):
+        os.makedirs(os.path.join(self.source_path, 'dir', 'sub'))
+        self.write('dir/sub/file', b'12345')
+        self.write(b'caf\xc3\xa9', b'12')
+        self.write(b'bad\xff', b'1')
+        tree = backup.DirTree.ls(self.source_path)
+        tree.find('dir/sub').exclude_all()
+        tree.find(b'caf\xc3\xa9').notes = u'caf\xe9 notes'
+        tree_path = os.path.join(self.path, 'tree.dat')
+        tree.save(tree_path)
+
+        loaded = backup.DirTree.load(tree_path)
+        self.assertEqual(loaded.name, tree.name)
+        self.assertEqual((loaded.size, loaded.filtered_size), (8, 3))
+        self.assertEqual(self.entries(loaded), self.entries(tree))
+        self.assertEqual(loaded.find(b'caf\xc3\xa9').notes, u'caf\xe9 notes')
+        self.assertEqual(loaded.find('dir/sub/file').mtime, tree.find('dir/sub/file').mtime)
+
+        # saving a partly loaded tree writes the parts still in the old file too
+        loaded = backup.DirTree.load(tree_path)
+        loaded.find(b'bad\xff').exclude_all()
+        loaded.save(tree_path)
+        tree.find(b'bad\xff').exclude_all()
+        self.assertEqual(self.entries(backup.DirTree.load(tree_path)), self.entries(tree))
+
+    def assert_totals(self, tree):
+        # every directory's filter and filtered size, worked out again from its files
+        for (node, relpath) in backup.walk_tree(tree, post_order=True):
+            if not node.is_directory or not node.children:
+                continue
+            filters = set(child.filter for child in node.children)
+            expected = filters.pop() if len(filters) == 1 and backup.FILTER_PARTIAL not in filters else \
+                backup.FILTER_PARTIAL
+            self.assertEqual(node.filter, expected, relpath)
+            self.assertEqual(node.filtered_size, sum(child.filtered_size for child in node.children), relpath)
+
+    def test_filter_changes_only_walk_up(self):
+        relpath = ''
+        for level in range(10):
+            relpath += 'd%d/' % (level,)
+            os.mkdir(os.path.join(self.source_path, relpath))
+            self.write(relpath + 'one', b'1')
+            self.write(relpath + 'two', b'22')
+        self.write('d0/empty', b'')
+        tree = backup.DirTree.ls(self.source_path)
+        node = tree.find(relpath + 'two')
+        ancestors = []
+        parent = node
+        while parent is not None:
+            ancestors.append(parent)
+            parent = parent.parent
+
+        changed = []
+        backup.DirTree.filter_changed = changed.append
+        try:
+            node.exclude_all()
+            self.assertEqual(changed, ancestors)
+            self.assertEqual(tree.filtered_size, 28)
+            self.assert_totals(tree)
+
+            # nothing above a partly included directory changes when an empty file is excluded
+            del changed[:]
+            empty = tree.find('d0/empty')
+            empty.exclude_all()
+            self.assertEqual(changed, [empty, empty.parent])
+            tree.find('d0/d1/').exclude_all()
+            tree.find('d0/one').exclude_all()
+            self.assert_totals(tree)
+            self.assertEqual(tree.filtered_size, 2)
+            tree.include_all()
+            self.assert_totals(tree)
+            self.assertEqual((tree.filter, tree.filtered_size), (backup.FILTER_INCLUDE_ALL, 30))
+        finally:
+            backup.DirTree.filter_changed = None
+
+    def test_analytics_with_non_ascii_names(self):
+        self.write(b'caf\xc3\xa9.txt', b'hello')
+        self.write(b'bad\xff.txt', b'x')
+        for backend in ('memory', 'sqlite'):
+            output = self.run_backup('-n', '--tree-backend', backend, '--analytics', self.source_path)
+            self.assertIn(b'caf\xc3\xa9.txt', output)
+            self.assertIn(b'bad\xff.txt', output)
+            shutil.rmtree(os.path.join(self.path, 'job'))
+
+    def test_extract_hard_linked_files(self):
+        path = self.write('one', b'shared contents')
+        os.link(path, os.path.join(self.source_path, 'two'))
+        archive_path = os.path.join(self.path, 'archive')
+        output = self.run_backup('--archive', 'gzip', self.source_path, archive_path)
+        self.assertIn(b'Archived 2 entries (30 bytes)', output)
+        for name in ('one', 'two'):
+            restore_path = os.path.join(self.path, 'restore-' + name)
+            self.run_backup('--extract', name, archive_path, restore_path)
+            with open(os.path.join(restore_path, name), 'rb') as f:
+                self.assertEqual(f.read(), b'shared contents')
+
+    def test_snapshot_links_unchanged_files(self):
+        self.write('same', b'unchanged')
+        self.write('changed', b'before')
+        dest_path = os.path.join(self.path, 'dest')
+        self.run_backup('--copy-engine', 'native', '--snapshot', self.source_path, dest_path)
+        # renamed, so the second snapshot can't take the first one's name within the same second
+        os.rename(os.path.join(dest_path, os.listdir(dest_path)[0]), os.path.join(dest_path, '2000-01-01_000000'))
+        first_path = os.path.join(dest_path, '2000-01-01_000000')
+        self.write('changed', b'after, and longer')
+        self.run_backup('--refresh', '--copy-engine', 'native', '--snapshot', self.source_path, dest_path)
+        second_path = os.path.join(dest_path, max(os.listdir(dest_path)))
+        self.assertNotEqual(second_path, first_path)
+
+        self.assertEqual(
+            os.stat(os.path.join(first_path, 'same')).st_ino, os.stat(os.path.join(second_path, 'same')).st_ino)
+        self.assertNotEqual(
+            os.stat(os.path.join(first_path, 'changed')).st_ino, os.stat(os.path.join(second_path, 'changed')).st_ino)
+        with open(os.path.join(second_path, 'changed'), 'rb') as f:
+            self.assertEqual(f.read(), b'after, and longer')
+        with open(os.path.join(second_path, backup.FILE_LIST_NAME)) as f:
+            statuses = dict((row['path'], row['snapshot']) for row in DictReader(f) if row['snapshot'])
+        self.assertEqual(statuses, dict(same=backup.SNAPSHOT_LINKED, changed=backup.SNAPSHOT_NEW))
+
+    def test_unchanged_files_keep_their_recorded_hashes(self):
+        self.write('file', b'original')
+        dest_path = os.path.join(self.path, 'dest')
+        expected = dict(file=hashlib.sha256(b'original').hexdigest())
+        self.run_backup('--copy-engine', 'native', self.source_path, dest_path)
+        self.assertEqual(self.file_hashes(dest_path), expected)
+        # the same size and time, so the copy counts it unchanged and takes its hash from FILES.csv
+        # rather than reading it again
+        copied_path = os.path.join(dest_path, 'file')
+        st = os.stat(copied_path)
+        with open(copied_path, 'wb') as f:
+            f.write(b'replaced')
+        os.utime(copied_path, (st.st_atime, st.st_mtime))
+        self.run_backup('--copy-engine', 'native', self.source_path, dest_path)
+        self.assertEqual(self.file_hashes(dest_path), expected)
+
+    def file_hashes(self, dest_path):
+        with open(os.path.join(dest_path, backup.FILE_LIST_NAME)) as f:
+            return dict((row['path'], row['sha256']) for row in DictReader(f) if row['is_directory'] != 'True')
+
+    def test_verify_modes(self):
+        self.write('file', b'original')
+        dest_path = os.path.join(self.path, 'dest')
+        self.run_backup('--copy-engine', 'native', self.source_path, dest_path)
+        for mode in ('quick', 'content', 'hashes'):
+            self.assertIn(b'Checked 1 files, 0 mismatches', self.run_backup('--verify', mode, self.source_path, dest_path))
+
+        # the same size and time, so only the checks that read the files see it
+        copied_path = os.path.join(dest_path, 'file')
+        st = os.stat(copied_path)
+        with open(copied_path, 'wb') as f:
+            f.write(b'replaced')
+        os.utime(copied_path, (st.st_atime, st.st_mtime))
+        self.assertIn(b'Checked 1 files, 0 mismatches', self.run_backup('--verify', 'quick', self.source_path, dest_path))
+        for (mode, problem) in (('content', b'content differs'), ('hashes', b'content differs from recorded hash')):
+            with self.assertRaises(subprocess.CalledProcessError) as raised:
+                self.run_backup('--verify', mode, self.source_path, dest_path)
+            self.assertIn(b'Mismatch: file (' + problem + b')', raised.exception.output)
+
+        os.remove(copied_path)
+        with self.assertRaises(subprocess.CalledProcessError) as raised:
+            self.run_backup('--verify', 'quick', self.source_path, dest_path)
+        self.assertIn(b'Mismatch: file (missing from destination)', raised.exception.output)
+
+    def test_rsync_rules(self):
+        excluded = ('a[1].txt', 'b*.log', 'c\\d', 'x1.tmp', 'x2.tmp')
+        for name in excluded + ('keep1', 'keep2', 'keep3', 'keep4', 'keep5'):
+            self.write(name, b'x')
+        os.mkdir(os.path.join(self.source_path, 'sub'))
+        self.write('sub/file', b'x')
+        rules_path = os.path.join(self.path, 'rules')
+        tree = backup.DirTree.ls(self.source_path)
+
+        def written(compact):
+            arguments = backup.write_rsync_rules(tree, rules_path, compact)
+            with open(rules_path, 'rb') as f:
+                data = f.read()
+            return arguments[0].split('=')[0], sorted(data.split(b'\0')[:-1] if len(arguments) > 1 else data.splitlines())
+
+        # exact paths, unless asked to share one rule between the .tmp files
+        for name in excluded:
+            tree.find(name).exclude_all()
+        self.assertEqual(written(False), (
+            '--exclude-from', [b'/a\\[1\\].txt', b'/b\\*.log', b'/c\\d', b'/x1.tmp', b'/x2.tmp']))
+        self.assertEqual(written(True), (
+            '--exclude-from', [b'/*.tmp', b'/a\\[1\\].txt', b'/b\\*.log', b'/c\\d']))
+
+        # two included entries against nine excluded ones are only listed when asked to
+        for child in tree.children:
+            if child.name in ('a[1].txt', 'sub/'):
+                child.include_all()
+            else:
+                child.exclude_all()
+        self.assertEqual(len(written(False)[1]), 9)
+        self.assertEqual(written(True), ('--files-from', [b'a[1].txt', b'sub/']))
+
+    def test_rsync_progress(self):
+        self.write('file', b'x')
+        bin_path = os.path.join(self.path, 'bin')
+        os.mkdir(bin_path)
+        # stands in for rsync: says which version it is, or prints a name and progress lines
+        with open(os.path.join(bin_path, 'rsync'), 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'if [ "$1" = --version ]; then echo "rsync  version 3.2.7  protocol version 31"; exit; fi\n'
+                    'printf "file\\n        500  50%%    1.00MB/s    0:00:00\\r'
+                    '      1,000 100%%    1.00MB/s    0:00:00 (xfr#1, to-chk=0/2)\\r\\n"\n')
+        os.chmod(os.path.join(bin_path, 'rsync'), 0o755)
+        tree = backup.DirTree.ls(self.source_path)
+        progress = []
+        saved = (os.environ['PATH'], sys.stdout)
+        os.environ['PATH'] = bin_path + os.pathsep + os.environ['PATH']
+        sys.stdout = output = tempfile.TemporaryFile()
+        try:
+            files = backup.copy_tree(
+                tree, self.source_path, os.path.join(self.path, 'dest'), os.path.join(self.path, 'rules'),
+                on_progress=lambda *args: progress.append(args))
+        finally:
+            (os.environ['PATH'], sys.stdout) = saved
+        output.seek(0)
+        self.assertEqual(output.read(), b'file\n')
+        self.assertEqual(progress, [(0, 500), (1, 1000)])
+        self.assertEqual(files, 1)
+        self.assertIsNone(backup.parse_rsync_progress(b'sent 1,000 bytes  received 35 bytes'))
+
+    def test_archive_progress(self):
+        for name in ('one', 'two', 'three'):
+            self.write(name, name.encode('ascii'))
+        tree = backup.DirTree.ls(self.source_path)
+        dest_path = os.path.join(self.path, 'dest')
+        os.mkdir(dest_path)
+        progress = []
+        # one archive per file
+        backup.archive_tree(
+            tree, self.source_path, dest_path, 'gzip', 1, workers=2, on_progress=lambda *args: progress.append(args))
+        # the workers' entries arrive in any order
+        self.assertEqual([entries for (entries, size) in progress], [1, 2, 3])
+        self.assertEqual(progress[-1], (3, 11))
+
+    def test_benchmark(self):
+        work_path = os.path.join(self.path, 'benchmark')
+        command = [sys.executable, BENCHMARK_PATH, '--scale', '0.01', '--skip', 'copy_unchanged', work_path]
+        subprocess.check_output(command + ['--label', 'first'], stderr=subprocess.STDOUT)
+        with open(os.path.join(work_path, 'small', 'source', 'd0', 'file00000.log'), 'rb') as f:
+            generated = f.read()
+        output = subprocess.check_output(command + ['--label', 'second'], stderr=subprocess.STDOUT)
+        # the trees are kept, and every timing is compared with the first run's
+        self.assertNotIn(b'Generating', output)
+        self.assertIn(b'vs first)', output)
+        with open(os.path.join(work_path, 'benchmark-results.csv')) as f:
+            rows = list(DictReader(f))
+        operations = set(row['operation'] for row in rows)
+        self.assertIn('copy', operations)
+        self.assertNotIn('copy_unchanged', operations)
+        for label in ('first', 'second'):
+            for shape in ('deep', 'wide', 'small', 'huge'):
+                self.assertEqual(
+                    set(row['operation'] for row in rows if row['label'] == label and row['shape'] == shape),
+                    operations)
+
+        # the same seed generates the same tree again
+        shutil.rmtree(os.path.join(work_path, 'small'))
+        subprocess.check_output(command + ['--shape', 'small', '--skip', 'copy'], stderr=subprocess.STDOUT)
+        with open(os.path.join(work_path, 'small', 'source', 'd0', 'file00000.log'), 'rb') as f:
+            self.assertEqual(f.read(), generated)
+
+    def test_journal_replay_with_torn_line(self):
+        for name in ('one', 'two', 'three'):
+            self.write(name, b'x')
+        tree_path = os.path.join(self.path, 'tree.dat')
+        journal_path = tree_path + backup.JOURNAL_SUFFIX
+        tree = backup.DirTree.ls(self.source_path)
+        tree.save(tree_path)
+        backup.DirTree.journal = backup.TreeJournal(journal_path)
+        try:
+            tree.find('one').exclude_all()
+            tree.find('two').notes = 'kept'
+        finally:
+            backup.DirTree.journal.close()
+            backup.DirTree.journal = None
+        good_size = os.path.getsize(journal_path)
+        with open(journal_path, 'ab') as f:
+            f.write(b'{"filter": "E", "path": "thr')
+
+        tree = backup.DirTree.load(tree_path)
+        journal = backup.TreeJournal(journal_path)
+        self.assertEqual(journal.replay(tree), 2)
+        self.assertEqual(os.path.getsize(journal_path), good_size)
+        self.assertEqual(tree.find('one').filter, backup.FILTER_EXCLUDE_ALL)
+        self.assertEqual(tree.find('two').notes, 'kept')
+        self.assertEqual(tree.find('three').filter, backup.FILTER_INCLUDE_ALL)
+
+        # edits made after the torn line was cut off are replayed too
+        journal.record(tree.find('three'), filter=backup.FILTER_EXCLUDE_ALL)
+        journal.close()
+        tree = backup.DirTree.load(tree_path)
+        self.assertEqual(backup.TreeJournal(journal_path).replay(tree), 3)
+        self.assertEqual(tree.find('three').filter, backup.FILTER_EXCLUDE_ALL)
+
+        # a record cut off just before its newline was torn too
+        with open(journal_path, 'ab') as f:
+            f.write(b'{"filter": "I", "path": "three"}')
+        tree = backup.DirTree.load(tree_path)
+        self.assertEqual(backup.TreeJournal(journal_path).replay(tree), 3)
+        self.assertEqual(tree.find('three').filter, backup.FILTER_EXCLUDE_ALL)
+
+    def test_rules_leave_excluded_directories_unread(self):
+        os.makedirs(os.path.join(self.source_path, 'skip', 'inner'))
+        self.write('skip/inner/file.tmp', b'x')
+        self.write('file.tmp', b'x')
+        self.write('file.txt', b'x')
+        tree_path = os.path.join(self.path, 'tree.dat')
+        tree = backup.DirTree.ls(self.source_path)
+        tree.find('skip').exclude_all()
+        tree.save(tree_path)
+
+        def unread(tree):
+            return tree.find('skip')._DirTree__lazy is not None
+
+        tree = backup.DirTree.load(tree_path)
+        rules = backup.FilterRules([('exclude', 'glob', '*.tmp'), ('exclude', 'glob', 'skip/')])
+        self.assertEqual(tree.apply_rules(rules), 2)
+        self.assertTrue(unread(tree))
+        self.assertEqual(tree.find('file.tmp').filter, backup.FILTER_EXCLUDE_ALL)
+        self.assertEqual(tree.filtered_size, 1)
+        self.assertEqual(tree.filter, backup.FILTER_PARTIAL)
+
+        # a rule that includes something could reach inside
+        tree = backup.DirTree.load(tree_path)
+        rules = backup.FilterRules([('include', 'glob', 'inner/')])
+        self.assertEqual(tree.apply_rules(rules), 1)
+        self.assertFalse(unread(tree))
+        self.assertEqual(tree.find('skip/inner/file.tmp').filter, backup.FILTER_INCLUDE_ALL)
+        self.assertEqual(tree.find('skip').filter, backup.FILTER_INCLUDE_ALL)
+        self.assertEqual(tree.filtered_size, 3)
+
+    def test_sqlite_backend(self):
+        os.makedirs(os.path.join(self.source_path, 'dir', 'sub'))
+        self.write('dir/one', b'1')
+        self.write('dir/sub/two', b'22')
+        self.write('three', b'333')
+        db_path = os.path.join(self.path, 'tree.sqlite')
+        tree = backup.SqliteTree.ls(self.source_path, db_path)
+        expected = backup.DirTree.ls(self.source_path)
+        self.assertEqual(sorted(self.entries(tree)), sorted(self.entries(expected)))
+
+        tree.find('dir/sub').exclude_all()
+        expected.find('dir/sub').exclude_all()
+        tree.find('dir/sub/two').notes = 'noted'
+        self.assertEqual(sorted(self.entries(tree)), sorted(self.entries(expected)))
+        self.assertEqual((tree.size, tree.filtered_size), (6, 4))
+        self.assertEqual(tree.find('dir').filter, backup.FILTER_PARTIAL)
+
+        # edits are in the database as they're made
+        tree = backup.SqliteTree.load(db_path)
+        self.assertEqual(sorted(self.entries(tree)), sorted(self.entries(expected)))
+        self.assertEqual(tree.find('dir/sub/two').notes, 'noted')
+        index = backup.SqliteNameIndex(tree)
+        self.assertEqual(len(index), 6)
+        self.assertEqual([index.path(entry) for entry in index.search('TWO')], [tree.name + 'dir/sub/two'])
+
+        dest_path = os.path.join(self.path, 'dest')
+        self.run_backup('--tree-backend', 'sqlite', '--copy-engine', 'native', self.source_path, dest_path)
+        with open(os.path.join(dest_path, 'dir', 'sub', 'two'), 'rb') as f:
+            self.assertEqual(f.read(), b'22')
+
+    def test_walk_tree(self):
+        os.makedirs(os.path.join(self.source_path, 'a', 'b'))
+        self.write('a/b/file', b'x')
+        self.write('c', b'x')
+        tree = backup.DirTree.ls(self.source_path)
+        tree.sort_by_name()
+        self.assertEqual([relpath for (node, relpath) in backup.walk_tree(tree)], ['', 'a/', 'a/b/', 'a/b/file', 'c'])
+        self.assertEqual(
+            [relpath for (node, relpath) in backup.walk_tree(tree, post_order=True)], ['a/b/file', 'a/b/', 'a/', 'c', ''])
+        self.assertEqual(
+            [relpath for (node, relpath) in backup.walk_tree(tree, prune=lambda node: node.name == 'b/')],
+            ['', 'a/', 'a/b/', 'c'])
+
+    def test_trees_deeper_than_the_recursion_limit(self):
+        depth = 150
+        os.makedirs(os.path.join(self.source_path, *(['d'] * depth)))
+        self.write('/'.join(['d'] * depth) + '/file', b'x')
+        tree_path = os.path.join(self.path, 'tree.dat')
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(100)
+        try:
+            tree = backup.DirTree.ls(self.source_path)
+            tree.find('d').exclude_all()
+            tree.find('d').include_all()
+            tree.sort_by_name()
+            tree.save(tree_path)
+            tree = backup.DirTree.load(tree_path)
+            entries = self.entries(tree)
+        finally:
+            sys.setrecursionlimit(limit)
+        self.assertEqual(len(entries), depth + 2)
+        self.assertEqual(entries[-1], ('d/' * depth + 'file', 1, backup.FILTER_INCLUDE_ALL))
+        self.assertEqual(tree.size, 1)
+
+    def test_watch_keeps_the_tree_up_to_date(self):
+        os.makedirs(os.path.join(self.source_path, 'gone', 'inner'))
+        self.write('gone/inner/file', b'x')
+        self.write('grows', b'x')
+        tree = backup.DirTree.ls(self.source_path)
+        try:
+            watcher = backup.TreeWatcher(tree)
+        except OSError:
+            self.skipTest('inotify is not available')
+        try:
+            self.assertEqual(watcher.watched, 3)
+            shutil.rmtree(os.path.join(self.source_path, 'gone'))
+            os.makedirs(os.path.join(self.source_path, 'new', 'inner'))
+            self.write('new/inner/file', b'new')
+            self.write('grows', b'longer')
+            expected = backup.DirTree.ls(self.source_path)
+            deadline = time.time() + 10
+            while sorted(self.entries(tree)) != sorted(self.entries(expected)) and time.time() < deadline:
+                watcher.poll(0.1)
+            self.assertEqual(sorted(self.entries(tree)), sorted(self.entries(expected)))
+            self.assertEqual(tree.size, 9)
+            self.assertEqual(watcher.watched, 3)
+        finally:
+            watcher.close()
+
+    def test_archives_are_throttled(self):
+        for name in ('one', 'two', 'three'):
+            self.write(name, b'x' * 100)
+        tree = backup.DirTree.ls(self.source_path)
+        dest_path = os.path.join(self.path, 'dest')
+        os.mkdir(dest_path)
+        # a second's worth goes through at once, and the rest takes half a second
+        throttle = backup.Throttle(bytes_per_second=200)
+        start_time = time.time()
+        backup.archive_tree(tree, self.source_path, dest_path, 'gzip', 1, workers=1, throttle=throttle)
+        self.assertAlmostEqual(throttle.waited, 0.5, delta=0.1)
+        self.assertGreaterEqual(time.time() - start_time, 0.4)
+
+    def interrupt_copy(self):
+        # a copy cut short with the large file partly copied; returns what the large file holds
+        data = bytes(bytearray(random.Random(0).randrange(256) for i in range(10000)))
+        self.write('large', data)
+        os.mkdir(os.path.join(self.source_path, 'sub'))
+        self.write('sub/small', b'small')
+        job_path = os.path.join(self.path, 'job')
+        os.mkdir(job_path)
+        dst_path = os.path.join(self.path, 'dest')
+        os.mkdir(dst_path)
+
+        class Interrupt(object):
+            # stands in for a Throttle, and cuts the copy of the large file short
+            taken = 0
+
+            def take(self, size, operations=1):
+                self.taken += size
+                if self.taken > 6000:
+                    raise IOError('interrupted')
+
+        # checkpoints every few chunks
+        saved = (backup.COPY_CHUNK_SIZE, backup.COPY_CHECKPOINT_BYTES)
+        (backup.COPY_CHUNK_SIZE, backup.COPY_CHECKPOINT_BYTES) = (1024, 2048)
+        try:
+            checkpoint = backup.CopyCheckpoint(os.path.join(job_path, backup.COPY_CHECKPOINT_NAME), dst_path)
+            tree = backup.DirTree.ls(self.source_path)
+            with self.assertRaises(OSError):
+                backup.copy_tree_native(tree, self.source_path, dst_path, 1, throttle=Interrupt(),
+                                        checkpoint=checkpoint)
+            checkpoint.close()
+        finally:
+            (backup.COPY_CHUNK_SIZE, backup.COPY_CHECKPOINT_BYTES) = saved
+        self.assertFalse(os.path.exists(os.path.join(dst_path, 'large')))
+        self.assertGreaterEqual(os.path.getsize(os.path.join(dst_path, '.large.partial')), 2048)
+        return data
+
+    def test_copy_resumes_from_checkpoint(self):
+        data = self.interrupt_copy()
+        dst_path = os.path.join(self.path, 'dest')
+        job_path = os.path.join(self.path, 'job')
+
+        output = self.run_backup('--copy-engine', 'native', '--hash', 'sha1', self.source_path, dst_path)
+        self.assertIn(b'Resumed 1 partly copied files', output)
+        self.assertFalse(os.path.exists(os.path.join(job_path, backup.COPY_CHECKPOINT_NAME)))
+        self.assertFalse(os.path.exists(os.path.join(dst_path, '.large.partial')))
+        with open(os.path.join(dst_path, 'large'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+        with open(os.path.join(dst_path, 'FILES.csv'), 'rb') as f:
+            hashes = dict((row['path'], row['sha1']) for row in DictReader(f) if row['is_directory'] == 'False')
+        self.assertEqual(hashes, {
+            'large': hashlib.sha1(data).hexdigest(),
+            'sub/small': hashlib.sha1(b'small').hexdigest(),
+        })
+
+    def test_copy_removes_partial_files_it_has_no_use_for(self):
+        self.interrupt_copy()
+        dst_path = os.path.join(self.path, 'dest')
+        rules_path = os.path.join(self.path, 'rules')
+        with open(rules_path, 'w') as f:
+            f.write('exclude glob large\n')
+        output = self.run_backup('--copy-engine', 'native', '--rules', rules_path, self.source_path, dst_path)
+        self.assertIn(b'1 no longer needed', output)
+        self.assertEqual(sorted(os.listdir(dst_path)), ['FILES.csv', 'README.txt', 'sub'])
+
+    def test_list_directories_included_again(self):
+        os.makedirs(os.path.join(self.source_path, 'skip', 'inner'))
+        self.write('skip/inner/file', b'x')
+        tree_path = os.path.join(self.path, 'tree.dat')
+        rules = backup.FilterRules([('exclude', 'glob', 'skip/')])
+        tree = backup.DirTree.ls(self.source_path, rules=rules)
+        self.assertEqual(tree.find('skip').children, ())
+        tree.save(tree_path)
+
+        tree = backup.DirTree.load(tree_path)
+        self.assertEqual(tree.list_unlisted(), [])
+        tree.find('skip').include_all()
+        self.assertEqual(len(tree.list_unlisted()), 2)
+        self.assertEqual(tree.find('skip/inner/file').size, 1)
+        self.assertEqual(tree.size, 1)
+
+        # the same, in the background
+        tree = backup.DirTree.load(tree_path)
+        tree.find('skip').include_all()
+        scan = tree.scan_unlisted()
+        scan.finish()
+        self.assertEqual(scan.listed, 2)
+        self.assertEqual(tree.find('skip/inner/file').size, 1)
+        self.assertEqual(tree.size, 1)
+        self.assertIsNone(tree.scan_unlisted())
+
+
+    def test_directories_included_again_are_kept_per_tree(self):
+        os.makedirs(os.path.join(self.source_path, 'skip'))
+        self.write('skip/file', b'x')
+        rules = backup.FilterRules([('exclude', 'glob', 'skip/')])
+        tree = backup.DirTree.ls(self.source_path, rules=rules)
+        other = backup.DirTree.ls(self.source_path, rules=rules)
+        # never listed, so its size of 0 isn't known
+        self.assertFalse(tree.find('skip').size_known)
+        tree.find('skip').include_all()
+        other.find('skip').include_all()
+        self.assertEqual(tree.reincluded, set([tree.find('skip')]))
+        self.assertEqual(len(tree.list_unlisted()), 1)
+        self.assertTrue(tree.find('skip').size_known)
+        self.assertEqual(tree.reincluded, set())
+        self.assertEqual(other.reincluded, set([other.find('skip')]))
+
+    def test_scan_error_ends_the_scan(self):
+        tree = backup.DirTree.ls(self.source_path)
+
+        def steps():
+            yield backup.SCAN_LISTED, tree
+            raise OSError(errno.EIO, 'failed')
+
+        scan = backup.TreeScan(tree, backup.ListingPool(1), steps(), dict(listed=1, unchanged=0, wait=False), set())
+        finished = []
+        scan.on_finished = finished.append
+        self.assertEqual(scan.poll(), ([tree], []))
+        self.assertTrue(scan.done)
+        self.assertEqual(scan.error.errno, errno.EIO)
+        self.assertEqual(finished, [scan])
+        with self.assertRaises(OSError):
+            scan.finish()
+
+@unittest.skipIf(backup is None, 'backup.py could not be imported')
+class FilterRulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000 * 24 * 60 * 60
+
+    def match(self, rules, relpath, is_directory=False, size=0, age_days=0):
+        return backup.FilterRules(rules, now=self.now).match(
+            relpath, is_directory, size, self.now - age_days * 24 * 60 * 60)
+
+    def test_globs(self):
+        rules = [
+            ('include', 'glob', '/keep/**'),
+            ('exclude', 'glob', '*.tmp'),
+            ('exclude', 'glob', 'cache/'),
+            ('exclude', 'glob', 'docs/*.pdf'),
+        ]
+        self.assertEqual(self.match(rules, 'a/b.tmp'), backup.FILTER_EXCLUDE_ALL)
+        self.assertEqual(self.match(rules, 'b.tmp'), backup.FILTER_EXCLUDE_ALL)
+        self.assertEqual(self.match(rules, 'keep/a/b.tmp'), backup.FILTER_INCLUDE_ALL)
+        self.assertEqual(self.match(rules, 'a/cache/', is_directory=True), backup.FILTER_EXCLUDE_ALL)
+        # a trailing slash only matches directories
+        self.assertIsNone(self.match(rules, 'a/cache'))
+        # patterns with a slash are anchored at the top, and * doesn't cross directories
+        self.assertEqual(self.match(rules, 'docs/a.pdf'), backup.FILTER_EXCLUDE_ALL)
+        self.assertIsNone(self.match(rules, 'x/docs/a.pdf'))
+        self.assertIsNone(self.match(rules, 'docs/x/a.pdf'))
+        self.assertIsNone(self.match(rules, 'a.txt'))
+
+    def test_first_matching_rule_wins(self):
+        rules = [
+            ('exclude', 'size', '> 1M'),
+            ('include', 'regex', r'important'),
+            ('exclude', 'age', '> 1y'),
+            ('include', 'glob', '*'),
+        ]
+        self.assertEqual(self.match(rules, 'important.iso', size=2 * 1024 * 1024), backup.FILTER_EXCLUDE_ALL)
+        self.assertEqual(self.match(rules, 'old/important.txt', age_days=400), backup.FILTER_INCLUDE_ALL)
+        self.assertEqual(self.match(rules, 'old/other.txt', age_days=400), backup.FILTER_EXCLUDE_ALL)
+        self.assertEqual(self.match(rules, 'new.txt', age_days=10), backup.FILTER_INCLUDE_ALL)
+        # sizes and ages only apply to files
+        self.assertEqual(self.match(rules, 'old/', is_directory=True, age_days=400), backup.FILTER_INCLUDE_ALL)
+
+    def test_regex_groups_stay_separate(self):
+        rules = [
+            ('exclude', 'regex', r'(\w)\1\.bak$'),
+            ('include', 'glob', '*.bak'),
+        ]
+        self.assertEqual(self.match(rules, 'aa.bak'), backup.FILTER_EXCLUDE_ALL)
+        self.assertEqual(self.match(rules, 'ab.bak'), backup.FILTER_INCLUDE_ALL)
+
+    def test_load(self):
+        path = tempfile.mkdtemp()
+        rules_path = os.path.join(path, 'rules')
+        try:
+            with open(rules_path, 'w') as f:
+                f.write('# comment\n\nexclude glob *.tmp\ninclude size < 10K\n')
+            rules = backup.FilterRules.load(rules_path)
+            self.assertEqual(rules.match('a.tmp', False, 0, None), backup.FILTER_EXCLUDE_ALL)
+            self.assertEqual(rules.match('a.txt', False, 100, None), backup.FILTER_INCLUDE_ALL)
+            with open(rules_path, 'w') as f:
+                f.write('exclude glob *.tmp\nexclude size > 10Q\n')
+            with self.assertRaises(ValueError) as context:
+                backup.FilterRules.load(rules_path)
+            self.assertIn(':2: ', str(context.exception))
+        finally:
+            shutil.rmtree(path)
+
+@unittest.skipIf(backup is None, 'backup.py could not be imported')
+class FileChooserTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            self.root = backup.tk.Tk()
+        except backup.tk.TclError:
+            self.skipTest('no display to open the file chooser on')
+        self.path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.path, 'dir', 'sub'))
+        for i in range(10):
+            with open(os.path.join(self.path, 'dir', 'file%d' % (i,)), 'wb') as f:
+                f.write(b'x')
+        with open(os.path.join(self.path, 'dir', 'sub', 'inner'), 'wb') as f:
+            f.write(b'x')
+        self.tree = backup.DirTree.ls(self.path)
+
+    def tearDown(self):
+        backup.DirTree.filter_changed = None
+        self.root.destroy()
+        shutil.rmtree(self.path)
+
+    def open(self, chooser, tree, expand=True):
+        treeview = chooser._FileChooser__treeview
+        treeview.focus(tree.treeview_iid)
+        if expand:
+            chooser._FileChooser__treeview_open(None)
+        else:
+            chooser._FileChooser__treeview_close(None)
+
+    def rows(self, chooser):
+        return len(chooser._FileChooser__tree_by_iid)
+
+    def test_rows_are_inserted_as_directories_are_expanded(self):
+        chooser = backup.FileChooser(self.root, self.tree, unload_collapsed=True)
+        # the root and its one directory
+        self.assertEqual(self.rows(chooser), 2)
+        directory = self.tree.find('dir')
+        self.open(chooser, directory)
+        self.assertEqual(self.rows(chooser), 13)
+        self.assertIsNone(self.tree.find('dir/sub/inner').treeview_iid)
+        self.open(chooser, directory, expand=False)
+        self.assertEqual(self.rows(chooser), 2)
+        self.assertIsNone(self.tree.find('dir/file0').treeview_iid)
+
+    def test_rows_are_refreshed_once_idle(self):
+        chooser = backup.FileChooser(self.root, self.tree)
+        self.open(chooser, self.tree.find('dir'))
+        treeview = chooser._FileChooser__treeview
+        file_iid = self.tree.find('dir/file0').treeview_iid
+        self.tree.exclude_all()
+        self.assertNotIn('exclude', treeview.item(file_iid, 'tags'))
+        self.root.update_idletasks()
+        self.assertIn('exclude', treeview.item(file_iid, 'tags'))
+        (batches, rows, flush_time, max_flush_time) = chooser.flush_timings
+        self.assertEqual((batches, rows), (1, 13))
+
+
+    def test_names_are_indexed_on_the_first_search(self):
+        chooser = backup.FileChooser(self.root, self.tree)
+        self.assertIsNone(chooser._FileChooser__index)
+        chooser._FileChooser__search_text.insert(0, 'inner')
+        chooser._FileChooser__search()
+        self.assertIsNotNone(chooser._FileChooser__index)
+        self.assertEqual(chooser._FileChooser__search_list.get(0, backup.tk.END), (self.tree.name + 'dir/sub/inner',))
+
+@unittest.skipIf(backup is None, 'backup.py could not be imported')
+class ThrottleTest(unittest.TestCase):
+
+    def test_bytes(self):
+        throttle = backup.Throttle(bytes_per_second=1000)
+        start_time = time.time()
+        # a second's worth at once, then what's taken beyond it is slept off
+        throttle.take(1000)
+        self.assertLess(time.time() - start_time, 0.1)
+        throttle.take(300)
+        self.assertGreaterEqual(time.time() - start_time, 0.25)
+        self.assertAlmostEqual(throttle.waited, 0.3, delta=0.05)
+
+    def test_operations(self):
+        throttle = backup.Throttle(operations_per_second=10)
+        start_time = time.time()
+        for i in range(13):
+            throttle.take(0)
+        self.assertGreaterEqual(time.time() - start_time, 0.25)
+        # bytes aren't limited, and reads that cost no operations don't wait
+        throttle = backup.Throttle(operations_per_second=1)
+        throttle.take(10 ** 9)
+        throttle.take(10 ** 9, operations=0)
+        self.assertEqual(throttle.waited, 0)
+
+
+@unittest.skipIf(backup is None, 'backup.py could not be imported')
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = imp.load_source('backup_scheduler', SCHEDULER_PATH)
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def options(self, **options):
+        values = dict(max_jobs=4, jobs_per_device=2, device_bandwidth=1000, device_iops=None)
+        values.update(options)
+        return optparse.Values(values)
+
+    def test_job_command(self):
+        job = dict(name='job', source='src', dest='dst', args=['--snapshot'])
+        command = self.scheduler.job_command(job, self.options(device_iops=10), 3)
+        self.assertEqual(command[2:], ['-q', '--max-bandwidth', '333', '--max-iops', '3', '--snapshot', 'src', 'dst'])
+
+    def test_jobs_share_the_budget_with_those_running(self):
+        # each job gets the budget divided by the jobs running on its device when it starts
+        shares = []
+
+        def job_command(job, options, sharing=1):
+            shares.append((job['name'], options.device_bandwidth // sharing))
+            return [sys.executable, '-c', 'import time; time.sleep(%s)' % (job['seconds'],)]
+
+        self.scheduler.job_command = job_command
+        self.scheduler.POLL_SECONDS = 0.01
+        jobs = [
+            dict(name='first', devices=[1], seconds=0.5),
+            dict(name='second', devices=[1], seconds=0.1),
+            dict(name='third', devices=[1], seconds=0),
+            dict(name='elsewhere', devices=[2], seconds=0),
+        ]
+        saved = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            results = self.scheduler.run_jobs(jobs, self.options(), self.path)
+        finally:
+            sys.stdout.close()
+            sys.stdout = saved
+        self.assertEqual([returncode for (job, returncode, elapsed_time) in results], [0] * 4)
+        self.assertEqual(shares, [('first', 1000), ('second', 500), ('elsewhere', 1000), ('third', 500)])
+
+@unittest.skipIf(backup is None, 'backup.py could not be imported')
+class CopyFileContentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.data = bytes(bytearray(random.Random(0).randrange(256) for i in range(10000)))
+        self.src_path = os.path.join(self.path, 'src')
+        with open(self.src_path, 'wb') as f:
+            f.write(self.data)
+        self.dst_path = os.path.join(self.path, 'dst')
+        # small chunks, so every copy takes several calls
+        self.saved = (backup.KERNEL_COPY_METHODS, backup.COPY_CHUNK_SIZE)
+        backup.COPY_CHUNK_SIZE = 1024
+        self.calls = []
+
+    def tearDown(self):
+        (backup.KERNEL_COPY_METHODS, backup.COPY_CHUNK_SIZE) = self.saved
+        shutil.rmtree(self.path)
+
+    def copy(self, offset=0, digest=None):
+        with open(self.src_path, 'rb') as fsrc:
+            with open(self.dst_path, 'wb') as fdst:
+                if offset:
+                    fdst.write(self.data[:offset])
+                    fdst.flush()
+                    fsrc.seek(offset)
+                backup.copy_file_contents(fsrc, fdst, digest)
+        with open(self.dst_path, 'rb') as f:
+            return f.read()
+
+    def recorded(self, method):
+        def record(infd, outfd, count):
+            self.calls.append(method)
+            return method(infd, outfd, count)
+        return record
+
+    def failing(self, error):
+        def fail(infd, outfd, count):
+            self.calls.append(error)
+            raise OSError(error, os.strerror(error))
+        return fail
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'kernel-side copies are only used on Linux')
+    def test_kernel_copy(self):
+        self.assertTrue(self.saved[0])
+        backup.KERNEL_COPY_METHODS = [self.recorded(method) for method in self.saved[0]]
+        self.assertEqual(self.copy(), self.data)
+        self.assertGreater(len(self.calls), 1)
+        self.assertTrue(all(call is self.saved[0][0] for call in self.calls))
+        del self.calls[:]
+        self.assertEqual(self.copy(offset=3000), self.data)
+        self.assertTrue(self.calls)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'kernel-side copies are only used on Linux')
+    def test_digest_with_kernel_copy(self):
+        backup.KERNEL_COPY_METHODS = [self.recorded(method) for method in self.saved[0]]
+        for offset in (0, 3000):
+            digest = backup.hashlib.new('sha1')
+            self.assertEqual(self.copy(offset=offset, digest=digest), self.data)
+            self.assertTrue(self.calls)
+            self.assertEqual(digest.hexdigest(), backup.hashlib.sha1(self.data[offset:]).hexdigest())
+            del self.calls[:]
+
+    def test_digest_without_kernel_copy(self):
+        backup.KERNEL_COPY_METHODS = [self.failing(errno.EXDEV)]
+        digest = backup.hashlib.new('sha1')
+        self.assertEqual(self.copy(digest=digest), self.data)
+        self.assertEqual(self.calls, [errno.EXDEV])
+        self.assertEqual(digest.hexdigest(), backup.hashlib.sha1(self.data).hexdigest())
+
+    def test_falls_back_when_unsupported(self):
+        backup.KERNEL_COPY_METHODS = [self.failing(errno.EXDEV), self.failing(errno.EINVAL)]
+        self.assertEqual(self.copy(), self.data)
+        self.assertEqual(self.calls, [errno.EXDEV, errno.EINVAL])
+        del self.calls[:]
+        self.assertEqual(self.copy(offset=3000), self.data)
+        self.assertEqual(self.calls, [errno.EXDEV, errno.EINVAL])
+
+    def test_error_after_copying_is_raised(self):
+        copied = []
+
+        def partial(infd, outfd, count):
+            if copied:
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+            copied.append(count)
+            return os.write(outfd, os.read(infd, count))
+
+        backup.KERNEL_COPY_METHODS = [partial]
+        with self.assertRaises(OSError):
+            self.copy()
+
+
+if __name__ == '__main__':
+    unittest.main()